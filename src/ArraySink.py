@@ -0,0 +1,159 @@
+import json
+import os
+import struct
+import numpy as np
+
+try:
+    from .Metrics import metrics
+    from .Triangular import unpack_triangular
+except ImportError:
+    from Metrics import metrics
+    from Triangular import unpack_triangular
+
+# Python 3.8.2
+
+__all__ = ["ArraySink", "load_shard", "build_manifest", "merge_manifests"]
+
+# Size reserved for the .npy header of a shard. The header is rewritten in place once the final number of images is known.
+NPY_HEADER_LENGTH = 128
+
+def _npy_header(dtype, shape) -> bytes:
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)})
+    # magic string (6 bytes) + version (2 bytes) + header length (2 bytes) + header
+    header = header.ljust(NPY_HEADER_LENGTH - 10 - 1) + '\n'
+    return b'\x93NUMPY' + bytes([1, 0]) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+# Writes the images of one source file as dense arrays instead of one PNG per image.
+# Images are grouped in shards, one per output folder (i.e. method/class) and image shape:
+#   {image_folder}/{source_file_name}-{height}x{width}.npy   ndarray, shape (n_images, height, width), memory mappable with np.load(mmap_mode='r')
+#   {image_folder}/{source_file_name}-{height}x{width}.json  manifest: source file, parameters and one item per image (label, annotation, channel, ...)
+# Images are streamed to disk as they are saved, so memory use doesn't grow with the number of images.
+# Use `close` (or a `with` block) to finish the shards, otherwise the .npy headers are not valid.
+class ArraySink:
+    def __init__(self, source_file: str, parameters: dict = None, dtype=None):
+        self.source_file = source_file
+        self.source_file_name = source_file.split('/')[-1]
+        self.parameters = parameters or {}
+        # None keeps the dtype of the first image saved in each shard
+        self.dtype = dtype
+        self.shards = {}
+        # Paths of every file written, used by the callers to know what was generated
+        self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    # packing: set when the images are packed triangular matrices (see Triangular), saved in the shard manifest so
+    # `load_shard` can expand them: {"layout": "upper", "size": n, "antisymmetric": bool, "dense_shape": shape of one dense image}.
+    def save(self, image_folder: str, image_file_name: str, image: np.ndarray, metadata: dict = None, packing: dict = None):
+        image = np.asarray(image)
+        key = (image_folder, image.shape)
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.__open_shard(image_folder, image.shape, image.dtype if self.dtype is None else self.dtype)
+            shard["packing"] = packing
+            self.shards[key] = shard
+
+        item = {"index": len(shard["items"]), "name": image_file_name}
+        item.update(metadata or {})
+        shard["items"].append(item)
+        data = np.ascontiguousarray(image, dtype=shard["dtype"])
+        with metrics.timer("write"):
+            shard["file"].write(data.tobytes())
+        metrics.count("images")
+        metrics.count("bytes_written", data.nbytes)
+
+    # images: ndarray, shape (n_images, height, width), one file name (and optionally one metadata dict) per image
+    def save_batch(self, image_folder: str, image_file_names: list, images: np.ndarray, metadata: list = None, packing: dict = None):
+        for index, (image_file_name, image) in enumerate(zip(image_file_names, images)):
+            self.save(image_folder, image_file_name, image, None if metadata is None else metadata[index], packing=packing)
+
+    def close(self):
+        for shard in self.shards.values():
+            f = shard["file"]
+            f.seek(0)
+            f.write(_npy_header(shard["dtype"], (len(shard["items"]),) + shard["shape"]))
+            f.close()
+
+            manifest = {
+                "source_file": self.source_file,
+                "array": os.path.basename(shard["path"]),
+                "shape": [len(shard["items"])] + list(shard["shape"]),
+                "dtype": np.dtype(shard["dtype"]).name,
+                "parameters": self.parameters,
+                "items": shard["items"],
+            }
+            if shard["packing"] is not None:
+                manifest["packing"] = shard["packing"]
+            manifest_path = shard["path"][:-len('.npy')] + '.json'
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+            self.written += [shard["path"], manifest_path]
+        self.shards = {}
+
+    def __open_shard(self, image_folder: str, shape: tuple, dtype):
+        os.makedirs(image_folder, exist_ok=True)
+        shape_name = 'x'.join(str(dim) for dim in shape)
+        path = f'{image_folder}/{self.source_file_name}-{shape_name}.npy'
+        f = open(path, 'wb')
+        # Placeholder, rewritten by `close`
+        f.write(_npy_header(dtype, (0,) + tuple(shape)))
+        return {"path": path, "file": f, "shape": tuple(shape), "dtype": np.dtype(dtype), "items": []}
+
+# Load a shard written by `ArraySink`. Returns (images, manifest), `images` is memory mapped by default.
+# dense: expand packed triangular shards (manifest["packing"]) to the full matrices, which reads the whole shard in memory.
+# Use dense=False to keep them packed and memory mapped, and Triangular.unpack_triangular to expand only some images.
+def load_shard(manifest_path: str, mmap_mode: str = 'r', dense: bool = True):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    images = np.load(f'{os.path.dirname(manifest_path)}/{manifest["array"]}', mmap_mode=mmap_mode)
+    packing = manifest.get("packing")
+    if dense and packing is not None:
+        images = unpack_triangular(images, packing["size"], antisymmetric=packing["antisymmetric"])
+        images = images.reshape((len(images),) + tuple(packing["dense_shape"]))
+    return images, manifest
+
+# Combine the manifests of every shard under `output_folder` (hidden folders excluded) into one index.
+# Each item gets the path of its shard array, relative to `output_folder`. The index is saved to `{output_folder}/{manifest_name}`.
+# manifest_paths: only combine these shard manifests instead of every one found under `output_folder`, e.g. the ones written by a run.
+# extra: added to the index, e.g. which part of a distributed run it covers.
+def build_manifest(output_folder: str, manifest_name: str = 'manifest.json', manifest_paths: list = None, extra: dict = None):
+    if manifest_paths is None:
+        manifest_paths = []
+        for root, dirs, files in os.walk(output_folder):
+            # Hidden folders hold caches (e.g. the kernel banks or a dataset cache), not outputs of the run
+            dirs[:] = sorted(folder for folder in dirs if not folder.startswith('.'))
+            manifest_paths += [os.path.join(root, file) for file in sorted(files) if file.endswith('.json')]
+
+    shards = []
+    for path in manifest_paths:
+        if os.path.basename(path) == manifest_name:
+            continue
+        with open(path) as f:
+            shard = json.load(f)
+        if "array" not in shard or "items" not in shard:
+            continue
+        shard["array"] = os.path.relpath(os.path.join(os.path.dirname(path), shard["array"]), output_folder)
+        shards.append(shard)
+
+    manifest_path = f'{output_folder}/{manifest_name}'
+    with open(manifest_path, 'w') as f:
+        json.dump(dict(extra or {}, shards=shards), f)
+    return manifest_path
+
+# Combine indexes written by `build_manifest` (e.g. one per node of a distributed run) into `{output_folder}/{manifest_name}`.
+# The shard arrays are sorted by path, so the result doesn't depend on the order of `index_paths`.
+def merge_manifests(output_folder: str, index_paths: list, manifest_name: str = 'manifest.json'):
+    shards = []
+    for path in index_paths:
+        with open(path) as f:
+            shards += json.load(f)["shards"]
+    shards.sort(key=lambda shard: shard["array"])
+
+    manifest_path = f'{output_folder}/{manifest_name}'
+    with open(manifest_path, 'w') as f:
+        json.dump({"shards": shards}, f)
+    return manifest_path
@@ -0,0 +1,254 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import get_context
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None
+    resource = None
+
+from Logger import log, set_verbosity, QUIET
+from Metrics import Metrics, STAGES
+from SyntheticEEG import generate_gdf_file, DESCRIPTION_CUE_LEFT, DESCRIPTION_CUE_RIGHT
+
+# Python 3.8.2
+
+__all__ = ["run_case", "run_benchmark", "compare_results", "measure_startup"]
+
+# Reproducible throughput benchmark on synthetic recordings (see SyntheticEEG), no dataset needed.
+# Each case is a run of TS2Image.generate_images, the code path of main.py (catalog, build cache, sinks and worker processes included),
+# and the time of each stage (load, filter, epoch, transform, significance, encode, write) is read from its metrics, see Metrics.
+# Ex.: python src/Benchmark.py --methods GAF ERSP --duration 300 600 --output benchmark.json
+#      python src/Benchmark.py --files 4 --workers 4 --output benchmark.json
+#      python src/Benchmark.py --output new.json --compare benchmark.json
+
+# Process high-water mark so far, in MB. Worker processes are started by the fork server, they aren't counted.
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def case_name(case: dict) -> str:
+    name = f'{case["method"]}-{case["n_channels"]}ch-{case["sfreq"]}Hz-{case["duration"]:g}s-{case["output_format"]}'
+    if case["method"] == "GAF" and case["image_size"] is not None:
+        name += f'-size{case["image_size"]}'
+    if case["n_files"] > 1 or case["n_workers"] > 1:
+        name += f'-{case["n_files"]}files-{case["n_workers"]}workers'
+    return name + ("-lazy" if case["lazy"] else "")
+
+# Run one benchmark case and return its measurements. Runs in a fresh process (see `run_benchmark`) so the peak RSS is the case's own.
+# case: method, input_folder, n_channels, sfreq, duration, n_files, n_workers, output_format, lazy, t_start, window, per_trial, image_size and work_dir.
+# The images are generated by TS2Image.generate_images, like main.py, for the cues of every file in `input_folder`, with the window
+# [t_start, t_start + window] for GAF and [t_start, window] for ERSP, into a new output folder: the build cache is always cold.
+# Stage seconds are summed over the files (and the ImageWriter threads), the total is the wall time of the run.
+def run_case(case: dict) -> dict:
+    import mne
+    from TS2Image import TS2Image
+    mne.set_log_level('WARNING')
+    # Only the run summary and errors
+    set_verbosity(QUIET)
+
+    output_folder = tempfile.mkdtemp(prefix='output-', dir=case["work_dir"])
+    cues = [DESCRIPTION_CUE_LEFT, DESCRIPTION_CUE_RIGHT]
+    started_at = time.perf_counter()
+    results = TS2Image(case["input_folder"], output_folder).generate_images(
+        method=case["method"], valid_events_descriptions=cues, events_dictionary={cue: cue for cue in cues}, t_start=case["t_start"], duration=case["window"],
+        n_workers=case["n_workers"], output_format=case["output_format"], use_cache=True, lazy=case["lazy"], per_trial=case["per_trial"],
+        image_size=case["image_size"], metrics_report=None)
+    wall_seconds = time.perf_counter() - started_at
+    shutil.rmtree(output_folder)
+
+    failed = [result for result in results if result["error"] is not None]
+    if len(failed) > 0:
+        raise RuntimeError(f'{case_name(case)}: {failed[0]["file"]} failed: {failed[0]["error"]}')
+    run_metrics = Metrics()
+    for result in results:
+        run_metrics.merge(result["metrics"])
+    summary = run_metrics.summary()
+    return {"stages": {stage: summary["stages"].get(stage, {"seconds": 0.0})["seconds"] for stage in STAGES}, "wall_seconds": wall_seconds,
+            "n_epochs": summary["counters"].get("epochs", 0), "n_files": sum(len(outputs) for result in results for outputs in result["outputs"].values()),
+            "bytes_written": summary["counters"].get("bytes_written", 0),
+            "input_bytes": sum(entry.stat().st_size for entry in os.scandir(case["input_folder"]) if entry.is_file()), "peak_rss_mb": peak_rss_mb()}
+
+# Process target: send the result of `run_case`, or the error, back to the parent
+def _run_case_process(case: dict, connection):
+    try:
+        connection.send((run_case(case), None))
+    except Exception as e:
+        connection.send((None, f'{type(e).__name__}: {e}'))
+    finally:
+        connection.close()
+
+# Summary of the repeats of a case: median time of each stage, and the worst peak RSS.
+def summarize_runs(case: dict, runs: list) -> dict:
+    stages = {}
+    for stage in STAGES:
+        seconds = float(np.median([run["stages"][stage] for run in runs]))
+        stages[stage] = {"seconds": seconds, "epochs_per_second": runs[0]["n_epochs"] / seconds if seconds > 0 else None}
+    total_seconds = float(np.median([run["wall_seconds"] for run in runs]))
+    return {"name": case_name(case), "case": {key: value for key, value in case.items() if key not in ["input_folder", "work_dir"]},
+            "n_epochs": runs[0]["n_epochs"], "n_files": runs[0]["n_files"], "bytes_written": runs[0]["bytes_written"], "input_bytes": runs[0]["input_bytes"],
+            "total_seconds": total_seconds, "epochs_per_second": runs[0]["n_epochs"] / total_seconds if total_seconds > 0 else None,
+            "peak_rss_mb": max((run["peak_rss_mb"] or 0) for run in runs) or None, "stages": stages,
+            "runs": [dict(run["stages"], total=run["wall_seconds"]) for run in runs]}
+
+def environment() -> dict:
+    import mne
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"git_commit": commit, "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "numpy": np.__version__, "mne": mne.__version__}
+
+# Cold start, median of `repeat` fresh interpreters: the interpreter alone, importing the pipeline (what the main process and a dry run pay
+# before doing anything) and importing the modules preloaded for the worker processes (what their fork server pays once per run).
+def measure_startup(repeat: int = 3) -> dict:
+    from TS2Image import WORKER_PRELOAD
+    src_folder = os.path.dirname(os.path.abspath(__file__))
+    commands = {"interpreter": "pass", "pipeline": "import TS2Image", "workers": "; ".join(f'import {module}' for module in WORKER_PRELOAD)}
+    startup = {}
+    for name, code in commands.items():
+        seconds = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {src_folder!r}); {code}'], check=True)
+            seconds.append(time.perf_counter() - started_at)
+        startup[name] = float(np.median(seconds))
+    return startup
+
+# Run every combination of the given parameters, `repeat` times each, and return the results (see `summarize_runs`).
+# The synthetic recordings are generated once in `work_dir` (not timed) and reused, the same seed always gives the same files.
+# Each case processes `n_files` recordings named like the BCI competition IV 2b training files, so TS2Image accepts them,
+# with `n_workers` worker processes (see TS2Image.generate_images, the files are the parallel units).
+def run_benchmark(work_dir: str, methods: list, n_channels: list, sfreqs: list, durations: list, output_formats: list, lazy: bool = False,
+                  t_start=-1, window=4, per_trial: bool = False, image_size: int = None, n_files: int = 1, n_workers: int = 1, repeat: int = 3, seed: int = 0) -> dict:
+    os.makedirs(work_dir, exist_ok=True)
+    cases = []
+    for method, channels, sfreq, duration, output_format in itertools.product(methods, n_channels, sfreqs, durations, output_formats):
+        # Every file of the folder is processed, one folder per number of files
+        input_folder = f'{work_dir}/synthetic-{channels}ch-{sfreq}Hz-{duration:g}s-{n_files}files-seed{seed}'
+        os.makedirs(input_folder, exist_ok=True)
+        for index in range(n_files):
+            file_path = f'{input_folder}/B{index + 1:02d}01T.gdf'
+            if not os.path.exists(file_path):
+                log(f'Generating {file_path}')
+                generate_gdf_file(file_path, n_channels=channels, sfreq=sfreq, duration=duration, seed=seed + index)
+        cases.append({"method": method.upper(), "input_folder": input_folder, "n_channels": channels, "sfreq": sfreq, "duration": duration,
+                      "n_files": n_files, "n_workers": n_workers, "output_format": output_format, "lazy": lazy, "t_start": t_start, "window": window,
+                      "per_trial": per_trial, "image_size": image_size, "seed": seed, "work_dir": work_dir})
+
+    results = []
+    # A fresh process for each run: no warm caches from the previous case and a clean peak RSS.
+    # Not a pool process, which couldn't start the worker processes of the case.
+    context = get_context('spawn')
+    for case in cases:
+        runs = []
+        for repetition in range(repeat):
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_case_process, args=(case, sender))
+            process.start()
+            sender.close()
+            try:
+                run, error = receiver.recv()
+            except EOFError:
+                run, error = None, f'the process exited with code {process.exitcode}'
+            process.join()
+            if error is not None:
+                raise RuntimeError(f'{case_name(case)}: {error}')
+            runs.append(run)
+            log(f'{case_name(case)} [{repetition + 1}/{repeat}]: {run["wall_seconds"]:.2f}s')
+        results.append(summarize_runs(case, runs))
+    return {"created": datetime.utcnow().isoformat(), "environment": environment(), "startup": measure_startup(repeat), "cases": results}
+
+# Compare two benchmark results case by case. Returns the list of (case, stage, old seconds, new seconds) slower than
+# `threshold` (e.g. 0.1 is 10% slower). Stages faster than `min_seconds` in both runs are ignored, they are mostly noise.
+def compare_results(old: dict, new: dict, threshold: float = 0.1, min_seconds: float = 0.05) -> list:
+    old_cases = {case["name"]: case for case in old["cases"]}
+    regressions = []
+    for case in new["cases"]:
+        if case["name"] not in old_cases:
+            continue
+        old_case = old_cases[case["name"]]
+        # Results saved before a stage existed don't have it
+        timings = [(stage, old_case["stages"][stage]["seconds"], case["stages"][stage]["seconds"]) for stage in STAGES if stage in old_case["stages"]]
+        timings.append(("total", old_case["total_seconds"], case["total_seconds"]))
+        for stage, old_seconds, new_seconds in timings:
+            if max(old_seconds, new_seconds) < min_seconds:
+                continue
+            change = (new_seconds - old_seconds) / old_seconds if old_seconds > 0 else float('inf')
+            print(f'{case["name"]:<40} {stage:<10} {old_seconds:9.3f}s -> {new_seconds:9.3f}s ({change:+.1%})')
+            if change > threshold:
+                regressions.append((case["name"], stage, old_seconds, new_seconds))
+    # Results saved before the startup was measured don't have it
+    for name, new_seconds in new.get("startup", {}).items():
+        old_seconds = old.get("startup", {}).get(name)
+        if old_seconds is None or max(old_seconds, new_seconds) < min_seconds:
+            continue
+        change = (new_seconds - old_seconds) / old_seconds if old_seconds > 0 else float('inf')
+        print(f'{"startup":<40} {name:<10} {old_seconds:9.3f}s -> {new_seconds:9.3f}s ({change:+.1%})')
+        if change > threshold:
+            regressions.append(("startup", name, old_seconds, new_seconds))
+    return regressions
+
+def print_results(results: dict):
+    print(f'{"case":<40} {"epochs":>6} {"epochs/s":>9} {"MB written":>10} {"peak RSS MB":>11} {"total":>9} ' + ' '.join(f'{stage:>12}' for stage in STAGES))
+    for case in results["cases"]:
+        print(f'{case["name"]:<40} {case["n_epochs"]:>6} {case["epochs_per_second"] or 0:>9.1f} {case["bytes_written"] / 1024 ** 2:>10.1f} '
+              f'{case["peak_rss_mb"] or 0:>11.0f} {case["total_seconds"]:>8.3f}s ' + ' '.join(f'{case["stages"][stage]["seconds"]:>11.3f}s' for stage in STAGES))
+    print('startup: ' + ', '.join(f'{name} {seconds:.3f}s' for name, seconds in results["startup"].items()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark TS2Image on synthetic recordings.')
+    parser.add_argument('--methods', dest='methods', type=str, nargs='+', default=['GAF', 'ERSP'], help='Methods to benchmark (default: GAF ERSP)')
+    parser.add_argument('--channels', dest='n_channels', type=int, nargs='+', default=[3], help='Numbers of channels (default: 3)')
+    parser.add_argument('--sfreq', dest='sfreqs', type=int, nargs='+', default=[250], help='Sampling frequencies in Hz (default: 250)')
+    parser.add_argument('--duration', dest='durations', type=float, nargs='+', default=[300], help='Recording durations in seconds (default: 300)')
+    parser.add_argument('--output-format', dest='output_formats', type=str, nargs='+', default=['png'], choices=['png', 'npy'],
+                        help='Output formats (default: png)')
+    parser.add_argument('--lazy', dest='lazy', action='store_true', help='Read and filter only the epoch windows')
+    parser.add_argument('--per-trial', dest='per_trial', action='store_true', help='ERSP: write one image per trial instead of the averages')
+    parser.add_argument('--t-start', dest='t_start', type=float, default=-1, help='Window start around each cue in seconds (default: -1)')
+    parser.add_argument('--window', dest='window', type=float, default=4, help='Window duration in seconds (default: 4)')
+    parser.add_argument('--files', dest='n_files', type=int, default=1, help='Recordings processed by each case (default: 1)')
+    parser.add_argument('--workers', dest='n_workers', type=int, default=1, help='Worker processes of each case, see main.py --workers (default: 1)')
+    parser.add_argument('--image-size', dest='image_size', type=int, default=None, help='GAF image size, PAA downsampling (default: one pixel per sample)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Runs of each case, the median is reported (default: 3)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the synthetic recordings (default: 0)')
+    parser.add_argument('--work-dir', dest='work_dir', type=str, default=None,
+                        help='Folder for the synthetic recordings and outputs, reused between runs (default: a temporary folder)')
+    parser.add_argument('--output', dest='output', type=str, default='benchmark.json', help='JSON results file (default: benchmark.json)')
+    parser.add_argument('--compare', dest='compare', type=str, default=None, help='Previous JSON results to compare with')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=0.1,
+                        help='With --compare, exit with status 1 if a stage is slower by more than this fraction (default: 0.1)')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='ts2image-benchmark-')
+    results = run_benchmark(work_dir, methods=args.methods, n_channels=args.n_channels, sfreqs=args.sfreqs, durations=args.durations,
+                            output_formats=args.output_formats, lazy=args.lazy, t_start=args.t_start, window=args.window,
+                            per_trial=args.per_trial, image_size=args.image_size, n_files=args.n_files, n_workers=args.n_workers, repeat=args.repeat, seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    log(f'Results saved to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, threshold=args.threshold)
+        if len(regressions) > 0:
+            log(f'{len(regressions)} regressions above {args.threshold:.0%}')
+            sys.exit(1)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+# Python 3.8.2
+
+__all__ = ["BuildCache"]
+
+# Bump when a change in the image generation makes previously generated outputs obsolete
+CACHE_VERSION = 1
+
+# Persistent record of what was already generated in an output folder, so re-runs only redo stale work.
+# Entries are keyed on the content hash of the input file plus the effective generation parameters
+# (method, channels, time window, filter band, image size, events, ...). An entry is valid while all its outputs exist.
+# Stored as JSON in `{output_folder}/.ts2image-cache.json`.
+# Not safe for concurrent writers: only the parent process should `record`/`save`, workers just return their outputs.
+class BuildCache:
+    def __init__(self, output_folder: str, cache_file_name: str = '.ts2image-cache.json'):
+        self.output_folder = output_folder
+        self.path = f'{output_folder}/{cache_file_name}'
+        self.hashes = {}
+        self.entries = {}
+        # Outputs of superseded entries that the entry replacing them didn't overwrite, deleted by `garbage_collect`
+        self.orphans = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                content = json.load(f)
+            if content.get("version") == CACHE_VERSION:
+                self.hashes = content.get("hashes", {})
+                self.entries = content.get("entries", {})
+                self.orphans = content.get("orphans", [])
+
+    # SHA-256 of the file content. Memoized on (size, mtime) so unchanged files are not read again.
+    def file_hash(self, file_path: str) -> str:
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        memo = self.hashes.get(file_path)
+        if memo is not None and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+            return memo["sha256"]
+
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+        self.hashes[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+        return self.hashes[file_path]["sha256"]
+
+    def key(self, file_path: str, parameters: dict) -> str:
+        content = json.dumps({"file": self.file_hash(file_path), "parameters": parameters, "version": CACHE_VERSION}, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    # True if `key` was generated before and all its outputs are still there
+    def is_valid(self, key: str) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and all(os.path.exists(output) for output in entry["outputs"])
+
+    # Remember the outputs generated for `key`. Older entries for the same file and job are superseded: the outputs with
+    # the same names have been overwritten, the others (e.g. after a change of image size, which is in the names) are kept
+    # on disk and deleted by `garbage_collect`.
+    def record(self, key: str, file_path: str, job: str, parameters: dict, outputs: list):
+        file_path = os.path.abspath(file_path)
+        for old_key in [k for k, entry in self.entries.items() if entry["file"] == file_path and entry["job"] == job and k != key]:
+            self.orphans += [output for output in self.entries.pop(old_key)["outputs"] if output not in outputs]
+        self.entries[key] = {
+            "file": file_path,
+            "job": job,
+            "file_hash": self.file_hash(file_path),
+            "parameters": parameters,
+            "outputs": sorted(outputs),
+            "created": datetime.utcnow().isoformat(),
+        }
+
+    # Forget the entries of `file_path` (or all entries if None) so they are generated again on the next run.
+    # Outputs are left on disk. Returns the number of entries removed.
+    def invalidate(self, file_path: str = None) -> int:
+        if file_path is None:
+            keys = list(self.entries.keys())
+        else:
+            file_path = os.path.abspath(file_path)
+            keys = [key for key, entry in self.entries.items() if entry["file"] == file_path]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    # Remove the entries whose input file is gone or has changed since they were generated, and delete their
+    # outputs and the outputs of superseded entries (see `record`) unless a live entry still uses them.
+    # Returns (entries removed, files deleted).
+    def garbage_collect(self):
+        stale_keys = []
+        for key, entry in self.entries.items():
+            if not os.path.exists(entry["file"]) or self.file_hash(entry["file"]) != entry["file_hash"]:
+                stale_keys.append(key)
+
+        stale_outputs = set(self.orphans)
+        self.orphans = []
+        for key in stale_keys:
+            stale_outputs.update(self.entries.pop(key)["outputs"])
+        live_outputs = set(output for entry in self.entries.values() for output in entry["outputs"])
+
+        deleted = 0
+        for output in sorted(stale_outputs - live_outputs):
+            if os.path.exists(output):
+                os.remove(output)
+                deleted += 1
+        self.hashes = {path: memo for path, memo in self.hashes.items() if os.path.exists(path)}
+        return len(stale_keys), deleted
+
+    def save(self):
+        os.makedirs(self.output_folder, exist_ok=True)
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({"version": CACHE_VERSION, "hashes": self.hashes, "entries": self.entries, "orphans": sorted(set(self.orphans))}, f)
+        # Atomic, an interrupted run never leaves a half written cache
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,109 @@
+import json
+import os
+import platform
+
+try:
+    from .Logger import log, DEBUG
+except ImportError:
+    from Logger import log, DEBUG
+
+# Python 3.8.2
+
+__all__ = ["Catalog", "scan_file", "estimate_epochs", "epoch_events", "CATALOG_VERSION"]
+
+# Bump when the entries change, older catalogs are then rebuilt
+CATALOG_VERSION = 2
+
+# Read the header and the event table of a recording, not its samples.
+# Returns the catalog entry: sampling rate, channel names, number of samples, duration, recording date and the events
+# ({description: count}, {description: [onsets in seconds]} and {description: [indexes among the annotations]}),
+# plus the size and modification time used to detect changes.
+def scan_file(file_path: str) -> dict:
+    import mne
+    raw = mne.io.read_raw_gdf(file_path, preload=False, verbose=False)
+    stat = os.stat(file_path)
+    events = {}
+    onsets = {}
+    indexes = {}
+    for annotation_index, (description, onset) in enumerate(zip(raw.annotations.description, raw.annotations.onset)):
+        description = str(description)
+        events[description] = events.get(description, 0) + 1
+        onsets.setdefault(description, []).append(round(float(onset), 6))
+        indexes.setdefault(description, []).append(annotation_index)
+    meas_date = raw.info['meas_date']
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sfreq": float(raw.info['sfreq']),
+        "ch_names": list(raw.ch_names),
+        "n_times": int(raw.n_times),
+        "duration": float(raw.n_times / raw.info['sfreq']),
+        "meas_date": None if meas_date is None else meas_date.isoformat(),
+        "events": events,
+        "onsets": onsets,
+        "indexes": indexes,
+    }
+
+# Number of epochs `preprocess_file` would extract from a catalog entry: events with a description in `descriptions`
+# whose [tmin, tmax] window fits inside the recording. Estimated from the header, without loading the recording.
+def estimate_epochs(entry: dict, descriptions: list, tmin, tmax) -> int:
+    return len(epoch_events(entry, descriptions, tmin, tmax))
+
+# The epochs `preprocess_file` would extract from a catalog entry, in the recording order: [(annotation_index, description, onset)],
+# annotation_index being the index among the events with a description in `descriptions`, like EpochedRecording.annotation_indexes.
+# Events at the same onset keep the order of the annotations, like the preprocessing.
+def epoch_events(entry: dict, descriptions: list, tmin, tmax) -> list:
+    sfreq = entry["sfreq"]
+    first_sample_offset = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - first_sample_offset + 1
+    # (onset, description) in the order of the annotations, which mne sorts by onset
+    events = sorted(((onset, description, index) for description in dict.fromkeys(descriptions)
+                     for onset, index in zip(entry["onsets"].get(description, []), entry["indexes"].get(description, []))), key=lambda event: event[2])
+    epochs = []
+    for annotation_index, (onset, description, _) in enumerate(events):
+        start = int(round(onset * sfreq)) + first_sample_offset
+        if start >= 0 and start + n_times <= entry["n_times"]:
+            epochs.append((annotation_index, description, onset))
+    return epochs
+
+# Index of the recordings of a dataset built from their headers only (see `scan_file`), saved as JSON so files are
+# only scanned again when they change. Used to select files and plan runs before loading any signal.
+#   {"version": CATALOG_VERSION, "entries": {file_path: entry}}
+class Catalog:
+    def __init__(self, catalog_path: str):
+        self.path = catalog_path
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                catalog = json.load(f)
+            if catalog.get("version") == CATALOG_VERSION:
+                self.entries = catalog["entries"]
+
+    # Scan the files that are new or changed since they were cataloged. Returns the number of files scanned.
+    def update(self, file_paths: list) -> int:
+        scanned = 0
+        for file_path in file_paths:
+            entry = self.entries.get(file_path)
+            stat = os.stat(file_path)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                continue
+            log(f'Cataloging {file_path}', level=DEBUG)
+            self.entries[file_path] = scan_file(file_path)
+            scanned += 1
+        return scanned
+
+    def entry(self, file_path: str) -> dict:
+        return self.entries[file_path]
+
+    # Files (among `file_paths`, or every cataloged file) whose entry matches `predicate`, e.g. lambda entry: entry["sfreq"] == 250
+    def select(self, predicate, file_paths: list = None) -> list:
+        file_paths = sorted(self.entries) if file_paths is None else file_paths
+        return [file_path for file_path in file_paths if predicate(self.entries[file_path])]
+
+    # Written to a temporary file first, so an interrupted save (or another node saving at the same time) never leaves a broken catalog
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary_path = f'{self.path}.{platform.node()}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({"version": CATALOG_VERSION, "entries": self.entries}, f)
+        os.replace(temporary_path, self.path)
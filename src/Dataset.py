@@ -0,0 +1,244 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from .Preprocessing import preprocess_file, L_FREQ, H_FREQ
+    from .GAF import gramian_angular_fields
+    from .ERSP import ersp_power, ersp_colormap, FREQS, BASELINE, MODE
+    from .Quantization import quantize as quantize_images, rgb_lut, parse_dtype, QUANTIZE_MODES, GAF_RANGE, ERSP_RANGE
+    from .ArraySink import ArraySink, load_shard
+    from .BuildCache import BuildCache
+    from .Logger import log, DEBUG
+except ImportError:
+    from Preprocessing import preprocess_file, L_FREQ, H_FREQ
+    from GAF import gramian_angular_fields
+    from ERSP import ersp_power, ersp_colormap, FREQS, BASELINE, MODE
+    from Quantization import quantize as quantize_images, rgb_lut, parse_dtype, QUANTIZE_MODES, GAF_RANGE, ERSP_RANGE
+    from ArraySink import ArraySink, load_shard
+    from BuildCache import BuildCache
+    from Logger import log, DEBUG
+
+# Python 3.8.2
+
+__all__ = ["ImageDataset", "file_images"]
+
+# Images of one recording computed in memory, without writing any file, `chunk_size` epochs at a time.
+# GAF: one image per epoch, shape (n_channels, image_size, image_size), the GASF of each channel followed by its GADF if `difference`.
+# ERSP: one baseline corrected time-frequency map per trial, shape (n_channels, n_freqs, n_times / decim).
+# desired_channels, t_start, duration, image_size, lazy, dtype, quantize: same as `GAF.generate_images`. For ERSP the window is [t_start, duration], like TS2Image.
+# Quantized images are uint8, RGB ones have an extra last dimension of 3.
+# Yields (images, labels, metadata) for each chunk: images.shape = (chunk, ...), labels are `events_dictionary[description]`
+# (the description itself if it has no entry or events_dictionary is None) and metadata has one dict per image
+# {"file", "description", "label", "annotation", "onset", "channels"}.
+def file_images(file_path: str, method: str, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, desired_channels: list,
+                image_size: int = None, difference: bool = False, chunk_size: int = 8, lazy: bool = False, dtype=None, quantize: str = None):
+    method = method.upper()
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f'Quantization {quantize} not supported. Accepted values: uint8, rgb')
+    dtype = parse_dtype(dtype)
+    tmax = t_start + duration if method == "GAF" else duration
+    recording = preprocess_file(file_path, desired_channels, valid_events_descriptions, tmin=t_start, tmax=tmax, lazy=lazy, dtype=dtype)
+    epochs = recording.window(t_start, tmax)
+    metadata = []
+    for description, annotation_index, onset in zip(recording.descriptions, recording.annotation_indexes, recording.onsets):
+        label = description if events_dictionary is None else events_dictionary.get(description, description)
+        metadata.append({"file": recording.file_name, "description": description, "label": label, "annotation": int(annotation_index),
+                         "onset": float(onset), "channels": recording.ch_names})
+
+    if method == "GAF":
+        n_timestamps = epochs.shape[-1]
+        image_size = n_timestamps if image_size is None else min(image_size, n_timestamps)
+        chunks = gramian_angular_fields(epochs, summation=True, difference=difference, chunk_size=chunk_size, image_size=image_size, dtype=dtype)
+        lut = rgb_lut('viridis') if quantize == "rgb" else None
+        for start, gasf, gadf in chunks:
+            images = gasf if gadf is None else np.concatenate([gasf, gadf], axis=1)
+            if quantize is not None:
+                images = quantize_images(images, GAF_RANGE, lut)
+            chunk_metadata = metadata[start:start + len(images)]
+            yield images, [item["label"] for item in chunk_metadata], chunk_metadata
+    elif method == "ERSP":
+        lut = rgb_lut(ersp_colormap()) if quantize == "rgb" else None
+        for start, power in ersp_power(epochs, recording.sfreq, t_start, chunk_size=chunk_size, dtype=dtype):
+            if quantize is not None:
+                power = quantize_images(power, ERSP_RANGE, lut)
+            chunk_metadata = metadata[start:start + len(power)]
+            yield power, [item["label"] for item in chunk_metadata], chunk_metadata
+    else:
+        raise ValueError(f'Method {method} not supported. Accepted values: GAF, ERSP')
+
+# Training input pipeline: yields batches of images computed on the fly from a list of recordings, no PNG round trip.
+#   for images, labels, metadata in ImageDataset(paths, "GAF", ["769", "770"], events_dictionary, t_start=0, duration=4, image_size=64):
+#       ...  # images.shape = (batch_size, n_channels, 64, 64), labels and metadata are lists, see `file_images`
+# - Background threads (`n_workers`) compute the images of the next files while the current batch is consumed. Each file keeps at most
+#   `prefetch` chunks in memory, so memory is bounded by n_workers * prefetch * chunk_size images. Threads rather than processes:
+#   numpy, scipy and the filters release the GIL, and the images don't have to be pickled back to the training process.
+# - Order is deterministic: files in the given order and epochs in the recording order, whatever the number of workers.
+#   shuffle: seeded shuffle of the file order and of the images, through a buffer of `shuffle_buffer` images. Call `set_epoch`
+#   before each pass over the data to get a different (but reproducible) order every epoch.
+# - cache_folder: keep the images of each file in an npy shard (see ArraySink) keyed on the file content and the parameters (see BuildCache),
+#   so the following passes, or another run with the same parameters, memory map them instead of computing them again.
+#   Every parameter set of a sweep gets its own shards. Incomplete passes are not cached.
+# - desired_channels: a list, or a function of the file name returning the list (e.g. the channels differ between datasets).
+class ImageDataset:
+    def __init__(self, file_paths: list, method: str, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, desired_channels=[],
+                 image_size: int = None, difference: bool = False, batch_size: int = 32, shuffle: bool = False, seed: int = 0, shuffle_buffer: int = 1024,
+                 drop_last: bool = False, n_workers: int = 2, prefetch: int = 4, chunk_size: int = 8, lazy: bool = False, cache_folder: str = None,
+                 dtype=None, quantize: str = None):
+        if method.upper() not in ["GAF", "ERSP"]:
+            raise ValueError(f'Method {method} not supported. Accepted values: GAF, ERSP')
+        self.file_paths = list(file_paths)
+        self.method = method.upper()
+        self.valid_events_descriptions = valid_events_descriptions
+        self.events_dictionary = events_dictionary
+        self.t_start = t_start
+        self.duration = duration
+        self.desired_channels = desired_channels
+        self.image_size = image_size
+        self.difference = difference
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.drop_last = drop_last
+        self.n_workers = max(1, n_workers)
+        self.prefetch = max(1, prefetch)
+        self.chunk_size = chunk_size
+        self.lazy = lazy
+        self.dtype = parse_dtype(dtype)
+        self.quantize = quantize
+        self.epoch = 0
+        self.cache = None if cache_folder is None else BuildCache(cache_folder, cache_file_name='.ts2image-dataset-cache.json')
+        # The cache is shared by the worker threads
+        self.__cache_lock = threading.Lock()
+
+    # Shuffle differently on each pass over the data, like the samplers of the training frameworks
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        file_paths = [self.file_paths[index] for index in rng.permutation(len(self.file_paths))] if self.shuffle else self.file_paths
+        # Images waiting to be batched: (image, label, metadata)
+        buffer = []
+        # Without shuffle, batches are emitted as soon as they are full
+        buffer_size = max(self.shuffle_buffer, self.batch_size) if self.shuffle else self.batch_size
+        for images, labels, metadata in self.__prefetched_chunks(file_paths):
+            buffer += zip(images, labels, metadata)
+            while len(buffer) >= buffer_size:
+                yield self.__batch(buffer, rng)
+        if self.shuffle:
+            rng.shuffle(buffer)
+        while len(buffer) >= self.batch_size or (len(buffer) > 0 and not self.drop_last):
+            yield self.__batch(buffer, rng)
+
+    # Take a batch out of `buffer`, at random positions when shuffling
+    def __batch(self, buffer: list, rng):
+        size = min(self.batch_size, len(buffer))
+        if self.shuffle:
+            picked = set(rng.choice(len(buffer), size=size, replace=False).tolist())
+            items = [buffer[index] for index in sorted(picked)]
+            buffer[:] = [item for index, item in enumerate(buffer) if index not in picked]
+        else:
+            items = buffer[:size]
+            del buffer[:size]
+        shapes = set(image.shape for image, _, _ in items)
+        if len(shapes) > 1:
+            raise ValueError(f'Images of different shapes {sorted(shapes)} can\'t be batched, e.g. the recordings have different sampling rates. Set image_size (GAF)')
+        return np.stack([image for image, _, _ in items]), [label for _, label, _ in items], [metadata for _, _, metadata in items]
+
+    # Chunks of every file, in order, computed ahead by the worker threads.
+    # Each file has its own bounded queue and the files are started in order, so the file being consumed is always running.
+    def __prefetched_chunks(self, file_paths: list):
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.prefetch) for _ in file_paths]
+        executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix='ImageDataset')
+        try:
+            for file_path, file_queue in zip(file_paths, queues):
+                executor.submit(self.__produce, file_path, file_queue, stop)
+            for file_queue in queues:
+                while True:
+                    kind, value = file_queue.get()
+                    if kind == "error":
+                        raise value
+                    if kind == "done":
+                        break
+                    yield value
+        finally:
+            # Also reached when the consumer stops early: the threads drop their work
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def __produce(self, file_path: str, file_queue: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    file_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        if stop.is_set():
+            return
+        try:
+            for chunk in self.__file_chunks(file_path):
+                if not put(("chunk", chunk)):
+                    return
+            put(("done", None))
+        except Exception as e:
+            put(("error", e))
+
+    def __file_chunks(self, file_path: str):
+        file_name = os.path.basename(file_path)
+        desired_channels = self.desired_channels(file_name) if callable(self.desired_channels) else self.desired_channels
+        compute = lambda: file_images(file_path, self.method, self.valid_events_descriptions, self.events_dictionary, self.t_start, self.duration,
+                                      desired_channels, image_size=self.image_size, difference=self.difference, chunk_size=self.chunk_size, lazy=self.lazy,
+                                      dtype=self.dtype, quantize=self.quantize)
+        if self.cache is None:
+            yield from compute()
+            return
+
+        parameters = self.__parameters(desired_channels)
+        with self.__cache_lock:
+            key = self.cache.key(file_path, parameters)
+            entry = self.cache.entries.get(key) if self.cache.is_valid(key) else None
+        if entry is not None:
+            log(f'Dataset: reading the cached images of {file_name}', level=DEBUG)
+            manifest_paths = [output for output in entry["outputs"] if output.endswith('.json')]
+            for manifest_path in manifest_paths:
+                images, manifest = load_shard(manifest_path)
+                for start in range(0, len(images), self.chunk_size):
+                    chunk_metadata = [{name: item[name] for name in ["file", "description", "label", "annotation", "onset", "channels"]}
+                                      for item in manifest["items"][start:start + self.chunk_size]]
+                    yield np.asarray(images[start:start + self.chunk_size]), [item["label"] for item in chunk_metadata], chunk_metadata
+            return
+
+        # One folder per parameter set, so the shards of a sweep don't overwrite each other
+        sink = ArraySink(file_path, parameters=parameters)
+        complete = False
+        try:
+            for images, labels, metadata in compute():
+                sink.save_batch(f'{self.cache.output_folder}/{self.method}/{key[:16]}', [f'{file_name}-Ann-{item["annotation"]}' for item in metadata], images, metadata)
+                yield images, labels, metadata
+            complete = True
+        finally:
+            sink.close()
+        if complete:
+            with self.__cache_lock:
+                self.cache.record(key, file_path, f'dataset-{key}', parameters, sink.written)
+                self.cache.save()
+
+    # Everything that changes the images of a file, used to key the cache
+    def __parameters(self, desired_channels: list) -> dict:
+        parameters = {"method": self.method, "channels": list(desired_channels), "t_start": self.t_start, "duration": self.duration,
+                      "filter": [L_FREQ, H_FREQ], "events": {description: None if self.events_dictionary is None else self.events_dictionary.get(description)
+                                                             for description in self.valid_events_descriptions},
+                      "dtype": None if self.dtype is None else self.dtype.name, "quantize": self.quantize}
+        if self.method == "GAF":
+            parameters.update({"image_size": self.image_size, "difference": self.difference})
+        else:
+            parameters.update({"freqs": FREQS.tolist(), "baseline": BASELINE, "mode": MODE})
+        return parameters
@@ -1,67 +1,145 @@
-import mne
-
-import os
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-from datetime import datetime
+# mne and matplotlib are imported where they are used, so importing this module doesn't load them
 # from mne.viz.utils import center_cmap
 # from mne.io import concatenate_raws, read_raw_edf
-from mne.time_frequency import tfr_multitaper
-from mne.stats import permutation_cluster_1samp_test as pcluster_test
-from mne.viz.utils import center_cmap
 
 # import Logger
 
+try:
+    from .ArraySink import ArraySink
+    from .ImageWriter import ImageWriter
+    from .Preprocessing import EpochedRecording, preprocess_file, L_FREQ, H_FREQ
+    from .Logger import log
+    from .Metrics import metrics
+    from .Quantization import quantize as quantize_images, rgb_lut, parse_dtype, working_dtype, QUANTIZE_MODES, ERSP_RANGE
+    from .Significance import significance_masks, SIGNIFICANCE_MODES, N_PERMUTATIONS, ALPHA
+    from .Spectral import multitaper_power, TIME_BANDWIDTH
+except ImportError:
+    from ArraySink import ArraySink
+    from ImageWriter import ImageWriter
+    from Preprocessing import EpochedRecording, preprocess_file, L_FREQ, H_FREQ
+    from Logger import log
+    from Metrics import metrics
+    from Quantization import quantize as quantize_images, rgb_lut, parse_dtype, working_dtype, QUANTIZE_MODES, ERSP_RANGE
+    from Significance import significance_masks, SIGNIFICANCE_MODES, N_PERMUTATIONS, ALPHA
+    from Spectral import multitaper_power, TIME_BANDWIDTH
+
 # Python 3.8.2
 
-__all__ = ["ERSP"]
+__all__ = ["ERSP", "ersp_power", "ersp_colormap"]
+
+# Compute ERDS maps ###########################################################
+# Frequencies from 2-35Hz
+FREQS = np.arange(1, 40, 1)
+
+# TODO: What this n_cycles actually mean???
+# The number of cycles globally or for each frequency. The time-window length is thus T = n_cycles / freq.
+N_CYCLES = FREQS # use constant t/f resolution
+
+DECIM = 2
+
+# https://mne.tools/stable/generated/mne.time_frequency.EpochsTFR.html#mne.time_frequency.EpochsTFR.apply_baseline
+# The time interval to apply rescaling / baseline correction. 
+# If None do not apply it. 
+# If baseline is (a, b) the interval is between “a (s)” and “b (s)”. 
+# If a is None the beginning of the data is used and if b is None then b is set to the end of the interval. 
+# If baseline is equal to (None, None) all the time interval is used.
+BASELINE = [-1, 0]  # baseline interval (in s)
+
+# Perform baseline correction by: 
+# subtracting the mean of baseline values followed by dividing by the mean of baseline values (‘percent’)
+MODE = "percent"
+
+# Baseline corrected time-frequency power of epochs, computed `chunk_size` epochs at a time.
+# data: ndarray, shape (n_epochs, n_channels, n_times), the first sample is `t_start` seconds after the event.
+# Yields (start, power) for each chunk, power.shape = (chunk_size, n_channels, n_freqs, n_times / decim).
+# Same as tfr_multitaper(epochs, average=False) followed by apply_baseline on these epochs, but only one chunk lives in memory at a time.
+# The DPSS tapers and the FFTs of the wavelets are computed once per set of parameters and reused by every chunk and file, see Spectral.KernelCache.
+# dtype: of the power returned, None keeps float64. The transform is computed in double precision whatever the dtype of data.
+# kernel_cache_folder: where the kernel banks are saved, to share them with other processes and later runs. None keeps them in memory only.
+def ersp_power(data: np.ndarray, sfreq: float, t_start, chunk_size: int = 16, freqs: np.ndarray = FREQS, n_cycles=N_CYCLES,
+               decim: int = DECIM, baseline: list = BASELINE, mode: str = MODE, dtype=None, kernel_cache_folder: str = None):
+    from mne.baseline import rescale
+    times = (int(round(t_start * sfreq)) + np.arange(data.shape[-1])) / sfreq
+    tfr_times = times[::decim]
+    for start in range(0, len(data), chunk_size):
+        with metrics.timer("transform"):
+            # Time-Frequency Representation (TFR), power.shape = (chunk_size, n_channels, n_freqs, n_times)
+            power = multitaper_power(data[start:start + chunk_size], sfreq, freqs, n_cycles, decim=decim, time_bandwidth=TIME_BANDWIDTH,
+                                     cache_folder=kernel_cache_folder)
+            # Baseline is applied to each trial before averaging, same as EpochsTFR.apply_baseline
+            rescale(power, tfr_times, baseline, mode=mode, copy=False, verbose=False)
+            if dtype is not None:
+                power = power.astype(dtype, copy=False)
+        yield start, power
+
+# Color map of the ERSP images
+def ersp_colormap():
+    import matplotlib.pyplot as plt
+    from mne.viz.utils import center_cmap
+    # TODO: Test other color maps
+    return center_cmap(plt.cm.RdBu, -1, 1)  # zero maps to white
 
 class ERSP:
     def __init__(self, file_path: str, debug: bool = True):
         self.file_path = file_path
         self.debug = debug
+
+        # Where images are written (ImageWriter or ArraySink), see `generate_images`
+        self._sink = None
+        # Quantization of the saved images and its RGB lookup table, see `generate_images`
+        self._quantize = None
+        self._lut = None
+        # What to do with the significance masks, see `generate_images`
+        self._significance = None
     
-    def _save_image(self, image_folder, image_file_name, image):
-        all_cmaps = {
-            'Perceptually Uniform Sequential' : ['viridis', 'plasma', 'inferno', 'magma', 'cividis'],
-            'Sequential' : ['Greys', 'Purples', 'Blues', 'Greens', 'Oranges', 'Reds', 'YlOrBr', 'YlOrRd', 
-                            'OrRd', 'PuRd', 'RdPu', 'BuPu', 'GnBu', 'PuBu', 'YlGnBu', 'PuBuGn', 'BuGn', 'YlGn']
-        }
-
-        # TODO: Test other color maps
-        default = 'viridis'
-        cmaps_selected = [default]
-
-        # Tests
-        custom_cmap = center_cmap(plt.cm.RdBu, -1, 1)  # zero maps to white
-        final_image_folder = f'{image_folder}'
-        if not os.path.exists(final_image_folder):
-            os.makedirs(final_image_folder)
-
-        image_path = f'{final_image_folder}/{image_file_name}.png'
-        plt.imsave(image_path, image, cmap=custom_cmap)
-        return
-
-        # cmaps_selected = [cmap]
-
-        # set min and max ERDS values in plot
-        # vmin, vmax = -1, 1  
-        
-        # zero maps to white
-        # cmap = center_cmap(plt.cm.RdBu, vmin, vmax)
-        # cmaps_selected = [cmap]
-        
-        for cmap_type, cmaps in all_cmaps.items():
-            for cmap in cmaps:
-                if cmap in cmaps_selected:
-                    final_image_folder = f'{image_folder}/{cmap_type}/{cmap}'
-                    if not os.path.exists(final_image_folder):
-                        os.makedirs(final_image_folder)
-        
-                    image_path = f'{final_image_folder}/{image_file_name}.png'
-                    # TODO: Add mask here https://mne.tools/stable/generated/mne.time_frequency.AverageTFR.html#mne.time_frequency.AverageTFR.plot
-                    plt.imsave(image_path, image, cmap=custom_cmap)
+    def _save_image(self, image_folder, image_file_name, image, metadata: dict = None):
+        self._sink.save(image_folder, image_file_name, image, metadata)
+
+    # Where the images are written: dense array shards for "npy", PNG files otherwise.
+    def _make_sink(self, source_file: str, output_format: str, parameters: dict):
+        if output_format == "npy":
+            return ArraySink(source_file, parameters=parameters)
+
+        return ImageWriter(cmap=ersp_colormap())
+
+    # Save the images of one ERSP map, either a class average or a single trial.
+    # power: ndarray, shape (n_channels, n_freqs, n_times). name_suffix is appended to the file name, e.g. the trial index.
+    # mask: boolean ndarray with the shape of power, True in the significant clusters (see `generate_images`), None when not tested.
+    # Masks are saved in a "mask" folder next to the images, with the same file names, as uint8 0/255.
+    def __save_event_images(self, output_folder: str, raw_file_name: str, event_description: str, name_suffix: str, power: np.ndarray,
+                            channel_names: list, n_epochs: int, generate_intermediate_images: bool, merge_channels: bool, mask: np.ndarray = None):
+        cue_human_readable = event_description
+        images_folder = f'{output_folder}/ERSP/{cue_human_readable}'
+        masks_folder = f'{images_folder}/mask'
+        metadata = {"label": cue_human_readable, "description": event_description, "n_epochs": n_epochs}
+        if mask is not None and self._significance == "apply":
+            power = np.where(mask, power, 0).astype(power.dtype, copy=False)
+        if self._quantize is not None:
+            with metrics.timer("encode"):
+                power = quantize_images(power, ERSP_RANGE, self._lut)
+        if mask is not None and self._significance == "mask":
+            mask = mask.astype(np.uint8) * 255
+        else:
+            mask = None
+
+        if merge_channels:
+            # RGB images keep their last dimension
+            channel_data = power.reshape((-1,) + power.shape[2:])
+            image_file_name = f'{raw_file_name}{name_suffix}-Ch-{channel_names}'
+            self._save_image(image_folder=images_folder, image_file_name=image_file_name, image=channel_data, metadata=dict(metadata, channel=channel_names))
+            if mask is not None:
+                self._save_image(image_folder=masks_folder, image_file_name=image_file_name, image=mask.reshape((-1,) + mask.shape[2:]),
+                                 metadata=dict(metadata, channel=channel_names, mask=True))
+
+        if generate_intermediate_images:
+            for channel_index, channel_name in enumerate(channel_names):
+                channel_data = power[channel_index] # shape (n_freqs, n_times)
+                image_file_name = f'{raw_file_name}{name_suffix}-Ch-{channel_name}'
+                self._save_image(image_folder=images_folder, image_file_name=image_file_name, image=channel_data, metadata=dict(metadata, channel=channel_name))
+                if mask is not None:
+                    self._save_image(image_folder=masks_folder, image_file_name=image_file_name, image=mask[channel_index],
+                                     metadata=dict(metadata, channel=channel_name, mask=True))
 
     # Generate sequential ids for events_descriptions_list
     # { x: 1, y: 2, z: 3, ... }
@@ -80,105 +158,133 @@ class ERSP:
     # Start and end time of the epochs in seconds, relative to the time-locked event. Defaults to -0.2 and 0.5, respectively.
     # t_start and t_end refer to the epoch time window around the event. 
     # Ex.: t_start = -0.5, t_end = 1.5, t_event = 10, would create an epoch starting at 10-0.5 and end at 11.5
-    def generate_images(self, output_folder: str, desired_channels: list, desired_events: list, t_start, t_end, generate_intermediate_images: bool = False, merge_channels=False):
-        raw = mne.io.read_raw_gdf(self.file_path, preload=True)
-        raw.filter(l_freq=1, h_freq=40)
+    # output_format: "png" saves one image file per image, "npy" saves dense array shards plus a manifest (see ArraySink).
+    # lazy: don't load the whole recording, read and filter only the desired channels in a padded window around each epoch.
+    # Use it for recordings that don't fit in memory, results match the default mode up to floating point error.
+    # chunk_size: number of epochs transformed at once. Peak memory is bounded by the chunk size instead of the number of epochs.
+    # per_trial: save one image per trial (streamed as each chunk is computed) instead of one average image per event.
+    # dtype: precision of the epochs, of the power and of the float outputs: float64 (None, default), float32 or float16.
+    # With float16 the epochs stay float32, see Quantization.working_dtype.
+    # quantize: None keeps the float maps, "uint8" maps the percent changes in ERSP_RANGE to gray levels 0..255 and "rgb" to the colors
+    # of the ERSP color map, with a lookup table. Values outside ERSP_RANGE are clipped.
+    # significance: test, for each event and channel, where the trials' power differs from the baseline with a cluster permutation test
+    # (see Significance.cluster_permutation_mask). "mask" saves the masks of the significant clusters in a "mask" folder next to the images,
+    # "apply" sets the rest of the images to 0. Only for the event averages, not with per_trial. The trials' power of the tested events
+    # is kept in memory until the end of the file.
+    # n_permutations, significance_seed: of each test. The masks only depend on the seed, not on significance_workers.
+    # significance_workers: processes running the tests of the (event, channel) pairs in parallel, None for one per core.
+    # kernel_cache_folder: where the multitaper kernel banks are saved, to reuse them in other processes and runs, see `ersp_power`.
+    # Returns the paths of the files written.
+    def generate_images(self, output_folder: str, desired_channels: list, desired_events: list, t_start, t_end, generate_intermediate_images: bool = False, merge_channels=False, output_format: str = "png", lazy: bool = False, chunk_size: int = 16, per_trial: bool = False,
+                        dtype=None, quantize: str = None, significance: str = None, n_permutations: int = N_PERMUTATIONS, significance_seed: int = 0,
+                        significance_workers: int = None, kernel_cache_folder: str = None):
+        recording = preprocess_file(self.file_path, desired_channels, desired_events, tmin=t_start, tmax=t_end, lazy=lazy, dtype=parse_dtype(dtype))
+        return self.generate_images_from_epochs(recording, output_folder=output_folder, desired_events=desired_events, t_start=t_start, t_end=t_end,
+                                                generate_intermediate_images=generate_intermediate_images, merge_channels=merge_channels,
+                                                output_format=output_format, chunk_size=chunk_size, per_trial=per_trial, dtype=dtype, quantize=quantize,
+                                                significance=significance, n_permutations=n_permutations, significance_seed=significance_seed,
+                                                significance_workers=significance_workers, kernel_cache_folder=kernel_cache_folder)
+
+    # Same as `generate_images` but reusing epochs already loaded, picked and filtered by `preprocess_file`,
+    # e.g. to run several methods on the same file. Epochs of events not in `desired_events`, or whose window runs past the end
+    # of the recording (see EpochedRecording.in_window), are ignored.
+    def generate_images_from_epochs(self, recording: EpochedRecording, output_folder: str, desired_events: list, t_start, t_end, generate_intermediate_images: bool = False, merge_channels=False, output_format: str = "png", chunk_size: int = 16, per_trial: bool = False,
+                                    dtype=None, quantize: str = None, significance: str = None, n_permutations: int = N_PERMUTATIONS,
+                                    significance_seed: int = 0, significance_workers: int = None, kernel_cache_folder: str = None):
+        if output_format not in ["png", "npy"]:
+            raise ValueError(f'Output format {output_format} not supported. Accepted values: png, npy')
+        if quantize not in QUANTIZE_MODES:
+            raise ValueError(f'Quantization {quantize} not supported. Accepted values: uint8, rgb')
+        if significance not in SIGNIFICANCE_MODES:
+            raise ValueError(f'Significance {significance} not supported. Accepted values: mask, apply')
+        if significance is not None and per_trial:
+            raise ValueError('Significance masks are computed for the event averages, they can\'t be used with per_trial')
+        dtype = parse_dtype(dtype)
+        log(f'ERSP: using the {len(recording)} preprocessed epochs of {recording.file_name}')
 
-        # https://mne.tools/stable/generated/mne.events_from_annotations.html?highlight=events_from_annotations#mne.events_from_annotations
         # Map descriptions (keys) to integer event codes (values). Only the descriptions present will be mapped, others will be ignored.
         event_id = self._generate_events_dictionary(events_descriptions_list=desired_events)
 
-        # https://mne.tools/stable/generated/mne.events_from_annotations.html?highlight=events_from_annotations#mne.events_from_annotations
-        # Get events and event_id from an Annotations object.
-        # This function will assign an integer Event ID to each unique element of raw.annotations.description, 
-        # and will return the mapping of descriptions to integer Event IDs along with the derived Event list.
-        events, generated_event_ids = mne.events_from_annotations(raw, event_id=event_id)
-        # events.shape = (271, 3) = (n_events, 3) = the events array is [start_sample, 0?, new int from event_id converted by the lib]
-        
-        channels = desired_channels
-        picks = mne.pick_channels(raw.info["ch_names"], channels)
-        
         ##################### EPOCH DATA #####################
-        # WARNING: This prevents exceptions to be thrown if we have overlapping events and it can also drop data!!!
-        # Check epocs.drop_log or something
-        # Error thrown: 'Event time samples were not unique. Consider setting the `event_repeated` parameter."'
-        event_repeated = None
-
         # https://mne.discourse.group/t/what-is-tmin-and-tmax-in-epochs/2920/1
         # “Epochs” are equal-duration chunks of the continuous raw signal. 
         # Epochs are created relative to a series of “events” (an event is a sample number plus an event ID integer encoding what kind of event it was)
-        # TODO: Test if we can replace event_id by desired_events. It seems it already supports a list of ids, so no need to convert list to dict...
-        epochs = mne.Epochs(raw, events, event_id, t_start, t_end,
-                            picks=picks, baseline=None, preload=True, event_repeated=event_repeated)
+        is_desired = np.array([description in event_id for description in recording.descriptions], dtype=bool)
+        # The epochs may have been cut for a longer window (see preprocess_file(min_tmax=...)), keep the ones where ours fits
+        is_desired &= recording.in_window(t_start, t_end)
+        data = recording.window(t_start, t_end)[is_desired]
+        if dtype is not None:
+            data = data.astype(working_dtype(dtype), copy=False)
+        # Precision of the power and of the images
+        dtype = data.dtype if dtype is None else dtype
+        epochs_event_ids = np.array([event_id[description] for description, keep in zip(recording.descriptions, is_desired) if keep], dtype=int)
+        # Index of each epoch among the file events, used to name the single trial images
+        epochs_indexes = recording.annotation_indexes[is_desired]
 
-        # Compute ERDS maps ###########################################################
-        # Frequencies from 2-35Hz
-        freqs = np.arange(1, 40, 1)  
-        
-        # TODO: What this n_cycles actually mean???
-        # The number of cycles globally or for each frequency. The time-window length is thus T = n_cycles / freq.
-        n_cycles = freqs # use constant t/f resolution
+        raw_file_name = recording.file_name
+        channel_names = recording.ch_names
 
-        # Return inter-trial coherence (ITC) as well as averaged (or single-trial) power.
-        return_inter_trial_coherence = False
+        parameters = {"method": "ERSP", "t_start": t_start, "t_end": t_end, "channels": channel_names, "l_freq": L_FREQ, "h_freq": H_FREQ,
+                      "freqs": FREQS.tolist(), "baseline": BASELINE, "mode": MODE, "per_trial": per_trial,
+                      "dtype": dtype.name, "quantize": quantize, "value_range": None if quantize is None else list(ERSP_RANGE),
+                      "significance": significance}
+        if significance is not None:
+            parameters.update(n_permutations=n_permutations, alpha=ALPHA, significance_seed=significance_seed)
+        self._sink = self._make_sink(recording.file_path, output_format, parameters)
+        self._quantize = quantize
+        self._lut = rgb_lut(ersp_colormap()) if quantize == "rgb" else None
+        self._significance = significance
 
-        # Time-Frequency Representation (TFR)
-        tfr = tfr_multitaper(epochs, freqs=freqs, n_cycles=n_cycles,
-                             use_fft=True, return_itc=return_inter_trial_coherence, average=False, decim=2)
-        
-        # TODO: Should we crop this? :think:
-        # https://mne.tools/stable/generated/mne.time_frequency.EpochsTFR.html#mne.time_frequency.EpochsTFR.crop
-        tfr.crop(t_start, t_end)
-        
-        # https://mne.tools/stable/generated/mne.time_frequency.EpochsTFR.html#mne.time_frequency.EpochsTFR.apply_baseline
-        # The time interval to apply rescaling / baseline correction. 
-        # If None do not apply it. 
-        # If baseline is (a, b) the interval is between “a (s)” and “b (s)”. 
-        # If a is None the beginning of the data is used and if b is None then b is set to the end of the interval. 
-        # If baseline is equal to (None, None) all the time interval is used.
-        baseline = [-1, 0]  # baseline interval (in s)
-        
-        # Perform baseline correction by: 
-        # subtracting the mean of baseline values followed by dividing by the mean of baseline values (‘percent’)
-        mode = "percent"
-        tfr.apply_baseline(baseline, mode=mode) # tfr.event_id = {'10': 10, '11': 11, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8, '9': 9}
-
-        raw_file_name = self.file_path.split('/')[-1]
-        # TODO: So at the end of the day we're justing averaging all runs for an specific event type? See tfr_ev.average()
-        # This will produce less images, maybe not enough to train the CNN?
-
-        for key_event_description, value_event_id_int in event_id.items():
-            # select desired epochs for visualization
-            tfr_ev = tfr[key_event_description]
-            cue_human_readable = key_event_description
-            images_folder = f'{output_folder}/ERSP/{cue_human_readable}'
-
-            # if merge_channels:
-            #     images_folder += '/merged_channels'
-            
-            # if generate_intermediate_images: 
-            #     images_folder += '/individual_channels'
-
-            if not os.path.exists(images_folder):
-                os.makedirs(images_folder)
-            
-            # https://mne.tools/stable/generated/mne.time_frequency.EpochsTFR.html#mne.time_frequency.EpochsTFR.average
-            # Average the data across epochs.
-            # Reduce A annotations into 1 - it'll also reduce the array dimensionality.
-            # tfr_ev.data.shape (60, 3, 34, 282)
-            avg = tfr_ev.average() # avg.data.shape = (3, 34, 282) - ndarray, shape (n_channels, n_freqs, n_times)
-
-            if merge_channels:
-                n_timestamps_index = 2
-                n_timestamps = avg.data.shape[n_timestamps_index]
-                channel_data = avg.data.reshape(-1, n_timestamps)
-                image_file_name = f'{raw_file_name}-Ch-{tfr.ch_names}'
-                self._save_image(image_folder=images_folder, image_file_name=image_file_name, image=channel_data)
-
-            if generate_intermediate_images:
-                for channel_index, channel_name in enumerate(tfr_ev.ch_names):
-                    channel_data = avg.data[channel_index] # avg.data.shape = (34, 282) - ndarray, shape (n_freqs, n_times)
-                    image_file_name = f'{raw_file_name}-Ch-{channel_name}'
-                    self._save_image(image_folder=images_folder, image_file_name=image_file_name, image=channel_data)
-        
-            # fig.savefig(f'Event-{key_event_id}.png')
\ No newline at end of file
+        # Running sum of the baseline corrected power of each event, shape (n_channels, n_freqs, n_times).
+        # Always float64, a float16 sum over many trials would lose most of its precision, the average is cast to `dtype` when it's saved.
+        power_sums = {}
+        epochs_counts = {}
+        # Power of each trial of each event, for the significance tests: {event: [ndarray shape (n_trials, n_channels, n_freqs, n_times)]}
+        trials_power = {}
+        try:
+            for start, power in ersp_power(data, recording.sfreq, t_start, chunk_size=chunk_size, dtype=dtype,
+                                           kernel_cache_folder=kernel_cache_folder):
+                chunk_event_ids = epochs_event_ids[start:start + chunk_size]
+                for key_event_description, value_event_id_int in event_id.items():
+                    is_event = chunk_event_ids == value_event_id_int
+                    if not is_event.any():
+                        continue
+                    if per_trial:
+                        for epoch_index, trial_power in zip(epochs_indexes[start:start + chunk_size][is_event], power[is_event]):
+                            self.__save_event_images(output_folder, raw_file_name, key_event_description, f'-Trial-{epoch_index}', trial_power,
+                                                     channel_names, 1, generate_intermediate_images, merge_channels)
+                    else:
+                        power_sums[key_event_description] = power_sums.get(key_event_description, 0) + power[is_event].sum(axis=0, dtype=np.float64)
+                        epochs_counts[key_event_description] = epochs_counts.get(key_event_description, 0) + int(is_event.sum())
+                        if significance is not None:
+                            trials_power.setdefault(key_event_description, []).append(power[is_event])
+
+            masks = {}
+            if significance is not None:
+                # One test per (event, channel), trials as samples
+                tests = {}
+                for key_event_description, event_power in trials_power.items():
+                    event_power = np.concatenate(event_power)
+                    for channel_index in range(len(channel_names)):
+                        tests[(key_event_description, channel_index)] = event_power[:, channel_index]
+                trials_power = None
+                channel_masks = significance_masks(tests, n_permutations=n_permutations, seed=significance_seed, n_workers=significance_workers)
+                for key_event_description in power_sums:
+                    masks[key_event_description] = np.stack([channel_masks[(key_event_description, channel_index)]
+                                                             for channel_index in range(len(channel_names))])
+
+            # TODO: So at the end of the day we're justing averaging all runs for an specific event type? See tfr_ev.average()
+            # This will produce less images, maybe not enough to train the CNN? Use `per_trial` to get one image per trial instead.
+            for key_event_description, power_sum in power_sums.items():
+                # Average the data across epochs.
+                # Reduce A annotations into 1 - it'll also reduce the array dimensionality.
+                avg = (power_sum / epochs_counts[key_event_description]).astype(dtype, copy=False) # avg.shape = (3, 34, 282) - ndarray, shape (n_channels, n_freqs, n_times)
+                self.__save_event_images(output_folder, raw_file_name, key_event_description, '', avg,
+                                         channel_names, epochs_counts[key_event_description], generate_intermediate_images, merge_channels,
+                                         mask=masks.get(key_event_description))
+
+        finally:
+            # Wait for the pending writes
+            sink, self._sink = self._sink, None
+            sink.close()
+        return sink.written
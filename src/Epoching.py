@@ -0,0 +1,80 @@
+import numpy as np
+
+# Python 3.8.2
+
+__all__ = ["window_start_samples", "window_n_times", "extract_epochs", "crop_views", "read_filtered_epochs"]
+
+# Sample index (relative to the first sample of `raw`) where each window starts, i.e. onset + t_start.
+# onsets: annotation onsets in seconds, as stored in `raw.annotations.onset`.
+# Same rounding as `raw.crop`, so windows start at the same sample the old crop based code used.
+def window_start_samples(raw, onsets, t_start):
+    times = np.asarray(onsets, dtype=float) + t_start
+    return np.atleast_1d(raw.time_as_index(times, use_rounding=True, origin=raw.annotations.orig_time)).astype(np.int64)
+
+# Number of samples in a window of `duration` seconds, including both ends like `raw.crop(tmin, tmin + duration)`.
+def window_n_times(sfreq: float, duration) -> int:
+    return int(round(duration * sfreq)) + 1
+
+# Cut all the epochs out of a continuous recording at once.
+# data: ndarray, shape (n_channels, n_samples), e.g. `raw.get_data()` after filtering.
+# start_samples: window start for each epoch, see `window_start_samples`.
+# min_n_times: keep the windows whose first `min_n_times` samples fit inside the recording, the samples after its end are zeros.
+# Used to cut the epochs of windows with different lengths at once (see EpochedRecording.in_window). None: the whole window must fit.
+# Returns (epochs, in_bounds): epochs.shape = (n_valid_epochs, n_channels, n_times) and `in_bounds` is a boolean mask
+# over `start_samples` telling which windows fit inside the recording (the others are dropped).
+# The windows are taken from a strided view of `data`, so only the selected samples are copied: no per-epoch Raw copy.
+def extract_epochs(data: np.ndarray, start_samples: np.ndarray, n_times: int, min_n_times: int = None):
+    start_samples = np.asarray(start_samples, dtype=np.int64)
+    n_samples = data.shape[-1]
+    in_bounds = (start_samples >= 0) & (start_samples + (n_times if min_n_times is None else min_n_times) <= n_samples)
+    is_whole = (start_samples + n_times <= n_samples)[in_bounds]
+    if not in_bounds.any():
+        return np.empty((0, data.shape[0], n_times), dtype=data.dtype), in_bounds
+    if is_whole.all():
+        # windows.shape = (n_channels, n_samples - n_times + 1, n_times), a view on `data`
+        windows = np.lib.stride_tricks.sliding_window_view(data, n_times, axis=-1)
+        epochs = windows[:, start_samples[in_bounds]].transpose(1, 0, 2)
+        return epochs, in_bounds
+
+    # Some windows run past the end of the recording
+    epochs = np.zeros((len(is_whole), data.shape[0], n_times), dtype=data.dtype)
+    for epoch_index, start in enumerate(start_samples[in_bounds]):
+        stop = min(start + n_times, n_samples)
+        epochs[epoch_index, :, :stop - start] = data[:, start:stop]
+    return epochs, in_bounds
+
+# Overlapping crops of each epoch, as a strided view (no copy): crop k starts `stride` samples after crop k - 1.
+# epochs: ndarray, shape (n_epochs, n_channels, n_samples), with n_samples >= (n_crops - 1) * stride + n_times.
+# Returns ndarray, shape (n_epochs, n_crops, n_channels, n_times), read-only.
+def crop_views(epochs: np.ndarray, n_times: int, n_crops: int, stride: int) -> np.ndarray:
+    if epochs.shape[-1] < (n_crops - 1) * stride + n_times:
+        raise ValueError(f'{n_crops} crops of {n_times} samples every {stride} samples don\'t fit in epochs of {epochs.shape[-1]} samples')
+    # windows.shape = (n_epochs, n_channels, n_samples - n_times + 1, n_times)
+    windows = np.lib.stride_tricks.sliding_window_view(epochs, n_times, axis=-1)
+    return windows[:, :, :(n_crops - 1) * stride + 1:max(stride, 1)].transpose(0, 2, 1, 3)
+
+# Lazy counterpart of filtering the whole recording and then calling `extract_epochs`.
+# raw: a Raw object opened with preload=False (already picked). Only the windows around the epochs are read from disk,
+# each one padded with a filter length of samples on both sides, band-pass filtered and then trimmed back to `n_times`.
+# The padding covers the whole impulse response of the (zero-phase FIR) filter, so each epoch matches filtering the
+# full recording up to floating point error while peak memory scales with the number of epochs instead of the file length.
+# dtype: of the epochs returned, filtering is always done in float64.
+# min_n_times: see `extract_epochs`.
+# Returns (epochs, in_bounds), see `extract_epochs`.
+def read_filtered_epochs(raw, start_samples: np.ndarray, n_times: int, l_freq, h_freq, dtype=np.float64, min_n_times: int = None):
+    import mne
+    sfreq = raw.info['sfreq']
+    start_samples = np.asarray(start_samples, dtype=np.int64)
+    in_bounds = (start_samples >= 0) & (start_samples + (n_times if min_n_times is None else min_n_times) <= raw.n_times)
+    padding = len(mne.filter.create_filter(None, sfreq, l_freq=l_freq, h_freq=h_freq, verbose=False))
+
+    # Zeros after the end of the recording, like `extract_epochs`
+    epochs = np.zeros((int(in_bounds.sum()), len(raw.ch_names), n_times), dtype=dtype)
+    for epoch_index, start in enumerate(start_samples[in_bounds]):
+        first = max(start - padding, 0)
+        stop = min(start + n_times, raw.n_times)
+        last = min(stop + padding, raw.n_times)
+        window = raw.get_data(start=first, stop=last)
+        window = mne.filter.filter_data(window, sfreq, l_freq=l_freq, h_freq=h_freq, verbose=False)
+        epochs[epoch_index, :, :stop - start] = window[:, start - first:stop - first]
+    return epochs, in_bounds
@@ -1,26 +1,93 @@
-import mne
-from pyts.image import GramianAngularField
-import os
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-from datetime import datetime
-# import Logger
-import cv2
+
+try:
+    from .Preprocessing import EpochedRecording, preprocess_file, L_FREQ, H_FREQ
+    from .Epoching import crop_views
+    from .ArraySink import ArraySink
+    from .ImageWriter import ImageWriter
+    from .Logger import log, is_enabled, DEBUG
+    from .Metrics import metrics
+    from .Triangular import triangular_indexes
+    from .Quantization import quantize as quantize_images, rgb_lut, parse_dtype, working_dtype, QUANTIZE_MODES, GAF_RANGE
+except ImportError:
+    from Preprocessing import EpochedRecording, preprocess_file, L_FREQ, H_FREQ
+    from Epoching import crop_views
+    from ArraySink import ArraySink
+    from ImageWriter import ImageWriter
+    from Logger import log, is_enabled, DEBUG
+    from Metrics import metrics
+    from Triangular import triangular_indexes
+    from Quantization import quantize as quantize_images, rgb_lut, parse_dtype, working_dtype, QUANTIZE_MODES, GAF_RANGE
 
 # Python 3.8.2
 
-__all__ = ["GAF"]
+__all__ = ["GAF", "gramian_angular_fields", "paa"]
+
+# Polar encoding used by the Gramian Angular Fields.
+# X: ndarray, shape (..., n_timestamps). Each time series is min-max rescaled to `sample_range` (like pyts does)
+# and the angles are returned as (cos(phi), sin(phi)), so we never need to call arccos/cos/sin.
+def polar_encoding(X: np.ndarray, sample_range: tuple = (-1, 1)):
+    x_min = X.min(axis=-1, keepdims=True)
+    x_max = X.max(axis=-1, keepdims=True)
+    scale = x_max - x_min
+    # Constant time series are mapped to the lower bound of the range, same as sklearn's MinMaxScaler. Ranges within the rounding
+    # error of the values count as constant: the PAA means of a constant series can differ by a few ulps (e.g. float32 volts)
+    scale[scale <= 10 * np.finfo(scale.dtype).eps * np.maximum(np.abs(x_min), np.abs(x_max))] = 1
+    low, high = sample_range
+    X_cos = (X - x_min) / scale * (high - low) + low
+    X_sin = np.sqrt(np.clip(1 - X_cos ** 2, 0, 1))
+    return X_cos, X_sin
 
-def log(msg:str, log_file: str = None):
-    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    txt = f'{now}: {msg}'
-    if log_file is None:
-        print(txt)
-    else:
-        f = open(log_file, 'w')
-        f.write(txt)
-        f.close
+# Piecewise Aggregate Approximation: reduce each time series to `output_size` points, the mean of consecutive segments.
+# X: ndarray, shape (..., n_timestamps). Returns ndarray, shape (..., output_size), X itself if output_size >= n_timestamps.
+# When n_timestamps is not a multiple of output_size the segments are the same as pyts' PAA(output_size=output_size):
+# bounds at floor(k * n_timestamps / output_size), so their lengths differ by at most one sample.
+def paa(X: np.ndarray, output_size: int):
+    n_timestamps = X.shape[-1]
+    if output_size is None or output_size >= n_timestamps:
+        return X
+    bounds = np.linspace(0, n_timestamps, output_size + 1).astype(np.int64)
+    # Lengths in the dtype of X, so float32/float16 time series are not promoted to float64
+    return np.add.reduceat(X, bounds[:-1], axis=-1) / np.diff(bounds).astype(X.dtype)
+
+# Batched Gramian Angular Fields engine.
+# X: ndarray, shape (n_epochs, n_channels, n_timestamps), or with more leading dimensions, e.g. (n_epochs, n_crops, n_channels, n_timestamps):
+# chunks are taken along the first one.
+# image_size: size of the images, the time series are reduced to `image_size` points with `paa` before building the fields,
+# so the cost is O(image_size^2) instead of O(n_timestamps^2). None (or a size >= n_timestamps) keeps one pixel per sample.
+# Yields (start, gasf, gadf) for each chunk of `chunk_size` epochs, where gasf/gadf have shape (chunk, ..., n_channels, image_size, image_size)
+# or are None if not requested. The polar encoding is computed once per chunk and shared by both fields:
+#   GASF[i, j] = cos(phi_i + phi_j) = cos_i * cos_j - sin_i * sin_j
+#   GADF[i, j] = sin(phi_i - phi_j) = sin_i * cos_j - cos_i * sin_j
+# This matches pyts' GramianAngularField(image_size=image_size) up to floating point error.
+# Chunking caps the peak memory to chunk_size * n_channels * image_size^2 values per field.
+# dtype: of the fields, None keeps the dtype of X. The fields are computed in the dtype of X, or in float32 for float16
+# (see Quantization.working_dtype), and only the finished fields are cast.
+# packed: only compute the upper triangle and the diagonal of each field (GASF is symmetric and GADF antisymmetric), fields then have
+# shape (chunk, n_channels, image_size * (image_size + 1) / 2), see Triangular.unpack_triangular to get the dense matrices back.
+def gramian_angular_fields(X: np.ndarray, summation: bool = True, difference: bool = False, chunk_size: int = 8, image_size: int = None, packed: bool = False,
+                           dtype=None):
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    for start in range(0, X.shape[0], chunk_size):
+        with metrics.timer("transform"):
+            X_cos, X_sin = polar_encoding(paa(X[start:start + chunk_size].astype(working_dtype(X.dtype), copy=False), image_size))
+            if packed:
+                rows, columns = triangular_indexes(X_cos.shape[-1])
+                cos_i, cos_j = X_cos[..., rows], X_cos[..., columns]
+                sin_i, sin_j = X_sin[..., rows], X_sin[..., columns]
+            else:
+                cos_i, cos_j = X_cos[..., :, None], X_cos[..., None, :]
+                sin_i, sin_j = X_sin[..., :, None], X_sin[..., None, :]
+            gasf = gadf = None
+            if summation:
+                gasf = cos_i * cos_j
+                gasf -= sin_i * sin_j
+            if difference:
+                gadf = sin_i * cos_j
+                gadf -= cos_i * sin_j
+            gasf = None if gasf is None else gasf.astype(dtype, copy=False)
+            gadf = None if gadf is None else gadf.astype(dtype, copy=False)
+        yield start, gasf, gadf
 
 class GAF:
     def __init__(self, file_path: str, valid_events_descriptions: list, cue_map, debug: bool = True):
@@ -35,165 +102,167 @@ class GAF:
 
         # This is a dictionary [number:text], we use the values to get the class name and use as the output folder
         self.cue_map = cue_map
+
+        # Where images are written (ImageWriter or ArraySink), see `generate_images`
+        self.__sink = None
         
-    def __time_from_annotation(self, annotation):
-        # Get data to slice the time series data
-        start_time = annotation['onset']
-        duration = annotation['duration']
-        end_time = start_time + duration
-        return start_time, end_time
-
-    # Get event description. It's the number, not the string.
-    def __description_from_annotation(self, annotation):
-        return annotation['description']
-    
-    def __should_process_annotation(self, annotation):
-        description = self.__description_from_annotation(annotation)
-        is_valid = description in self.valid_events_descriptions
-        return is_valid
-
-    def __save_image(self, image_folder, image_file_name, image):
-        final_image_folder = f'{image_folder}'
-        if not os.path.exists(final_image_folder):
-            os.makedirs(final_image_folder)
-
-        image_path = f'{final_image_folder}/{image_file_name}.png'
-        log("Saving image to " + image_path)
-        # plt.imsave(image_path, desired_image)
-        plt.imsave(image_path, image, cmap='viridis')
-        return
-
-        #  Color maps
-        all_cmaps = {
-            'Perceptually Uniform Sequential' : ['viridis', 'plasma', 'inferno', 'magma', 'cividis'],
-            'Sequential' : ['Greys', 'Purples', 'Blues', 'Greens', 'Oranges', 'Reds', 'YlOrBr', 'YlOrRd', 
-                            'OrRd', 'PuRd', 'RdPu', 'BuPu', 'GnBu', 'PuBu', 'YlGnBu', 'PuBuGn', 'BuGn', 'YlGn']
-        }
-        default = 'viridis'
-        cmaps_selected = [default]
-        
-        # Resize image if needed
-        # desired_image_size = 256
-        desired_image = image
-        # if image.shape[0] < desired_image_size:
-        #     desired_image = cv2.resize(desired_image, dsize=(desired_image_size, desired_image_size), interpolation=cv2.INTER_AREA)
-        
-        for cmap_type, cmaps in all_cmaps.items():
-            for cmap in cmaps:
-                if cmap in cmaps_selected:
-                    final_image_folder = f'{image_folder}/{cmap_type}/{cmap}'
-                    if not os.path.exists(final_image_folder):
-                        os.makedirs(final_image_folder)
-        
-                    image_path = f'{final_image_folder}/{image_file_name}.png'
-                    log("Saving image to " + image_path)
-                    # plt.imsave(image_path, desired_image)
-                    plt.imsave(image_path, desired_image, cmap=cmap)
-                    
-                    # image_path = f'{image_path}.csv'
-                    # log("Saving image to " + image_path)
-                    # np.savetxt(image_path, image, delimiter=",")
-
-    # TODO: Is there a way to declare `gaf` type to be `pyts.image.GramianAngularField`?
-    def __generate_image(self, gaf, output_folder: str, cue_human_readable: str, 
-                        cue_samples: pd.DataFrame, n_timestamps: int, image_file_name: str, 
-                        generate_intermediate_images: bool = False, merge_channels: bool = True, is_pause: bool = False):
-        # Generate Garmian Angular Field
-        image_folder = f'{output_folder}/GAF/{gaf.method}/{cue_human_readable}'
-        if not os.path.exists(image_folder):
-            os.makedirs(image_folder)
-        cue_samples_gaf = gaf.fit_transform(cue_samples)
+    # Save the images of one epoch.
+    # epoch_gaf: ndarray, shape (n_channels, n_timestamps, n_timestamps), n_timestamps being the image size. method: the GAF method name used as output folder, i.e. summation or difference.
+    # metadata: information about the epoch (label, annotation, ...) kept by the array output format.
+    # packed: epoch_gaf holds packed triangles instead, shape (n_channels, n_timestamps * (n_timestamps + 1) / 2). Only for ArraySink.
+    def __generate_image(self, epoch_gaf: np.ndarray, method: str, output_folder: str, cue_human_readable: str, 
+                        n_timestamps: int, image_file_name: str, channel_names: list, metadata: dict,
+                        generate_intermediate_images: bool = False, merge_channels: bool = True, is_pause: bool = False, packed: bool = False):
+        image_folder = f'{output_folder}/GAF/{method}/{cue_human_readable}'
+        # How to expand the packed images, see ArraySink.load_shard
+        packing = {"layout": "upper", "size": n_timestamps, "antisymmetric": method == "difference"}
         
         if merge_channels:
-            # Reshape to reduce/remove channels dimension, making it a taller matrix i.e. stacking channels images vertically
-            # https://github.com/johannfaouzi/pyts/issues/95#issuecomment-809177142
-            merged_channels_image = cue_samples_gaf.reshape(-1, n_timestamps)
-            self.__save_image(image_folder, image_file_name, merged_channels_image)
+            if packed:
+                # Channels stay in rows, the dense image is still the stacked one
+                self.__sink.save(image_folder, image_file_name, epoch_gaf, dict(metadata, channel=channel_names),
+                                 packing=dict(packing, dense_shape=[len(epoch_gaf) * n_timestamps, n_timestamps]))
+            else:
+                # Reshape to reduce/remove channels dimension, making it a taller matrix i.e. stacking channels images vertically
+                # https://github.com/johannfaouzi/pyts/issues/95#issuecomment-809177142
+                # RGB images keep their last dimension
+                merged_channels_image = epoch_gaf.reshape((-1,) + epoch_gaf.shape[2:])
+                self.__sink.save(image_folder, image_file_name, merged_channels_image, dict(metadata, channel=channel_names))
         
-        # TODO: generate_intermediate_images is coming as False but we're passing True in __generate_image_from_annotation
         if generate_intermediate_images:
-            channel_index = 0
-            for img in cue_samples_gaf:
-                intermediate_image_file_name = f"{image_file_name}-Ch-{channel_index}"
-                self.__save_image(image_folder, intermediate_image_file_name, img)
-                channel_index += 1
-
-    def __generate_image_from_annotation(self, gasf, gadf, output_folder: str, 
-                                        cue_human_readable: str, cue_samples: pd.DataFrame, 
-                                        n_timestamps: int, image_file_name: str, 
-                                        generate_intermediate_images: bool = False, generate_difference_images: bool = False, merge_channels: bool = True, is_pause: bool = False):
-        log(f'Generating summation image ({image_file_name})...')
-        self.__generate_image(gaf=gasf, output_folder=output_folder, cue_human_readable=cue_human_readable, 
-                             cue_samples=cue_samples, n_timestamps=n_timestamps, image_file_name=image_file_name,
-                             generate_intermediate_images=generate_intermediate_images, merge_channels=merge_channels, is_pause=is_pause)
-
-        if generate_difference_images:
-            log(f'Generating difference image ({image_file_name})...')
-            self.__generate_image(gaf=gadf, output_folder=output_folder, cue_human_readable=cue_human_readable, 
-                                 cue_samples=cue_samples, n_timestamps=n_timestamps, image_file_name=image_file_name,
-                                 generate_intermediate_images=generate_intermediate_images, merge_channels=merge_channels, is_pause=is_pause)
-
-    def generate_images(self, output_folder: str, t_start, duration, generate_intermediate_images: bool = False, generate_difference_images: bool = False, desired_channels: list = [], merge_channels: bool=True):
-        gasf = GramianAngularField(image_size=32, method='summation')
-        gadf = GramianAngularField(image_size=32, method='difference')
-        
-        # Read data
-        raw = mne.io.read_raw_gdf(self.file_path, preload=True)
-        
-        # Filter channels
-        if len(desired_channels) > 0:
-            raw = raw.pick_channels(desired_channels)
+            intermediate_image_file_names = [f"{image_file_name}-Ch-{channel_index}" for channel_index in range(len(epoch_gaf))]
+            intermediate_metadata = [dict(metadata, channel=channel_name) for channel_name in channel_names]
+            if packed:
+                self.__sink.save_batch(image_folder, intermediate_image_file_names, epoch_gaf, intermediate_metadata,
+                                       packing=dict(packing, dense_shape=[n_timestamps, n_timestamps]))
+            else:
+                self.__sink.save_batch(image_folder, intermediate_image_file_names, epoch_gaf, intermediate_metadata)
 
-        raw.filter(l_freq=1, h_freq=40)
+    # chunk_size: number of epochs transformed at once by the GAF engine. Bigger is faster but uses more memory.
+    # output_format: "png" saves one image file per image, "npy" saves dense array shards plus a manifest (see ArraySink).
+    # lazy: don't load the whole recording, read and filter only the desired channels in a padded window around each epoch.
+    # Use it for recordings that don't fit in memory, results match the default mode up to floating point error.
+    # image_size: width and height of the images. The epochs are downsampled to `image_size` points with PAA before building the fields,
+    # None (default) keeps one pixel per sample, i.e. a 4 s window at 250 Hz gives 1001x1001 images.
+    # packed: "npy" only, store the upper triangle and the diagonal of each field instead of the full matrix (GASF is symmetric, GADF antisymmetric),
+    # which halves the size of the shards. `ArraySink.load_shard` expands them back to dense matrices.
+    # dtype: precision of the epochs and of the fields, float64 (None, default), float32 or float16. float32 halves memory and bandwidth.
+    # float16 fields are computed from float32 epochs, see Quantization.working_dtype.
+    # quantize: None keeps the float fields (PNGs colored with each image's min and max), "uint8" maps [-1, 1] to gray levels 0..255 and
+    # "rgb" to the viridis colors, with a lookup table over the whole chunk. Quantized PNGs and shards store 1 (or 3) bytes per pixel.
+    # n_crops, crop_stride: augmentation, `n_crops` windows of `duration` seconds per trial, each starting `crop_stride` seconds after the previous one,
+    # i.e. crop k covers [t_start + k * crop_stride, t_start + k * crop_stride + duration]. The trial is loaded, filtered and epoched once and the crops
+    # are strided views of it, transformed in one batch. Images are named with a "-Crop-k" suffix and their start time is kept in the npy manifest.
+    # The fields are rescaled per crop, so they can't be shared between crops, but when the stride is a multiple of the PAA segment
+    # (n_timestamps / image_size) the PAA of the whole trial is computed once and shared by all its crops.
+    # Returns the paths of the files written.
+    def generate_images(self, output_folder: str, t_start, duration, generate_intermediate_images: bool = False, generate_difference_images: bool = False, desired_channels: list = [], merge_channels: bool=True, chunk_size: int = 8, output_format: str = "png", lazy: bool = False, image_size: int = None, packed: bool = False,
+                        dtype=None, quantize: str = None, n_crops: int = 1, crop_stride: float = 0):
+        tmax = t_start + duration + (n_crops - 1) * crop_stride
+        recording = preprocess_file(self.file_path, desired_channels, self.valid_events_descriptions, tmin=t_start, tmax=tmax, lazy=lazy, dtype=parse_dtype(dtype))
+        return self.generate_images_from_epochs(recording, output_folder=output_folder, t_start=t_start, duration=duration, 
+                                                generate_intermediate_images=generate_intermediate_images, generate_difference_images=generate_difference_images, 
+                                                merge_channels=merge_channels, chunk_size=chunk_size, output_format=output_format, image_size=image_size, packed=packed,
+                                                dtype=dtype, quantize=quantize, n_crops=n_crops, crop_stride=crop_stride)
 
-        raw_file_name = self.file_path.split('/')[-1]
+    # Same as `generate_images` but reusing epochs already loaded, picked and filtered by `preprocess_file`,
+    # e.g. to run several methods on the same file. Epochs whose description is not valid for this instance, or whose window
+    # runs past the end of the recording (see EpochedRecording.in_window), are ignored.
+    # With crops the epochs must extend to t_start + duration + (n_crops - 1) * crop_stride.
+    def generate_images_from_epochs(self, recording: EpochedRecording, output_folder: str, t_start, duration, generate_intermediate_images: bool = False, generate_difference_images: bool = False, merge_channels: bool=True, chunk_size: int = 8, output_format: str = "png", image_size: int = None, packed: bool = False,
+                                    dtype=None, quantize: str = None, n_crops: int = 1, crop_stride: float = 0):
+        if output_format not in ["png", "npy"]:
+            raise ValueError(f'Output format {output_format} not supported. Accepted values: png, npy')
+        if packed and output_format != "npy":
+            raise ValueError('Packed triangular images are only supported by the npy output format')
+        if image_size is not None and image_size < 1:
+            raise ValueError(f'Image size must be positive, got {image_size}')
+        if quantize not in QUANTIZE_MODES:
+            raise ValueError(f'Quantization {quantize} not supported. Accepted values: uint8, rgb')
+        if packed and quantize == "rgb":
+            raise ValueError('Packed triangular images can\'t be quantized to RGB, use uint8')
+        crop_stride_samples = int(round(crop_stride * recording.sfreq))
+        if n_crops < 1 or (n_crops > 1 and crop_stride_samples < 1):
+            raise ValueError(f'Crops need n_crops >= 1 and a stride of at least one sample, got {n_crops} crops every {crop_stride} s')
+        dtype = parse_dtype(dtype)
+        log(f'GAF: using the {len(recording)} preprocessed epochs of {recording.file_name}')
 
-        # Get annotations and iterate over
-        annotations = raw.annotations
-        annotation_index = 0
+        raw_file_name = recording.file_name
         is_pause = False
-        for ann in annotations:
-            # This is used only for the output folder as the event class
-            description = self.__description_from_annotation(ann)
-            
+        is_valid = np.array([description in self.valid_events_descriptions for description in recording.descriptions], dtype=bool)
+        # The epochs may have been cut for a longer window (see preprocess_file(min_tmax=...)), keep the ones where ours fits
+        is_valid &= recording.in_window(t_start, t_start + duration, extra_samples=(n_crops - 1) * crop_stride_samples)
+        if not is_valid.any():
+            return []
+
+        # trials.shape = (n_epochs, n_channels, n_timestamps + (n_crops - 1) * crop_stride_samples)
+        trials = recording.window(t_start, t_start + duration, extra_samples=(n_crops - 1) * crop_stride_samples)[is_valid]
+        if dtype is not None:
+            trials = trials.astype(working_dtype(dtype), copy=False)
+        n_timestamps = trials.shape[-1] - (n_crops - 1) * crop_stride_samples
+        epochs_metadata = []
+        for description, annotation_index, onset in zip(np.array(recording.descriptions)[is_valid], recording.annotation_indexes[is_valid], recording.onsets[is_valid]):
             # TODO: This can crash if the annotation is not in the `event_description_dictionary`
             cue_human_readable = self.cue_map[description]
-            
-            # Internal validation if the annotation should be processed
-            if not self.__should_process_annotation(ann):
-                log(f'Ignoring annotation ({annotation_index}): {cue_human_readable}. See __should_process_annotation to understand why.')
-                continue
-
-            log(f'Processing annotation ({annotation_index}): {cue_human_readable}...')
-
-            # Extract samples for that event/cue
-            start_time, end_time = self.__time_from_annotation(ann)
-            tmin = start_time + t_start
-            tmax = tmin + duration
-            cue_samples = raw.copy().crop(tmin=tmin, tmax=tmax).to_data_frame().drop(columns='time')
-            
-            n_timestamps, n_samples = cue_samples.shape # n_timestamps.shape = (314 timesamples, 6 channels)
-            
-            # Setup GAFs
-            # The image size can only be as big as there are samples, and the minimum size required by the ML model is 32.
-            # TODO: What if we get a signal that has less than 32 samples?
-            gasf.image_size = gadf.image_size = max(32, n_timestamps)
-            
-            # Prepare data as required by GAF lib
-            # GramianAngularField.fit_transform() expects (n_samples, n_features): cue_samples.shape = (6, 314) = (n_channels, n_timestamps)
-            cue_samples = cue_samples.transpose() 
-            
-            # Mount image path
-            image_file_name = f'size_{gasf.image_size}-{raw_file_name}-Ann-{annotation_index}'
-            if is_pause:
-                image_file_name = image_file_name + "-pause"
-
-            self.__generate_image_from_annotation(gasf=gasf, gadf=gadf, 
-                                                 output_folder=output_folder, 
-                                                 cue_human_readable=cue_human_readable, cue_samples=cue_samples, n_timestamps=n_timestamps, 
-                                                 image_file_name=image_file_name, 
-                                                 generate_intermediate_images=generate_intermediate_images, 
-                                                 generate_difference_images=generate_difference_images, merge_channels=merge_channels,
-                                                 is_pause=is_pause)
-            
-            annotation_index += 1
\ No newline at end of file
+            epochs_metadata.append({"label": cue_human_readable, "description": str(description), "annotation": int(annotation_index), "onset": float(onset)})
+
+        # By default the image size is as big as there are samples, and the minimum size required by the ML model is 32.
+        # TODO: What if we get a signal that has less than 32 samples?
+        # Sizes bigger than the number of samples are not upsampled.
+        image_size = n_timestamps if image_size is None else min(image_size, n_timestamps)
+        channel_names = recording.ch_names
+
+        # crops.shape = (n_epochs, n_crops, n_channels, n_timestamps), a view on `trials`
+        segment = n_timestamps // image_size
+        if n_crops > 1 and n_timestamps % image_size == 0 and crop_stride_samples % segment == 0:
+            # The PAA segments of every crop are segments of the trial: reduce the trial once, then crop the reduced series
+            crops = crop_views(paa(trials, trials.shape[-1] // segment), image_size, n_crops, crop_stride_samples // segment)
+            fields_image_size = None
+        else:
+            crops = crop_views(trials, n_timestamps, n_crops, crop_stride_samples)
+            fields_image_size = image_size
+        crop_starts = [t_start + crop * crop_stride_samples / recording.sfreq for crop in range(n_crops)]
+
+        if output_format == "npy":
+            parameters = {"method": "GAF", "t_start": t_start, "duration": duration, "channels": channel_names, "l_freq": L_FREQ, "h_freq": H_FREQ, "image_size": image_size, "packed": packed,
+                          "n_crops": n_crops, "crop_stride": crop_stride, "dtype": trials.dtype.name if dtype is None else dtype.name, "quantize": quantize, "value_range": None if quantize is None else list(GAF_RANGE)}
+            self.__sink = ArraySink(recording.file_path, parameters=parameters)
+        else:
+            self.__sink = ImageWriter(cmap='viridis')
+
+        lut = rgb_lut('viridis') if quantize == "rgb" else None
+        try:
+            # chunk_size counts images, each epoch of the chunk gives n_crops of them
+            for start, gasf, gadf in gramian_angular_fields(crops, summation=True, difference=generate_difference_images, chunk_size=max(1, chunk_size // n_crops), image_size=fields_image_size, packed=packed,
+                                                             dtype=dtype):
+                for method, fields in (('summation', gasf), ('difference', gadf)):
+                    if fields is None:
+                        continue
+                    if quantize is not None:
+                        with metrics.timer("encode"):
+                            fields = quantize_images(fields, GAF_RANGE, lut)
+                    for epoch_crops, metadata in zip(fields, epochs_metadata[start:start + len(fields)]):
+                        for crop, epoch_gaf in enumerate(epoch_crops):
+                            # Mount image path
+                            image_file_name = f'size_{image_size}-{raw_file_name}-Ann-{metadata["annotation"]}'
+                            crop_metadata = dict(metadata, method=method)
+                            if n_crops > 1:
+                                image_file_name = f'{image_file_name}-Crop-{crop}'
+                                crop_metadata.update(crop=crop, crop_start=crop_starts[crop])
+                            if is_pause:
+                                image_file_name = image_file_name + "-pause"
+
+                            if is_enabled(DEBUG):
+                                log(f'Generating {method} image ({image_file_name})...', level=DEBUG)
+                            self.__generate_image(epoch_gaf=epoch_gaf, method=method, output_folder=output_folder, 
+                                                 cue_human_readable=metadata["label"], n_timestamps=image_size, 
+                                                 image_file_name=image_file_name, channel_names=channel_names,
+                                                 metadata=crop_metadata,
+                                                 generate_intermediate_images=generate_intermediate_images, merge_channels=merge_channels,
+                                                 is_pause=is_pause, packed=packed)
+        finally:
+            # Wait for the pending writes
+            sink, self.__sink = self.__sink, None
+            sink.close()
+            log(f'Saved {len(sink.written)} files from {raw_file_name}')
+        return sink.written
@@ -0,0 +1,121 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from .Metrics import metrics
+except ImportError:
+    from Metrics import metrics
+
+# Python 3.8.2
+
+__all__ = ["ImageWriter", "colormap_lut", "apply_colormap"]
+
+# Precompute the RGBA colors of a matplotlib color map, as uint8. lut.shape = (N, 4)
+# cmap: color map name (e.g. 'viridis') or a matplotlib Colormap.
+def colormap_lut(cmap) -> np.ndarray:
+    import matplotlib.pyplot as plt
+    cmap = plt.get_cmap(cmap)
+    return (cmap(np.arange(cmap.N)) * 255).astype(np.uint8)
+
+# Color a batch of images with a lookup table, same result as `plt.imsave(path, image, cmap=cmap)`:
+# each image is normalized with its own min and max before indexing the color map.
+# images: ndarray, shape (n_images, height, width). Returns ndarray, shape (n_images, height, width, 4), dtype uint8.
+def apply_colormap(images: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    n_colors = lut.shape[0]
+    vmin = images.min(axis=(-2, -1), keepdims=True)
+    vmax = images.max(axis=(-2, -1), keepdims=True)
+    scale = vmax - vmin
+    # Constant images are mapped to the first color, like matplotlib's Normalize does
+    scale[scale == 0] = np.inf
+    indexes = ((images - vmin) / scale * n_colors).astype(np.intp)
+    np.clip(indexes, 0, n_colors - 1, out=indexes)
+    return lut[indexes]
+
+# Writes PNG images in background threads so computing the next images overlaps with encoding and disk I/O.
+# - Color maps are applied with a precomputed lookup table over the whole batch, no matplotlib call per image.
+# - uint8 images are already quantized (see Quantization.quantize) and written as they are: (height, width) as gray levels, (height, width, 3) as RGB.
+# - Folders already created are remembered, so os.makedirs is called once per folder.
+# - At most `max_pending` batches wait in the queue: `save` blocks when it's full, which keeps memory flat.
+# The images passed to `save`/`save_batch` must not be modified afterwards, they are written asynchronously.
+# Use `close` (or a `with` block) to wait for every pending write. Errors raised by the threads are re-raised by `close`.
+class ImageWriter:
+    def __init__(self, cmap='viridis', n_threads: int = 2, max_pending: int = 16):
+        self.lut = colormap_lut(cmap)
+        self.__executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='ImageWriter')
+        self.__pending = threading.BoundedSemaphore(max_pending)
+        self.__lock = threading.Lock()
+        self.__folders = set()
+        self.__errors = []
+        # Paths of every file written, used by the callers to know what was generated
+        self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    # metadata is accepted for compatibility with ArraySink, PNG files don't keep it
+    def save(self, image_folder: str, image_file_name: str, image: np.ndarray, metadata: dict = None):
+        self.save_batch(image_folder, [image_file_name], np.asarray(image)[np.newaxis])
+
+    # images: ndarray, shape (n_images, height, width), or (n_images, height, width, 3) for RGB uint8 images. One file name per image.
+    def save_batch(self, image_folder: str, image_file_names: list, images: np.ndarray, metadata: list = None):
+        # Backpressure: wait until there is room in the queue
+        self.__pending.acquire()
+        try:
+            # The threads attribute their metrics to the file being processed when the images were saved
+            self.__executor.submit(self.__write, image_folder, list(image_file_names), images, metrics.current_file)
+        except BaseException:
+            self.__pending.release()
+            raise
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        if len(self.__errors) > 0:
+            raise self.__errors[0]
+
+    def __ensure_folder(self, image_folder: str):
+        if image_folder in self.__folders:
+            return
+        os.makedirs(image_folder, exist_ok=True)
+        with self.__lock:
+            self.__folders.add(image_folder)
+
+    def __write(self, image_folder: str, image_file_names: list, images: np.ndarray, file: str = None):
+        from PIL import Image
+        try:
+            self.__ensure_folder(image_folder)
+            encode_seconds = write_seconds = 0.0
+            n_bytes = 0
+            started_at = time.perf_counter()
+            colored_images = images if images.dtype == np.uint8 else apply_colormap(images, self.lut)
+            paths = []
+            for image_file_name, colored_image in zip(image_file_names, colored_images):
+                image_path = f'{image_folder}/{image_file_name}.png'
+                # Encode in memory first, so encoding and disk I/O are measured separately
+                buffer = io.BytesIO()
+                Image.fromarray(colored_image).save(buffer, format='png')
+                encoded_at = time.perf_counter()
+                encode_seconds += encoded_at - started_at
+                with open(image_path, 'wb') as f:
+                    f.write(buffer.getbuffer())
+                started_at = time.perf_counter()
+                write_seconds += started_at - encoded_at
+                n_bytes += buffer.getbuffer().nbytes
+                paths.append(image_path)
+            metrics.add_time("encode", encode_seconds, calls=len(paths), file=file)
+            metrics.add_time("write", write_seconds, calls=len(paths), file=file)
+            metrics.count("images", len(paths), file=file)
+            metrics.count("bytes_written", n_bytes, file=file)
+            with self.__lock:
+                self.written += paths
+        except Exception as e:
+            with self.__lock:
+                self.__errors.append(e)
+        finally:
+            self.__pending.release()
@@ -1,13 +1,44 @@
 from datetime import datetime
 
-__all__ = ["log"]
+__all__ = ["log", "set_verbosity", "get_verbosity", "set_log_file", "get_log_file", "is_enabled", "QUIET", "INFO", "DEBUG"]
 
-def log(msg:str, log_file: str = None):
+# Verbosity levels: QUIET only logs errors and the run summary, INFO one line per file and stage, DEBUG every image, annotation and file check.
+QUIET = 0
+INFO = 1
+DEBUG = 2
+
+_verbosity = INFO
+# Default file where the messages are appended, None prints them
+_log_file = None
+
+def set_verbosity(level: int):
+    global _verbosity
+    _verbosity = level
+
+def get_verbosity() -> int:
+    return _verbosity
+
+# Append every message to `log_file` instead of printing it, None to print again.
+def set_log_file(log_file: str = None):
+    global _log_file
+    _log_file = log_file
+
+def get_log_file() -> str:
+    return _log_file
+
+# Check before building expensive messages on the hot path
+def is_enabled(level: int) -> bool:
+    return level <= _verbosity
+
+# level: messages above the current verbosity are dropped without formatting the timestamp.
+def log(msg:str, log_file: str = None, level: int = INFO):
+    if level > _verbosity:
+        return
     now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
     txt = f'{now}: {msg}'
+    log_file = log_file or _log_file
     if log_file is None:
         print(txt)
     else:
-        f = open(log_file, 'w')
-        f.write(txt)
-        f.close
\ No newline at end of file
+        with open(log_file, 'a') as f:
+            f.write(txt + '\n')
@@ -0,0 +1,117 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Python 3.8.2
+
+__all__ = ["Metrics", "metrics", "STAGES"]
+
+# Pipeline stages timed by the instrumentation
+# load: read the recording, filter: band-pass filter, epoch: cut (and in lazy mode read and filter) the epochs,
+# transform: GAF/ERSP, significance: ERSP cluster permutation tests (wall time of the pool), encode: colormap and PNG compression, write: file I/O.
+STAGES = ["load", "filter", "epoch", "transform", "significance", "encode", "write"]
+
+# Low overhead timers and counters, aggregated per file and stage (no per call record is kept).
+# Safe to use from the ImageWriter threads. Worker processes send their records back with `drain` and the parent `merge`s them.
+class Metrics:
+    def __init__(self):
+        # {(file, stage): [seconds, calls]}
+        self.timers = {}
+        # {(file, counter): value}
+        self.counters = {}
+        # File the stages are attributed to, see `file`
+        self.current_file = None
+        self.__lock = threading.Lock()
+
+    # Attribute the stages and counters recorded inside this block to `file_name`.
+    @contextmanager
+    def file(self, file_name: str):
+        previous, self.current_file = self.current_file, file_name
+        try:
+            yield
+        finally:
+            self.current_file = previous
+
+    # Time a stage. When run in threads (e.g. encode/write) the seconds are busy time, they can add up to more than the wall time.
+    @contextmanager
+    def timer(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started_at)
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1, file: str = None):
+        key = (file or self.current_file, stage)
+        with self.__lock:
+            timer = self.timers.setdefault(key, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def count(self, counter: str, value=1, file: str = None):
+        key = (file or self.current_file, counter)
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Return the records (picklable) and start again from zero.
+    def drain(self) -> dict:
+        with self.__lock:
+            records = {"timers": self.timers, "counters": self.counters}
+            self.timers, self.counters = {}, {}
+        return records
+
+    # Add the records returned by `drain`, e.g. from a worker process.
+    def merge(self, records: dict):
+        for (file, stage), (seconds, calls) in records["timers"].items():
+            self.add_time(stage, seconds, calls, file=file)
+        for (file, counter), value in records["counters"].items():
+            self.count(counter, value, file=file)
+
+    # Totals of every stage and counter over all the files
+    def summary(self) -> dict:
+        stages = {}
+        for (_, stage), (seconds, calls) in self.timers.items():
+            total = stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+            total["seconds"] += seconds
+            total["calls"] += calls
+        counters = {}
+        for (_, counter), value in self.counters.items():
+            counters[counter] = counters.get(counter, 0) + value
+        return {"stages": stages, "counters": counters}
+
+    def files(self) -> dict:
+        files = {}
+        for (file, stage), (seconds, calls) in self.timers.items():
+            files.setdefault(file, {"stages": {}, "counters": {}})["stages"][stage] = {"seconds": seconds, "calls": calls}
+        for (file, counter), value in self.counters.items():
+            files.setdefault(file, {"stages": {}, "counters": {}})["counters"][counter] = value
+        return files
+
+    # Write the metrics report, as CSV (one row per file and stage or counter) if `report_path` ends with .csv, JSON otherwise.
+    # extra: run level information added to the JSON report, e.g. the wall time.
+    def write_report(self, report_path: str, extra: dict = None):
+        if report_path.endswith('.csv'):
+            with open(report_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(["file", "kind", "name", "seconds", "calls", "value"])
+                for (file, stage), (seconds, calls) in sorted(self.timers.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+                    writer.writerow([file, "stage", stage, f'{seconds:.6f}', calls, ""])
+                for (file, counter), value in sorted(self.counters.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+                    writer.writerow([file, "counter", counter, "", "", value])
+        else:
+            with open(report_path, 'w') as f:
+                json.dump(dict(extra or {}, **self.summary(), files=self.files()), f, indent=2)
+        return report_path
+
+    # One line per stage, slowest first
+    def summary_lines(self) -> list:
+        summary = self.summary()
+        lines = [f'{stage:<12} {total["seconds"]:10.3f}s {total["calls"]:8d} calls'
+                 for stage, total in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"])]
+        lines += [f'{counter:<12} {value}' for counter, value in sorted(summary["counters"].items())]
+        return lines
+
+# Process wide instance used by the pipeline
+metrics = Metrics()
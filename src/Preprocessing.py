@@ -0,0 +1,144 @@
+import numpy as np
+
+try:
+    from .Logger import log, DEBUG
+    from .Metrics import metrics
+    from .Epoching import window_start_samples, extract_epochs, read_filtered_epochs
+    from .Quantization import working_dtype
+except ImportError:
+    from Logger import log, DEBUG
+    from Metrics import metrics
+    from Epoching import window_start_samples, extract_epochs, read_filtered_epochs
+    from Quantization import working_dtype
+
+# Python 3.8.2
+
+__all__ = ["EpochedRecording", "read_recording", "filter_recording", "epoch_recording", "preprocess_file"]
+
+# Band-pass filter applied to every recording, in Hz
+L_FREQ = 1
+H_FREQ = 40
+
+# Output of the preprocessing stage shared by all the image generation methods: the recording loaded, picked,
+# filtered and cut into epochs around the selected annotations. Each method takes the time window it needs with `window`,
+# and the epochs where that window is inside the recording with `in_window`.
+class EpochedRecording:
+    def __init__(self, file_path: str, sfreq: float, ch_names: list, data: np.ndarray, tmin: float,
+                 descriptions: list, annotation_indexes: np.ndarray, onsets: np.ndarray, n_valid_times: np.ndarray = None):
+        self.file_path = file_path
+        self.file_name = file_path.split('/')[-1]
+        self.sfreq = sfreq
+        self.ch_names = ch_names
+        # data.shape = (n_epochs, n_channels, n_times), the first sample is `tmin` seconds after the event
+        self.data = data
+        self.tmin = tmin
+        # Event description (e.g. "769") of each epoch
+        self.descriptions = descriptions
+        # Index of each epoch among the selected annotations, including the ones dropped for being outside the recording.
+        # Used to name the images, so names don't change when an epoch is dropped.
+        self.annotation_indexes = annotation_indexes
+        # Annotation onset of each epoch, in seconds
+        self.onsets = onsets
+        # Number of samples of each epoch inside the recording, the ones after are zeros. None: all the epochs are complete.
+        self.n_valid_times = n_valid_times
+
+    def __len__(self):
+        return len(self.data)
+
+    # Epochs between `tmin` and `tmax` seconds around the events, both included, like mne.Epochs(tmin=tmin, tmax=tmax).
+    # extra_samples: extend the window by this number of samples after `tmax`, e.g. to cut overlapping crops (see Epoching.crop_views).
+    # Returns a view on `data`, shape (n_epochs, n_channels, n_times). Epochs running past the end of the recording are zero padded,
+    # select the others with `in_window`.
+    def window(self, tmin, tmax, extra_samples: int = 0) -> np.ndarray:
+        first, last = self.__window_samples(tmin, tmax, extra_samples)
+        return self.data[..., first:last]
+
+    # Boolean mask over the epochs telling which ones have the whole `window(tmin, tmax, extra_samples)` inside the recording,
+    # i.e. the epochs preprocess_file(tmin=tmin, tmax=tmax) alone would have kept.
+    def in_window(self, tmin, tmax, extra_samples: int = 0) -> np.ndarray:
+        _, last = self.__window_samples(tmin, tmax, extra_samples)
+        if self.n_valid_times is None:
+            return np.ones(len(self), dtype=bool)
+        return self.n_valid_times >= last
+
+    def __window_samples(self, tmin, tmax, extra_samples: int) -> tuple:
+        first = int(round(tmin * self.sfreq)) - int(round(self.tmin * self.sfreq))
+        last = int(round(tmax * self.sfreq)) - int(round(self.tmin * self.sfreq)) + 1 + extra_samples
+        if first < 0 or last > self.data.shape[-1]:
+            raise ValueError(f'Window [{tmin}, {tmax}] s (+ {extra_samples} samples) is outside the preprocessed epochs [{self.tmin}, {self.tmin + (self.data.shape[-1] - 1) / self.sfreq}] s')
+        return first, last
+
+# Read a recording and keep only `desired_channels` (all of them if empty).
+# preload=False only reads the header, the samples are read on demand (see `read_filtered_epochs`).
+def read_recording(file_path: str, desired_channels: list, preload: bool = True):
+    # Imported here, like every heavy dependency: importing the pipeline modules stays fast for planning, dry runs and the worker start
+    import mne
+    with metrics.timer("load"):
+        raw = mne.io.read_raw_gdf(file_path, preload=preload)
+
+        # Pick the channels before filtering, there is no reason to filter channels we don't use
+        if len(desired_channels) > 0:
+            raw.pick_channels(desired_channels)
+    return raw
+
+# Band-pass filter a preloaded recording in place between L_FREQ and H_FREQ.
+def filter_recording(raw):
+    with metrics.timer("filter"):
+        raw.filter(l_freq=L_FREQ, h_freq=H_FREQ)
+    return raw
+
+# Cut the epochs around the annotations whose description is in `valid_events_descriptions`, in the recording order.
+# tmin, tmax: epoch window in seconds around each annotation onset. Epochs outside the recording are dropped.
+# raw must be filtered already, unless lazy: then it is opened with preload=False and only a padded window around each epoch
+# is read and filtered, see `read_filtered_epochs`.
+# dtype: precision of the outputs computed from the epochs (e.g. float32 halves their memory), None keeps float64. Filtering is always
+# done in float64. The epochs are float32 for float16 outputs, see Quantization.working_dtype.
+# min_tmax: keep the epochs inside the recording up to `min_tmax` only, instead of `tmax`, and zero pad them after its end.
+# For methods sharing the epochs with shorter windows, each one selects its epochs with `EpochedRecording.in_window`. None: tmax.
+def epoch_recording(raw, file_path: str, valid_events_descriptions: list, tmin, tmax, lazy: bool = False, dtype=None, min_tmax=None):
+    file_name = file_path.split('/')[-1]
+    dtype = working_dtype(dtype)
+    annotations = raw.annotations
+    is_valid = np.array([description in valid_events_descriptions for description in annotations.description], dtype=bool)
+    onsets = np.asarray(annotations.onset)[is_valid]
+    descriptions = [str(description) for description in np.asarray(annotations.description)[is_valid]]
+
+    # Same samples mne.Epochs(raw, events, event_id, tmin, tmax) would take
+    sfreq = raw.info['sfreq']
+    first_sample_offset = int(round(tmin * sfreq))
+    n_times = int(round(tmax * sfreq)) - first_sample_offset + 1
+    min_n_times = None if min_tmax is None else int(round(min_tmax * sfreq)) - first_sample_offset + 1
+    start_samples = window_start_samples(raw, onsets, 0) + first_sample_offset
+    # In lazy mode this includes reading and filtering the epoch windows
+    with metrics.timer("epoch"):
+        if lazy:
+            data, in_bounds = read_filtered_epochs(raw, start_samples, n_times, l_freq=L_FREQ, h_freq=H_FREQ, dtype=dtype or np.float64, min_n_times=min_n_times)
+        else:
+            data, in_bounds = extract_epochs(raw.get_data(), start_samples, n_times, min_n_times=min_n_times)
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+    metrics.count("epochs", len(data))
+
+    annotation_indexes = np.arange(len(onsets))
+    for annotation_index in annotation_indexes[~in_bounds]:
+        log(f'Ignoring annotation ({annotation_index}) of {file_name}: the time window is outside the recording.', level=DEBUG)
+    log(f'Preprocessed {file_name}: {len(data)} epochs of {len(raw.ch_names)} channels')
+    n_valid_times = None if min_tmax is None else np.minimum(raw.n_times - start_samples[in_bounds], n_times)
+
+    return EpochedRecording(file_path=file_path, sfreq=sfreq, ch_names=list(raw.ch_names), data=data, tmin=first_sample_offset / sfreq,
+                            descriptions=[description for description, keep in zip(descriptions, in_bounds) if keep],
+                            annotation_indexes=annotation_indexes[in_bounds], onsets=onsets[in_bounds], n_valid_times=n_valid_times)
+
+# Load, pick, filter and epoch a recording once, so every method can reuse it.
+# Only annotations whose description is in `valid_events_descriptions` are kept, in the recording order.
+# tmin, tmax: epoch window in seconds around each annotation onset. Epochs outside the recording are dropped.
+# lazy: read and filter only a padded window around each epoch instead of the whole recording, see `read_filtered_epochs`.
+# dtype: precision of the epochs, see `epoch_recording`.
+# min_tmax: keep the epochs that fit up to `min_tmax` only, see `epoch_recording`.
+def preprocess_file(file_path: str, desired_channels: list, valid_events_descriptions: list, tmin, tmax, lazy: bool = False, dtype=None, min_tmax=None):
+    file_name = file_path.split('/')[-1]
+    log(f'Preprocessing {file_name}: load, pick channels, filter {L_FREQ}-{H_FREQ} Hz and epoch [{tmin}, {tmax}] s')
+    raw = read_recording(file_path, desired_channels, preload=not lazy)
+    if not lazy:
+        filter_recording(raw)
+    return epoch_recording(raw, file_path, valid_events_descriptions, tmin, tmax, lazy=lazy, dtype=dtype, min_tmax=min_tmax)
@@ -0,0 +1,47 @@
+import numpy as np
+
+# Python 3.8.2
+
+__all__ = ["quantize", "rgb_lut", "parse_dtype", "working_dtype", "QUANTIZE_MODES", "GAF_RANGE", "ERSP_RANGE"]
+
+# Output images as 8 bit values instead of float64 maps colored by matplotlib: one vectorized pass over a whole batch,
+# with a fixed value range (not each image's min and max), so a pixel value means the same thing in every image.
+
+# "uint8": one gray level per value, "rgb": 8 bit RGB colors through the lookup table of the method's color map
+QUANTIZE_MODES = [None, "uint8", "rgb"]
+
+# GAF values are cosines and sines, always in [-1, 1]
+GAF_RANGE = (-1, 1)
+
+# ERSP values are percent changes from the baseline (-1 is -100%), the ERSP color map is centered on 0 over the same range.
+# Values outside of it are clipped.
+ERSP_RANGE = (-1, 1)
+
+# Precision of the epochs, transforms and float outputs: None keeps float64 (mne's precision).
+def parse_dtype(dtype):
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype not in [np.float16, np.float32, np.float64]:
+        raise ValueError(f'dtype {dtype} not supported. Accepted values: float16, float32, float64')
+    return dtype
+
+# Precision the epochs and transforms are computed in for outputs of `dtype` (see `parse_dtype`). float16 has no normal numbers
+# below 6e-5, so EEG in volts (about 1e-5 V) would be subnormal: float16 outputs are computed in float32 and only cast at the end.
+def working_dtype(dtype):
+    return np.dtype(np.float32) if dtype == np.float16 else dtype
+
+# 256 RGB colors sampled evenly from a matplotlib color map (name or Colormap), as uint8. lut.shape = (256, 3)
+def rgb_lut(cmap) -> np.ndarray:
+    import matplotlib.pyplot as plt
+    cmap = plt.get_cmap(cmap)
+    return np.rint(cmap(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+# Map `images` linearly from `value_range` to 0..255, values outside the range are clipped.
+# lut: a (256, 3) table from `rgb_lut`, then the result are RGB images with shape images.shape + (3,). Otherwise gray levels, same shape as images.
+def quantize(images: np.ndarray, value_range: tuple, lut: np.ndarray = None) -> np.ndarray:
+    low, high = value_range
+    levels = (images - low) * (255 / (high - low))
+    np.clip(levels, 0, 255, out=levels)
+    levels = np.rint(levels, out=levels).astype(np.uint8)
+    return levels if lut is None else lut[levels]
@@ -0,0 +1,40 @@
+import heapq
+
+# Python 3.8.2
+
+__all__ = ["parse_shard", "partition", "shard_items", "shard_name"]
+
+# Deterministic partitioning of the work list across nodes, without a coordinator: every node computes the same partition
+# from the same inputs (file names and weights, e.g. sizes on a shared filesystem) and processes only its own part.
+
+# Parse "i/N" into (i, N). Shards are numbered from 0, e.g. 0/4 ... 3/4, like array job indexes.
+def parse_shard(text: str) -> tuple:
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard {text}, expected i/N e.g. 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard {text}, expected 0 <= i < N')
+    return index, count
+
+# Split `items` into `count` parts of similar total weight (greedy longest processing time first):
+# the heaviest item goes to the lightest part. Ties are broken by item name and part index, so the result only depends
+# on the items and their weights, not on the listing order.
+# Returns a list of `count` lists, each sorted by name.
+def partition(items: list, weights: dict, count: int) -> list:
+    parts = [[] for _ in range(count)]
+    # (total weight, part index)
+    loads = [(0, index) for index in range(count)]
+    for item in sorted(items, key=lambda item: (-weights[item], item)):
+        load, index = heapq.heappop(loads)
+        parts[index].append(item)
+        heapq.heappush(loads, (load + weights[item], index))
+    return [sorted(part) for part in parts]
+
+# Items of shard `index` out of `count`, see `partition`.
+def shard_items(items: list, weights: dict, index: int, count: int) -> list:
+    return partition(items, weights, count)[index]
+
+# Used to name the files written by each shard, e.g. manifest-shard-0-of-4.json
+def shard_name(index: int, count: int) -> str:
+    return f'shard-{index}-of-{count}'
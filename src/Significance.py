@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+
+try:
+    from .Logger import log
+    from .Metrics import metrics
+except ImportError:
+    from Logger import log
+    from Metrics import metrics
+
+# Python 3.8.2
+
+__all__ = ["cluster_permutation_mask", "significance_masks", "SIGNIFICANCE_MODES", "N_PERMUTATIONS", "ALPHA"]
+
+# What to do with the significance masks of the ERSP maps: None skips the tests, "mask" saves each mask next to its image,
+# "apply" sets the pixels outside the significant clusters to 0 (no change from the baseline, white in the ERSP color map).
+SIGNIFICANCE_MODES = [None, "mask", "apply"]
+
+# Sign flip permutations per test, same default as mne's permutation_cluster_1samp_test
+N_PERMUTATIONS = 1024
+
+# Used both as the cluster forming threshold (two-sided t-test p-value) and as the cluster significance level
+ALPHA = 0.05
+
+# Connected pixels along frequency or time, not across the permutations stacked on the first axis
+_STRUCTURE = np.zeros((3, 3, 3), dtype=bool)
+_STRUCTURE[1] = [[False, True, False], [True, True, True], [False, True, False]]
+
+# One-sample t-values of `signs @ X`, one row per permutation.
+# X: ndarray, shape (n_trials, n_pixels). signs: ndarray, shape (n_permutations, n_trials) of +-1.
+# Flipping signs doesn't change the sum of squares, so the variance of all the permutations comes from a single matrix product.
+def _t_values(X: np.ndarray, sum_squares: np.ndarray, signs: np.ndarray) -> np.ndarray:
+    n_trials = X.shape[0]
+    means = signs @ X / n_trials
+    variances = (sum_squares - n_trials * means ** 2) / (n_trials - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_values = means / np.sqrt(np.maximum(variances, 0) / n_trials)
+    t_values[~np.isfinite(t_values)] = 0
+    return t_values
+
+# Clusters of a batch of t maps, t_maps.shape = (n_maps, n_freqs, n_times): connected pixels above `threshold` (positive clusters)
+# or below -threshold (negative ones). Returns (labels, sums): labels.shape = t_maps.shape, 0 outside the clusters,
+# and sums[label] the sum of the t-values of each cluster (sums[0] is unused).
+def _clusters(t_maps: np.ndarray, threshold: float):
+    from scipy import ndimage
+    positive, n_positive = ndimage.label(t_maps > threshold, structure=_STRUCTURE)
+    negative, n_negative = ndimage.label(t_maps < -threshold, structure=_STRUCTURE)
+    labels = positive + np.where(negative > 0, negative + n_positive, 0)
+    sums = np.bincount(labels.ravel(), weights=t_maps.ravel(), minlength=n_positive + n_negative + 1)
+    return labels, sums
+
+# Significant clusters of a one-sample cluster permutation test against 0, like mne's permutation_cluster_1samp_test(tail=0)
+# with the default lattice adjacency, vectorized over batches of `batch_size` permutations.
+# data: ndarray, shape (n_trials, n_freqs, n_times), e.g. the baseline corrected power of one channel for the trials of one event.
+# threshold: cluster forming t-value, None for the two-sided t threshold at `alpha`.
+# seed: anything np.random.default_rng accepts, the result only depends on it and the data.
+# Returns a boolean mask, shape (n_freqs, n_times), True in the clusters whose p-value is <= alpha.
+def cluster_permutation_mask(data: np.ndarray, n_permutations: int = N_PERMUTATIONS, alpha: float = ALPHA, threshold: float = None,
+                             seed=0, batch_size: int = 64) -> np.ndarray:
+    n_trials = data.shape[0]
+    mask = np.zeros(data.shape[1:], dtype=bool)
+    if n_trials < 2:
+        return mask
+    if threshold is None:
+        from scipy import stats
+        threshold = stats.t.ppf(1 - alpha / 2, n_trials - 1)
+    X = data.reshape(n_trials, -1).astype(np.float64)
+    sum_squares = (X ** 2).sum(axis=0)
+
+    observed = _t_values(X, sum_squares, np.ones((1, n_trials))).reshape((1,) + data.shape[1:])
+    labels, sums = _clusters(observed, threshold)
+    if len(sums) == 1:
+        return mask
+
+    # Null distribution of the largest cluster, in absolute value, of each permutation
+    rng = np.random.default_rng(seed)
+    null = np.zeros(n_permutations)
+    for start in range(0, n_permutations, batch_size):
+        n_batch = min(batch_size, n_permutations - start)
+        signs = rng.choice([-1.0, 1.0], size=(n_batch, n_trials))
+        t_maps = _t_values(X, sum_squares, signs).reshape((n_batch,) + data.shape[1:])
+        batch_labels, batch_sums = _clusters(t_maps, threshold)
+        # Permutation of each cluster label, to take the maximum per permutation in one pass
+        permutations = np.zeros(len(batch_sums), dtype=np.intp)
+        permutations[batch_labels.ravel()] = np.repeat(np.arange(n_batch), t_maps[0].size)
+        np.maximum.at(null[start:start + n_batch], permutations[1:], np.abs(batch_sums[1:]))
+
+    p_values = (1 + (null[np.newaxis, :] >= np.abs(sums[1:, np.newaxis])).sum(axis=1)) / (n_permutations + 1)
+    significant = np.flatnonzero(p_values <= alpha) + 1
+    return np.isin(labels[0], significant)
+
+# Like TS2Image's workers, the test processes come from a fork server (spawned where there is none): the callers have threads running,
+# e.g. the ImageWriter pool of the ERSP sink, and forking a process with live threads can leave its locks held in the child.
+# The fork server is shared with TS2Image when it already started one.
+def _pool_context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    return multiprocessing.get_context('forkserver')
+
+# Pool task: (key, data, n_permutations, alpha, seed) -> (key, mask, seconds)
+def _mask_task(task: tuple):
+    key, data, n_permutations, alpha, seed = task
+    started_at = time.perf_counter()
+    mask = cluster_permutation_mask(data, n_permutations=n_permutations, alpha=alpha, seed=seed)
+    return key, mask, time.perf_counter() - started_at
+
+# Run the cluster permutation tests of several maps, in parallel with `n_workers` processes (None: one per core).
+# tests: {key: data}, e.g. {(event, channel): ndarray shape (n_trials, n_freqs, n_times)}. Returns {key: mask}.
+# Each test gets its own seed, derived from `seed` and the position of the test in `tests`, so the masks don't depend on the number of workers.
+# Worker processes of a pool (e.g. TS2Image with n_workers > 1) can't start a pool of their own: there the tests run one after the other.
+# The wall time is recorded in the "significance" stage and the number of permutations in the "permutations" counter.
+def significance_masks(tests: dict, n_permutations: int = N_PERMUTATIONS, alpha: float = ALPHA, seed: int = 0, n_workers: int = None) -> dict:
+    tasks = [(key, data, n_permutations, alpha, [seed, index]) for index, (key, data) in enumerate(tests.items())]
+    masks = {}
+    with metrics.timer("significance"):
+        if (n_workers is None or n_workers > 1) and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+            with _pool_context().Pool(processes=min(n_workers or os.cpu_count() or 1, len(tasks))) as pool:
+                busy_seconds = 0.0
+                for key, mask, seconds in pool.imap_unordered(_mask_task, tasks):
+                    masks[key] = mask
+                    busy_seconds += seconds
+            log(f'{len(tasks)} cluster permutation tests of {n_permutations} permutations, {busy_seconds:.2f}s of CPU time')
+        else:
+            for task in tasks:
+                key, mask, _ = _mask_task(task)
+                masks[key] = mask
+    metrics.count("permutations", n_permutations * len(tasks))
+    return masks
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import platform
+import threading
+from collections import OrderedDict
+import numpy as np
+
+try:
+    from .Metrics import metrics
+except ImportError:
+    from Metrics import metrics
+
+# Python 3.8.2
+
+__all__ = ["KernelCache", "kernel_cache", "multitaper_power", "TIME_BANDWIDTH"]
+
+# Same default as mne's tfr_array_multitaper: 3 DPSS tapers
+TIME_BANDWIDTH = 4.0
+
+# Complex values in each batch of inverse FFTs of `multitaper_power` (64 MB in complex128)
+MAX_BLOCK_VALUES = 2 ** 22
+
+# Changes when the layout of the banks saved on disk changes, older files are ignored
+KERNEL_BANK_VERSION = 1
+
+# Multitaper wavelets of every frequency, as mne's _make_dpss(zero_mean=True) builds them, scaled so that the power is the plain sum
+# of the squared convolutions over the tapers (the taper weights and mne's final 2 / sum(weights ** 2) normalization are folded in).
+# Returns a list, one item per taper, of lists of complex wavelets, one per frequency.
+def _wavelets(sfreq: float, freqs: np.ndarray, n_cycles: np.ndarray, time_bandwidth: float) -> list:
+    from mne.time_frequency import dpss_windows
+    n_tapers = int(np.floor(time_bandwidth - 1))
+    wavelets = [[] for _ in range(n_tapers)]
+    weights = np.empty((n_tapers, len(freqs)))
+    for k, (f, cycles) in enumerate(zip(freqs, n_cycles)):
+        t_win = cycles / float(f)
+        t = np.arange(0.0, t_win, 1.0 / sfreq)
+        # Centered before tapering
+        oscillation = np.exp(2.0 * 1j * np.pi * f * (t - t_win / 2.0))
+        tapers, concentrations = dpss_windows(t.shape[0], time_bandwidth / 2.0, n_tapers, sym=False)
+        for m in range(n_tapers):
+            wavelet = oscillation * tapers[m]
+            wavelet -= wavelet.mean()
+            wavelet /= np.sqrt(0.5) * np.linalg.norm(wavelet)
+            wavelets[m].append(wavelet)
+            weights[m, k] = np.sqrt(concentrations[m])
+    scale = weights * np.sqrt(2 / (weights ** 2).sum(axis=0))
+    return [[wavelet * scale[m, k] for k, wavelet in enumerate(taper_wavelets)] for m, taper_wavelets in enumerate(wavelets)]
+
+# FFT of the wavelets zero padded to n_fft samples, bank.shape = (n_tapers, n_freqs, n_fft).
+# Each wavelet is rolled back by half its length, so the "same" mode output of the convolution of a signal of n_times samples
+# (mne's centered slice) is the first n_times samples of the inverse FFT, for every frequency.
+# n_fft >= n_times + wavelet length - 1, so the roll never wraps the samples that are kept.
+def _kernel_bank(sfreq: float, freqs: np.ndarray, n_cycles: np.ndarray, time_bandwidth: float, n_times: int) -> np.ndarray:
+    from scipy.fft import fft, next_fast_len
+    wavelets = _wavelets(sfreq, freqs, n_cycles, time_bandwidth)
+    max_size = max(len(wavelet) for wavelet in wavelets[0])
+    if max_size > n_times:
+        raise ValueError(f'At least one of the wavelets is longer than the signal ({max_size} > {n_times} samples). '
+                         'Use a longer signal or shorter wavelets.')
+    n_fft = next_fast_len(n_times + max_size - 1)
+    kernels = np.zeros((len(wavelets), len(freqs), n_fft), dtype=np.complex128)
+    for m, taper_wavelets in enumerate(wavelets):
+        for k, wavelet in enumerate(taper_wavelets):
+            kernels[m, k, :len(wavelet)] = wavelet
+            kernels[m, k] = np.roll(kernels[m, k], -((len(wavelet) - 1) // 2))
+    return fft(kernels, axis=-1)
+
+# Kernel banks of the multitaper transform, keyed by everything they depend on: sampling rate, frequencies, cycles,
+# time-bandwidth product and the FFT size, which follows from the number of samples of the epochs.
+# Decimation happens after the convolution, so one bank serves every `decim`.
+# The last `max_entries` banks used are kept in memory (least recently used first out). With `folder`, banks are also saved there
+# as .npy files shared by the worker processes and later runs, the oldest used beyond `max_files` are deleted.
+# Safe to use from threads, e.g. the ImageDataset prefetch workers.
+class KernelCache:
+    def __init__(self, max_entries: int = 8, max_files: int = 32):
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self.banks = OrderedDict()
+        # {"memory": hits, "disk": hits, "built": misses}
+        self.stats = {"memory": 0, "disk": 0, "built": 0}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(sfreq: float, freqs: np.ndarray, n_cycles: np.ndarray, time_bandwidth: float, n_times: int) -> str:
+        description = json.dumps([KERNEL_BANK_VERSION, float(sfreq), [float(f) for f in freqs], [float(c) for c in n_cycles],
+                                  float(time_bandwidth), int(n_times)])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    # Bank for these parameters, from memory, from `folder` or built (and then saved to `folder`).
+    # n_cycles: one value per frequency or a single value for all of them.
+    def bank(self, sfreq: float, freqs, n_cycles, time_bandwidth: float, n_times: int, folder: str = None) -> np.ndarray:
+        freqs = np.asarray(freqs, dtype=float)
+        n_cycles = np.broadcast_to(np.asarray(n_cycles, dtype=float), freqs.shape)
+        key = self.key(sfreq, freqs, n_cycles, time_bandwidth, n_times)
+        with self.__lock:
+            bank = self.banks.get(key)
+            if bank is not None:
+                self.banks.move_to_end(key)
+                self.stats["memory"] += 1
+                return bank
+
+        bank = None if folder is None else self.__load(folder, key)
+        source = "disk" if bank is not None else "built"
+        if bank is None:
+            bank = _kernel_bank(sfreq, freqs, n_cycles, time_bandwidth, n_times)
+            bank.flags.writeable = False
+            metrics.count("kernel_banks_built")
+            if folder is not None:
+                self.__save(folder, key, bank)
+
+        with self.__lock:
+            self.stats[source] += 1
+            self.banks[key] = bank
+            self.banks.move_to_end(key)
+            while len(self.banks) > self.max_entries:
+                self.banks.popitem(last=False)
+        return bank
+
+    def clear(self):
+        with self.__lock:
+            self.banks.clear()
+
+    def __load(self, folder: str, key: str):
+        path = f'{folder}/{key}.npy'
+        try:
+            bank = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # Mark it as recently used for the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        bank.flags.writeable = False
+        return bank
+
+    # Written to a temporary file first, so a process reading the bank never sees a partial file
+    def __save(self, folder: str, key: str, bank: np.ndarray):
+        os.makedirs(folder, exist_ok=True)
+        temporary_path = f'{folder}/{key}.{platform.node()}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.save(f, bank)
+        os.replace(temporary_path, f'{folder}/{key}.npy')
+
+        files = [entry for entry in os.scandir(folder) if entry.name.endswith('.npy')]
+        if len(files) > self.max_files:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+# Process wide instance used by `multitaper_power`
+kernel_cache = KernelCache()
+
+# Multitaper power of every epoch and channel, same as mne's tfr_array_multitaper(data, sfreq, freqs, n_cycles, use_fft=True,
+# decim=decim, output='power') up to floating point error, but with the kernel bank from `kernel_cache` (see KernelCache)
+# and the convolutions of all the epochs and channels batched: one FFT per signal and one inverse FFT per signal, taper and frequency.
+# The inverse FFTs run on blocks of signals and frequencies of at most MAX_BLOCK_VALUES values, so the temporary complex arrays
+# stay small whatever the number of epochs, and the power is accumulated block by block.
+# data: ndarray, shape (n_epochs, n_channels, n_times). Returns power, shape (n_epochs, n_channels, n_freqs, ceil(n_times / decim)), float64.
+# cache_folder: where the kernel banks are saved and shared between processes and runs, None keeps them in memory only.
+def multitaper_power(data: np.ndarray, sfreq: float, freqs, n_cycles, decim: int = 1, time_bandwidth: float = TIME_BANDWIDTH,
+                     cache_folder: str = None) -> np.ndarray:
+    from scipy.fft import fft, ifft
+    if time_bandwidth < 2.0:
+        raise ValueError('time_bandwidth should be >= 2.0 for good tapers')
+    if np.any(np.asarray(freqs) > sfreq / 2.0):
+        raise ValueError(f'Cannot compute freq above Nyquist freq of the data ({sfreq / 2.0:0.1f} Hz), got {np.max(freqs):0.1f} Hz')
+    n_epochs, n_channels, n_times = data.shape
+    bank = kernel_cache.bank(sfreq, freqs, n_cycles, time_bandwidth, n_times, folder=cache_folder)
+    n_tapers, n_freqs, n_fft = bank.shape
+
+    signals = fft(data.reshape(n_epochs * n_channels, n_times).astype(np.float64, copy=False), n_fft, axis=-1)
+    power = np.zeros((n_epochs * n_channels, n_freqs, len(range(0, n_times, decim))))
+    signals_step = max(1, min(len(signals), MAX_BLOCK_VALUES // n_fft))
+    freqs_step = max(1, MAX_BLOCK_VALUES // (signals_step * n_fft))
+    for signals_start in range(0, len(signals), signals_step):
+        block_signals = signals[signals_start:signals_start + signals_step, np.newaxis, :]
+        for freqs_start in range(0, n_freqs, freqs_step):
+            # A view on `power`, shape (signals_step, freqs_step, n_times / decim)
+            block_power = power[signals_start:signals_start + signals_step, freqs_start:freqs_start + freqs_step]
+            for taper_bank in bank:
+                # The product is a temporary, the inverse FFT can overwrite it
+                coefficients = ifft(block_signals * taper_bank[np.newaxis, freqs_start:freqs_start + freqs_step], axis=-1, overwrite_x=True)[..., :n_times:decim]
+                block_power += coefficients.real ** 2 + coefficients.imag ** 2
+    return power.reshape(n_epochs, n_channels, n_freqs, -1)
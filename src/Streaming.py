@@ -0,0 +1,316 @@
+import argparse
+import socket
+import time
+import numpy as np
+
+try:
+    from .GAF import gramian_angular_fields
+    from .ImageWriter import ImageWriter
+    from .Preprocessing import L_FREQ, H_FREQ
+    from .Logger import log
+    from .Metrics import metrics
+except ImportError:
+    from GAF import gramian_angular_fields
+    from ImageWriter import ImageWriter
+    from Preprocessing import L_FREQ, H_FREQ
+    from Logger import log
+    from Metrics import metrics
+
+# Python 3.8.2
+
+__all__ = ["StreamingGAF", "StreamFilter", "GDFReplaySource", "SocketSource", "replay_to_socket", "stream_images", "SCALINGS"]
+
+# Online GAF of a live stream: one image per hop over a sliding window, for real-time BCI demos.
+# A source is any iterable of sample chunks, ndarray shape (n_channels, n_samples), with `sfreq` and `ch_names` attributes,
+# e.g. GDFReplaySource (a recording played back as if it was live) or SocketSource (float32 frames from a TCP socket).
+
+# How the samples are rescaled to [-1, 1] before the polar encoding:
+# fixed: a fixed amplitude range (`value_range`, values outside are clipped). Angles never change once computed,
+#   so each hop only computes the rows and columns of the new points.
+# running: the min and max of each channel seen so far. Incremental like fixed, except when a new point widens the range:
+#   then the whole field is computed again (often at the start of the stream, rarely once the range has settled).
+# window: the min and max of each window, exactly like the offline GAF. Every angle changes at every hop, so each image is a full computation.
+SCALINGS = ["fixed", "running", "window"]
+
+# Sliding window Gramian Angular Fields, updated incrementally.
+# window, hop: in samples. image_size: the window is reduced to `image_size` points with PAA (see GAF.paa), which requires
+# `window` to be a multiple of `image_size` and `hop` a multiple of the segment length window / image_size. None keeps one pixel per sample.
+# The PAA values, their angles (cos, sin) and the fields are kept in ring buffers indexed by the position of each point in the window:
+# a hop of k points overwrites k ring slots and computes the k rows and columns of those points, O(k * image_size) instead of O(image_size^2).
+# Images are read out in time order with one copy when they are emitted.
+class StreamingGAF:
+    def __init__(self, n_channels: int, window: int, hop: int, image_size: int = None, scaling: str = "running", value_range: tuple = None,
+                 summation: bool = True, difference: bool = False):
+        image_size = window if image_size is None else image_size
+        if image_size < 1 or window % image_size != 0:
+            raise ValueError(f'The window ({window} samples) must be a multiple of the image size ({image_size})')
+        self.segment = window // image_size
+        if hop < 1 or hop > window or hop % self.segment != 0:
+            raise ValueError(f'The hop ({hop} samples) must be a multiple of the PAA segment ({self.segment} samples) and at most the window ({window})')
+        if scaling not in SCALINGS:
+            raise ValueError(f'Scaling {scaling} not supported. Accepted values: {", ".join(SCALINGS)}')
+        if scaling == "fixed" and value_range is None:
+            raise ValueError('Fixed scaling needs a value_range, e.g. (-50e-6, 50e-6) for EEG in volts')
+        self.n_channels = n_channels
+        self.n = image_size
+        self.hop_points = hop // self.segment
+        self.scaling = scaling
+        self.summation = summation
+        self.difference = difference
+        # (low, high) of each channel, shape (n_channels, 1)
+        if scaling == "fixed":
+            self.low = np.broadcast_to(np.asarray(value_range[0], dtype=float), (n_channels,)).reshape(-1, 1)
+            self.high = np.broadcast_to(np.asarray(value_range[1], dtype=float), (n_channels,)).reshape(-1, 1)
+        else:
+            self.low = np.full((n_channels, 1), np.inf)
+            self.high = np.full((n_channels, 1), -np.inf)
+
+        # Ring buffers, slot `self.head` holds the oldest point once the window is full
+        self.values = np.zeros((n_channels, self.n))
+        self.cos = np.zeros((n_channels, self.n))
+        self.sin = np.zeros((n_channels, self.n))
+        self.gasf = np.zeros((n_channels, self.n, self.n)) if summation else None
+        self.gadf = np.zeros((n_channels, self.n, self.n)) if difference else None
+        self.head = 0
+        # Points received so far, and the samples of the segment not complete yet
+        self.n_points = 0
+        self.pending = np.zeros((n_channels, 0))
+        # The angles must all be computed again before the next image, see `scaling`
+        self.stale = scaling != "fixed"
+        # How the images were computed: {"incremental": n, "full": n}
+        self.updates = {"incremental": 0, "full": 0}
+
+    # Add samples, shape (n_channels, n_samples), and return the images of the hops completed: [(end_sample, gasf, gadf)],
+    # end_sample being the number of samples received at the end of the window. gasf/gadf have shape (n_channels, image_size, image_size), or are None.
+    # max_images: only read out the images of the last `max_images` hops completed by these samples (the others are updated but not emitted),
+    # which bounds the work per call when the consumer falls behind. None emits every image.
+    def push(self, samples: np.ndarray, max_images: int = None) -> list:
+        samples = np.asarray(samples, dtype=float)
+        if self.pending.shape[1] > 0:
+            samples = np.concatenate([self.pending, samples], axis=1)
+        n_segments = samples.shape[1] // self.segment
+        self.pending = samples[:, n_segments * self.segment:].copy()
+        points = samples[:, :n_segments * self.segment].reshape(self.n_channels, n_segments, self.segment).mean(axis=-1)
+
+        # Index (in points) of the last point of each window completed
+        window_ends = [index for index in range(n_segments)
+                       if self.n_points + index + 1 >= self.n and (self.n_points + index + 1 - self.n) % self.hop_points == 0]
+        emitted = set(window_ends if max_images is None else window_ends[max(len(window_ends) - max_images, 0):])
+        images = []
+        start = 0
+        for end in window_ends:
+            self.__add_points(points[:, start:end + 1])
+            start = end + 1
+            if end in emitted:
+                images.append((self.n_points * self.segment,) + self.__image())
+        self.__add_points(points[:, start:])
+        return images
+
+    def __add_points(self, points: np.ndarray):
+        n_points = points.shape[1]
+        if n_points == 0:
+            return
+        # Only the last `n` points can still be in the window
+        kept = points[:, -self.n:]
+        positions = (self.head + n_points - kept.shape[1] + np.arange(kept.shape[1])) % self.n
+        self.values[:, positions] = kept
+        self.head = (self.head + n_points) % self.n
+        self.n_points += n_points
+
+        if self.scaling == "running":
+            low = np.minimum(self.low, kept.min(axis=1, keepdims=True))
+            high = np.maximum(self.high, kept.max(axis=1, keepdims=True))
+            if (low < self.low).any() or (high > self.high).any():
+                self.low, self.high = low, high
+                self.stale = True
+        if not self.stale:
+            with metrics.timer("transform"):
+                self.__encode(positions)
+
+    # Angles of the points at `positions` and the rows and columns of the fields they are part of
+    def __encode(self, positions: np.ndarray):
+        scale = self.high - self.low
+        scale[scale == 0] = 1
+        cos = np.clip((self.values[:, positions] - self.low) / scale * 2 - 1, -1, 1)
+        self.cos[:, positions] = cos
+        self.sin[:, positions] = np.sqrt(1 - cos ** 2)
+
+        cos_i, sin_i = self.cos[:, positions, None], self.sin[:, positions, None]
+        cos_j, sin_j = self.cos[:, None, :], self.sin[:, None, :]
+        if self.summation:
+            rows = cos_i * cos_j
+            rows -= sin_i * sin_j
+            self.gasf[:, positions, :] = rows
+            self.gasf[:, :, positions] = rows.transpose(0, 2, 1)
+        if self.difference:
+            rows = sin_i * cos_j
+            rows -= cos_i * sin_j
+            self.gadf[:, positions, :] = rows
+            self.gadf[:, :, positions] = -rows.transpose(0, 2, 1)
+
+    # Current window in time order
+    def __image(self) -> tuple:
+        if self.scaling == "window":
+            order = (self.head + np.arange(self.n)) % self.n
+            # Same as the offline GAF of this window
+            _, gasf, gadf = next(gramian_angular_fields(self.values[np.newaxis, :, order], summation=self.summation, difference=self.difference, chunk_size=1))
+            self.updates["full"] += 1
+            return None if gasf is None else gasf[0], None if gadf is None else gadf[0]
+
+        with metrics.timer("transform"):
+            if self.stale:
+                self.__encode(np.arange(self.n))
+                self.stale = False
+                self.updates["full"] += 1
+            else:
+                self.updates["incremental"] += 1
+            gasf = self.__in_time_order(self.gasf) if self.summation else None
+            gadf = self.__in_time_order(self.gadf) if self.difference else None
+        return gasf, gadf
+
+    # Copy of a ring indexed field with the oldest point first: the ring is a rotation, so this is 4 block copies
+    def __in_time_order(self, field: np.ndarray) -> np.ndarray:
+        head = self.head
+        tail = self.n - head
+        ordered = np.empty_like(field)
+        ordered[:, :tail, :tail] = field[:, head:, head:]
+        ordered[:, :tail, tail:] = field[:, head:, :head]
+        ordered[:, tail:, :tail] = field[:, :head, head:]
+        ordered[:, tail:, tail:] = field[:, :head, :head]
+        return ordered
+
+# Causal band-pass filter between L_FREQ and H_FREQ that keeps its state between chunks.
+# The offline pipeline uses mne's zero-phase FIR filter, which needs future samples: a live stream can only be filtered causally,
+# so the filtered signal is delayed and slightly different from the offline one.
+class StreamFilter:
+    def __init__(self, sfreq: float, n_channels: int, l_freq: float = L_FREQ, h_freq: float = H_FREQ, order: int = 4):
+        from scipy.signal import butter
+        self.sos = butter(order, [l_freq, h_freq], btype='bandpass', fs=sfreq, output='sos')
+        self.zi = np.zeros((self.sos.shape[0], n_channels, 2))
+
+    def __call__(self, samples: np.ndarray) -> np.ndarray:
+        from scipy.signal import sosfilt
+        filtered, self.zi = sosfilt(self.sos, samples, axis=-1, zi=self.zi)
+        return filtered
+
+# Stand-in for a live amplifier: plays a recording back in chunks of `chunk_duration` seconds.
+# realtime: chunks are released at the pace of the recording. When the consumer is late, the next chunk holds every sample
+# due by then, like a device buffer would. Otherwise chunks are yielded as fast as they are consumed.
+class GDFReplaySource:
+    def __init__(self, file_path: str, desired_channels: list = [], chunk_duration: float = 0.04, realtime: bool = True):
+        import mne
+        raw = mne.io.read_raw_gdf(file_path, preload=True, verbose=False)
+        if len(desired_channels) > 0:
+            raw.pick_channels(desired_channels)
+        self.sfreq = raw.info['sfreq']
+        self.ch_names = list(raw.ch_names)
+        self.data = raw.get_data()
+        self.chunk_samples = max(1, int(round(chunk_duration * self.sfreq)))
+        self.realtime = realtime
+
+    def __iter__(self):
+        n_samples = self.data.shape[1]
+        position = 0
+        started_at = time.perf_counter()
+        while position < n_samples:
+            end = min(position + self.chunk_samples, n_samples)
+            if self.realtime:
+                due_at = started_at + end / self.sfreq
+                now = time.perf_counter()
+                if now < due_at:
+                    time.sleep(due_at - now)
+                else:
+                    end = min(max(end, int((now - started_at) * self.sfreq)), n_samples)
+            yield self.data[:, position:end]
+            position = end
+
+# Samples received from a TCP socket as little endian float32 frames, one value per channel per sample (interleaved).
+# Each iteration returns every complete frame available, so a late consumer gets the backlog at once instead of lagging behind.
+class SocketSource:
+    def __init__(self, host: str, port: int, n_channels: int, sfreq: float, ch_names: list = None, buffer_size: int = 1 << 20):
+        self.host = host
+        self.port = port
+        self.sfreq = sfreq
+        self.ch_names = ch_names or [f'Ch{index}' for index in range(n_channels)]
+        self.frame_size = 4 * n_channels
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        with socket.create_connection((self.host, self.port)) as connection:
+            remainder = b''
+            while True:
+                data = connection.recv(self.buffer_size)
+                if len(data) == 0:
+                    return
+                data = remainder + data
+                n_frames = len(data) // self.frame_size
+                remainder = data[n_frames * self.frame_size:]
+                if n_frames > 0:
+                    yield np.frombuffer(data[:n_frames * self.frame_size], dtype='<f4').reshape(n_frames, -1).T.astype(float)
+
+# Serve the chunks of `source` to the first client connecting on `port`, in the SocketSource format. Used to test a live setup with a recording.
+def replay_to_socket(source, port: int, host: str = '127.0.0.1'):
+    with socket.create_server((host, port)) as server:
+        log(f'Waiting for a client on {host}:{port}')
+        connection, address = server.accept()
+        with connection:
+            log(f'Streaming to {address}')
+            for chunk in source:
+                connection.sendall(np.ascontiguousarray(chunk.T, dtype='<f4').tobytes())
+
+# Run a source through the filter (if any) and the streaming GAF.
+# Yields {"end_sample", "gasf", "gadf", "latency"} for each image, latency being the seconds from receiving the chunk to the image being ready.
+# max_lag: images read out per chunk, see StreamingGAF.push. With 1 the work per chunk is bounded whatever the backlog, so latency stays bounded.
+def stream_images(source, streaming_gaf: StreamingGAF, stream_filter: StreamFilter = None, max_lag: int = 1):
+    for chunk in source:
+        received_at = time.perf_counter()
+        if stream_filter is not None:
+            chunk = stream_filter(chunk)
+        for end_sample, gasf, gadf in streaming_gaf.push(chunk, max_images=max_lag):
+            yield {"end_sample": end_sample, "gasf": gasf, "gadf": gadf, "latency": time.perf_counter() - received_at}
+
+# Ex.: python src/Streaming.py datasets/B0101T.gdf --window 2 --hop 0.25 --image-size 50 --realtime
+#      python src/Streaming.py datasets/B0101T.gdf --serve 5000 --realtime   and in another shell
+#      python src/Streaming.py --connect 127.0.0.1:5000 --sfreq 250 --channels 3 --window 2 --hop 0.25 --image-size 50
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming GAF images over a sliding window.')
+    parser.add_argument('file', metavar='File', type=str, nargs='?', default=None, help='GDF recording played back as a live stream')
+    parser.add_argument('--connect', dest='connect', type=str, default=None, help='host:port of a SocketSource stream instead of a file')
+    parser.add_argument('--serve', dest='serve', type=int, default=None, help='Play the file on this TCP port instead of processing it')
+    parser.add_argument('--sfreq', dest='sfreq', type=float, default=250, help='Sampling frequency of the --connect stream in Hz (default: 250)')
+    parser.add_argument('--channels', dest='n_channels', type=int, default=3, help='Number of channels of the --connect stream (default: 3)')
+    parser.add_argument('--pick', dest='channels', type=str, nargs='+', default=['EEG:C3', 'EEG:C4', 'EEG:Cz'], help='Channels of the file (default: EEG:C3 EEG:C4 EEG:Cz)')
+    parser.add_argument('--realtime', dest='realtime', action='store_true', help='Play the file at the pace of the recording')
+    parser.add_argument('--window', dest='window', type=float, default=2, help='Window duration in seconds (default: 2)')
+    parser.add_argument('--hop', dest='hop', type=float, default=0.25, help='Time between images in seconds (default: 0.25)')
+    parser.add_argument('--image-size', dest='image_size', type=int, default=None, help='Image size, PAA downsampling (default: one pixel per sample)')
+    parser.add_argument('--scaling', dest='scaling', type=str, default='running', choices=SCALINGS, help='Rescaling of the samples (default: running)')
+    parser.add_argument('--value-range', dest='value_range', type=float, nargs=2, default=None, help='Amplitude range for --scaling fixed, e.g. -5e-5 5e-5')
+    parser.add_argument('--max-lag', dest='max_lag', type=int, default=1, help='Images read out per chunk when the stream is behind (default: 1)')
+    parser.add_argument('--output-folder', dest='output_folder', type=str, default=None, help='Save the images as PNG files in this folder')
+    args = parser.parse_args()
+
+    if args.connect is not None:
+        host, port = args.connect.rsplit(':', 1)
+        source = SocketSource(host, int(port), args.n_channels, args.sfreq)
+    else:
+        source = GDFReplaySource(args.file, args.channels, realtime=args.realtime)
+    if args.serve is not None:
+        replay_to_socket(source, args.serve)
+        raise SystemExit(0)
+
+    streaming_gaf = StreamingGAF(len(source.ch_names), int(round(args.window * source.sfreq)), int(round(args.hop * source.sfreq)), image_size=args.image_size,
+                                 scaling=args.scaling, value_range=args.value_range)
+    writer = None if args.output_folder is None else ImageWriter(cmap='viridis')
+    latencies = []
+    try:
+        for image in stream_images(source, streaming_gaf, StreamFilter(source.sfreq, len(source.ch_names)), max_lag=args.max_lag):
+            latencies.append(image["latency"])
+            if writer is not None:
+                writer.save_batch(args.output_folder, [f'stream-{image["end_sample"]}-Ch-{channel}' for channel in source.ch_names], image["gasf"])
+    finally:
+        if writer is not None:
+            writer.close()
+    if len(latencies) > 0:
+        log(f'{len(latencies)} images, latency median {np.median(latencies) * 1000:.2f} ms, max {np.max(latencies) * 1000:.2f} ms, '
+            f'updates {streaming_gaf.updates}')
@@ -0,0 +1,127 @@
+import argparse
+import numpy as np
+
+# Python 3.8.2
+
+__all__ = ["synthetic_recording", "write_gdf", "generate_gdf_file"]
+
+# Deterministic synthetic motor imagery recordings, laid out like the BCI competition IV 2b files
+# (http://www.bbci.de/competition/iv/desc_2b.pdf): a trial every `trial_interval` seconds starting with a "768" (start of trial)
+# event and a cue ("769" left hand, "770" right hand) `cue_delay` seconds later.
+# Used to benchmark and try the pipeline without the competition files, no network needed.
+
+# Channel names of the BCI competition IV 2b files, see `TS2Image.__desired_channels_for_file`
+DEFAULT_CHANNELS = ['EEG:C3', 'EEG:Cz', 'EEG:C4']
+
+DESCRIPTION_START_TRIAL = "768"
+DESCRIPTION_CUE_LEFT = "769"
+DESCRIPTION_CUE_RIGHT = "770"
+
+# Motor imagery decreases the mu rhythm over the opposite hemisphere (event-related desynchronization),
+# so the ERSP images of both classes differ: C4 for the left hand and C3 for the right hand.
+CONTRALATERAL_CHANNEL = {DESCRIPTION_CUE_LEFT: "C4", DESCRIPTION_CUE_RIGHT: "C3"}
+
+# Returns (data, ch_names, events): data.shape = (n_channels, n_samples) in volts and events is a list of (onset in seconds, description).
+# The same arguments always give the same recording.
+# Each channel is 1/f background noise plus a 10 Hz mu and a 20 Hz beta rhythm, attenuated during the imagery period
+# (`imagery_duration` seconds after the cue) on the channel contralateral to the cued hand.
+def synthetic_recording(n_channels: int = 3, sfreq: float = 250, duration: float = 300, trial_interval: float = 8.0, cue_delay: float = 3.0,
+                        imagery_duration: float = 4.0, cue_descriptions: tuple = (DESCRIPTION_CUE_LEFT, DESCRIPTION_CUE_RIGHT), seed: int = 0):
+    rng = np.random.default_rng(seed)
+    n_samples = int(round(duration * sfreq))
+    times = np.arange(n_samples) / sfreq
+    ch_names = DEFAULT_CHANNELS[:n_channels] + [f'EEG:{index}' for index in range(len(DEFAULT_CHANNELS), n_channels)]
+
+    # 1/f background: shape white noise in the frequency domain
+    spectrum = np.fft.rfft(rng.standard_normal((n_channels, n_samples)), axis=-1)
+    freqs = np.fft.rfftfreq(n_samples, d=1 / sfreq)
+    spectrum[:, 1:] /= np.sqrt(freqs[1:])
+    spectrum[:, 0] = 0
+    background = np.fft.irfft(spectrum, n=n_samples, axis=-1)
+    background *= 10e-6 / background.std(axis=-1, keepdims=True)
+
+    events = []
+    # Rhythm amplitude of each channel over time, 1 outside the imagery periods
+    modulation = np.ones((n_channels, n_samples))
+    for trial_start in np.arange(0, duration - cue_delay - imagery_duration, trial_interval):
+        cue = str(rng.choice(cue_descriptions))
+        cue_onset = trial_start + cue_delay
+        events += [(float(trial_start), DESCRIPTION_START_TRIAL), (float(cue_onset), cue)]
+        for channel_index, channel_name in enumerate(ch_names):
+            if channel_name.split(':')[-1] == CONTRALATERAL_CHANNEL.get(cue):
+                first, last = int(round(cue_onset * sfreq)), int(round((cue_onset + imagery_duration) * sfreq))
+                modulation[channel_index, first:last] = 0.4
+
+    phases = rng.uniform(0, 2 * np.pi, size=(2, n_channels, 1))
+    mu = 8e-6 * np.sin(2 * np.pi * 10 * times + phases[0])
+    beta = 3e-6 * np.sin(2 * np.pi * 20 * times + phases[1])
+    data = background + modulation * (mu + beta)
+    return data, ch_names, events
+
+# Write a GDF 1.25 file readable by `mne.io.read_raw_gdf`, with int16 samples in uV like the competition files
+# and the events in the event table, so they are loaded as annotations.
+# data: ndarray, shape (n_channels, n_samples) in volts. events: list of (onset in seconds, description), descriptions must be integer codes.
+# The recording is padded with zeros to a whole number of 1 second data records, `sfreq` must be an integer.
+def write_gdf(file_path: str, data: np.ndarray, sfreq: float, ch_names: list, events: list, physical_range: float = 500.0):
+    if sfreq != int(sfreq):
+        raise ValueError(f'Sampling frequency must be an integer, got {sfreq}')
+    sfreq = int(sfreq)
+    n_channels, n_samples = data.shape
+    n_records = -(-n_samples // sfreq)
+    header_length = 256 * (1 + n_channels)
+    digital_max = 32767
+
+    def text(value: str, length: int) -> bytes:
+        return value.encode('latin-1')[:length].ljust(length, b' ')
+
+    # Fixed header
+    header = text("GDF 1.25", 8) + text("X X", 80) + text("Synthetic recording", 80) + text("20050101120000 00", 16)
+    header += np.array([header_length], '<i8').tobytes() + bytes(24 + 20)
+    header += np.array([n_records], '<i8').tobytes() + np.array([1, 1], '<u4').tobytes() + np.array([n_channels], '<u4').tobytes()
+    # Variable header, one field for all the channels at a time
+    header += b''.join(text(name, 16) for name in ch_names)
+    header += b''.join(text("", 80) for _ in ch_names)
+    header += b''.join(text("uV", 8) for _ in ch_names)
+    header += np.full(n_channels, -physical_range, '<f8').tobytes() + np.full(n_channels, physical_range, '<f8').tobytes()
+    header += np.full(n_channels, -digital_max, '<i8').tobytes() + np.full(n_channels, digital_max, '<i8').tobytes()
+    header += b''.join(text("HP:0.5Hz LP:100Hz", 80) for _ in ch_names)
+    # Samples per record and data type (3 = int16) of each channel
+    header += np.full(n_channels, sfreq, '<i4').tobytes() + np.full(n_channels, 3, '<i4').tobytes()
+    header += bytes(32 * n_channels)
+    assert len(header) == header_length
+
+    # Data records: each record holds `sfreq` samples of every channel, channel after channel
+    samples = np.zeros((n_channels, n_records * sfreq), dtype='<i2')
+    samples[:, :n_samples] = np.clip(np.round(data * 1e6 / physical_range * digital_max), -digital_max, digital_max)
+    records = samples.reshape(n_channels, n_records, sfreq).transpose(1, 0, 2)
+
+    # Event table (mode 1): positions are 1-based sample indexes
+    positions = np.array([int(round(onset * sfreq)) + 1 for onset, _ in events], '<u4')
+    types = np.array([int(description) for _, description in events], '<u2')
+    event_table = np.array([1], '<u1').tobytes() + np.array([sfreq], '<u4').tobytes()[:3]
+    event_table += np.array([len(events)], '<u4').tobytes() + positions.tobytes() + types.tobytes()
+
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(records).tobytes())
+        f.write(event_table)
+    return file_path
+
+# Generate a synthetic recording (see `synthetic_recording` for the arguments) and write it to `file_path` as GDF.
+def generate_gdf_file(file_path: str, n_channels: int = 3, sfreq: float = 250, duration: float = 300, seed: int = 0, **kwargs):
+    data, ch_names, events = synthetic_recording(n_channels=n_channels, sfreq=sfreq, duration=duration, seed=seed, **kwargs)
+    return write_gdf(file_path, data, sfreq, ch_names, events)
+
+# Ex.: python src/SyntheticEEG.py datasets/B0101T.gdf --duration 600
+# Name the files like the competition ones (B*T.gdf) to process them with main.py
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic motor imagery GDF recordings.')
+    parser.add_argument('files', metavar='File', type=str, nargs='+', help='GDF files to write')
+    parser.add_argument('--channels', dest='n_channels', type=int, default=3, help='Number of channels (default: 3)')
+    parser.add_argument('--sfreq', dest='sfreq', type=int, default=250, help='Sampling frequency in Hz (default: 250)')
+    parser.add_argument('--duration', dest='duration', type=float, default=300, help='Recording duration in seconds (default: 300)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Random seed of the first file, incremented for each file (default: 0)')
+    args = parser.parse_args()
+    for file_index, file_path in enumerate(args.files):
+        generate_gdf_file(file_path, n_channels=args.n_channels, sfreq=args.sfreq, duration=args.duration, seed=args.seed + file_index)
+        print(f'Wrote {file_path}')
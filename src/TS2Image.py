@@ -1,13 +1,60 @@
-from multiprocessing import Process
+import multiprocessing
 from GAF import GAF
-from Logger import log
-from ERSP import ERSP
+from Logger import log, set_verbosity, get_verbosity, set_log_file, get_log_file, QUIET, DEBUG
+from Metrics import Metrics, metrics
+from ERSP import ERSP, FREQS, DECIM
+from ArraySink import build_manifest, merge_manifests
+from Sharding import shard_items, shard_name
+from Catalog import Catalog, estimate_epochs, epoch_events
+from Dataset import ImageDataset
+from BuildCache import BuildCache
+from Preprocessing import preprocess_file, L_FREQ, H_FREQ
+from Quantization import parse_dtype, QUANTIZE_MODES
+from Significance import SIGNIFICANCE_MODES, N_PERMUTATIONS
+import glob
 import os
+import re
+import time
+import traceback
 
 # Python 3.8.2
 
 __all__ = ["TS2Image"]
 
+# Epoch window of each method around the events, in seconds: GAF uses [t_start, t_start + duration] and ERSP [t_start, duration].
+# GAF crops (see GAF.generate_images) extend the window by (n_crops - 1) * crop_stride.
+def _method_window(method: str, t_start, duration, n_crops: int = 1, crop_stride: float = 0) -> tuple:
+    return (t_start, t_start + duration + (n_crops - 1) * crop_stride) if method == "GAF" else (t_start, duration)
+
+# Multitaper kernel banks shared by the ERSP jobs of every worker and run, inside the output folder, see Spectral.KernelCache
+KERNEL_CACHE_FOLDER = '.ts2image-kernels'
+
+# Heavy modules the jobs need, imported once by the fork server instead of once per worker, see `_worker_context`
+WORKER_PRELOAD = ["mne", "scipy.signal", "scipy.fft", "matplotlib.pyplot", "Preprocessing", "GAF", "ERSP"]
+
+# Seconds between the creation of the pool and the start of this worker, reported with its first job, see `_run_job`
+_worker_startup = None
+
+# Workers are forked from a fork server that imported WORKER_PRELOAD once, so they start warm: nothing is imported again per worker,
+# and unlike a plain fork they don't inherit the parent's threads (e.g. the ImageWriter pools) or state.
+# Only call this when a pool is needed: it starts the server right away, which imports in the background.
+# Where there is no fork server (Windows) the workers are spawned and import everything themselves.
+def _worker_context():
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    from multiprocessing import forkserver
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(WORKER_PRELOAD)
+    forkserver.ensure_running()
+    return context
+
+# Worker processes don't share the parent's logging settings when they are spawned
+def _init_worker(verbosity: int, log_file: str, pool_created_at: float):
+    global _worker_startup
+    _worker_startup = time.time() - pool_created_at
+    set_verbosity(verbosity)
+    set_log_file(log_file)
+
 # Use public method `generate_images` to process time series files into images
 class TS2Image:
     def __init__(self, input_folder: str, output_folder: str):
@@ -27,7 +74,7 @@ class TS2Image:
     def __custom_filter(self, file:str):
         # Note: Change your filter here
         should_include_file = self.__bci_competition_b(file)
-        log(f"should_include_file: {file}: {should_include_file}")
+        log(f"should_include_file: {file}: {should_include_file}", level=DEBUG)
         return should_include_file
     
     # http://www.bbci.de/competition/iv/desc_2b.pdf
@@ -52,27 +99,124 @@ class TS2Image:
             return ['EEG:C3', 'EEG:C4', 'EEG:Cz']
 
     # Helper function to generate the images. Serve kind as a facade.
-    def __generate_images(self, files_dir: str, file_name: str, output_folder: str, method: str, events_descriptions_to_process: list, t_start, duration, events_dictionary: dict):
+    # The file is loaded, picked, filtered and epoched once and the epochs are reused by every method.
+    # The paths generated by each method are added to `outputs`, i.e. {method: [paths]}, as soon as the method finishes.
+    def __generate_images(self, files_dir: str, file_name: str, output_folder: str, methods: list, outputs: dict, events_descriptions_to_process: list, t_start, duration, events_dictionary: dict, output_format: str = "png", lazy: bool = False, per_trial: bool = False, image_size: int = None, packed: bool = False,
+                          dtype: str = None, quantize: str = None, n_crops: int = 1, crop_stride: float = 0,
+                          significance: str = None, n_permutations: int = N_PERMUTATIONS, significance_seed: int = 0, significance_workers: int = None):
         # Set desired channels
         desired_channels = self.__desired_channels_for_file(file_name)
 
         file_full_path = f'{files_dir}/{file_name}'
         log(f'Started {file_full_path}...')
-        log(f"Working on {method.upper()}")
-        if method.upper() == "GAF":
-            gaf = GAF(file_path=file_full_path, valid_events_descriptions=events_descriptions_to_process, cue_map=events_dictionary)
-            gaf.generate_images(output_folder=output_folder, t_start=t_start, duration=duration, generate_intermediate_images=True, generate_difference_images=False, desired_channels=desired_channels, merge_channels=False)
-        else:
-            ersp = ERSP(file_path=file_full_path)
-            ersp.generate_images(output_folder=output_folder, desired_events=events_descriptions_to_process, t_start=t_start, t_end=duration, generate_intermediate_images=True, desired_channels=desired_channels, merge_channels=False)
+
+        # Methods use different windows around each event (see `_method_window`), so epoch the union of them.
+        # Each method only uses the epochs where its own window fits in the recording, like running it alone.
+        tmaxs = [_method_window(method, t_start, duration, n_crops, crop_stride)[1] for method in methods]
+        recording = preprocess_file(file_full_path, desired_channels, events_descriptions_to_process, tmin=t_start, tmax=max(tmaxs), lazy=lazy, dtype=parse_dtype(dtype),
+                                    min_tmax=min(tmaxs))
+
+        for method in methods:
+            log(f"Working on {method}")
+            if len(methods) > 1:
+                log(f'Reusing the preprocessed epochs of {file_name} for {method} (shared by {", ".join(methods)})')
+            if method == "GAF":
+                gaf = GAF(file_path=file_full_path, valid_events_descriptions=events_descriptions_to_process, cue_map=events_dictionary)
+                outputs[method] = gaf.generate_images_from_epochs(recording, output_folder=output_folder, t_start=t_start, duration=duration, generate_intermediate_images=True, generate_difference_images=False, merge_channels=False, output_format=output_format, image_size=image_size, packed=packed, dtype=dtype, quantize=quantize, n_crops=n_crops, crop_stride=crop_stride)
+            else:
+                ersp = ERSP(file_path=file_full_path)
+                outputs[method] = ersp.generate_images_from_epochs(recording, output_folder=output_folder, desired_events=events_descriptions_to_process, t_start=t_start, t_end=duration, generate_intermediate_images=True, merge_channels=False, output_format=output_format, per_trial=per_trial, dtype=dtype, quantize=quantize,
+                                                                   significance=significance, n_permutations=n_permutations, significance_seed=significance_seed,
+                                                                   significance_workers=significance_workers, kernel_cache_folder=f'{output_folder}/{KERNEL_CACHE_FOLDER}')
 
         log(f'Finished {file_full_path}!')
 
-    # Set the method you want to use. Accepted values: GAF, ERSP
+    # Everything that changes the outputs of a (file, method) job. Used to key the build cache.
+    # `lazy` and `significance_workers` are ignored on purpose: they only change how the work is done, not the result.
+    def __job_parameters(self, file_name: str, method: str, events_descriptions_to_process: list, t_start, duration, events_dictionary: dict, output_format: str, lazy: bool, per_trial: bool, image_size: int, packed: bool, dtype: str, quantize: str, n_crops: int, crop_stride: float,
+                         significance: str, n_permutations: int, significance_seed: int, significance_workers: int):
+        is_significance_tested = significance is not None and method.upper() == "ERSP"
+        return {
+            "method": method.upper(),
+            "channels": self.__desired_channels_for_file(file_name),
+            "t_start": t_start,
+            "duration": duration,
+            "filter": [L_FREQ, H_FREQ],
+            "events": {description: events_dictionary.get(description) for description in events_descriptions_to_process},
+            "output_format": output_format,
+            "per_trial": per_trial and method.upper() == "ERSP",
+            "image_size": image_size if method.upper() == "GAF" else None,
+            "packed": packed and method.upper() == "GAF",
+            "dtype": None if dtype is None else parse_dtype(dtype).name,
+            "quantize": quantize,
+            "crops": [n_crops, crop_stride] if method.upper() == "GAF" and n_crops > 1 else None,
+            "significance": [significance, n_permutations, significance_seed] if is_significance_tested else None,
+        }
+
+    # Process a single (file, methods) job. Errors are caught and returned so one bad file doesn't stop the whole run.
+    # This runs inside the worker processes when `n_workers > 1`, so it must only return picklable values.
+    # The stage timers and counters of the job are returned in "metrics", see Metrics.drain.
+    # "startup": seconds the worker took to start, in the first result of each worker, None otherwise.
+    # Not name mangled on purpose: the pool pickles this bound method by name.
+    def _run_job(self, job: tuple):
+        global _worker_startup
+        startup, _worker_startup = _worker_startup, None
+        file_name, methods, kwargs = job
+        started_at = time.perf_counter()
+        error = None
+        # Outputs of the methods that finished, kept even if a later method fails
+        outputs = {}
+        # Drop anything recorded outside a job, e.g. by a previous run in this process
+        metrics.drain()
+        try:
+            with metrics.file(file_name):
+                self.__generate_images(self.input_folder, file_name, self.output_folder, methods=methods, outputs=outputs, **kwargs)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}\n{traceback.format_exc()}'
+        return {"file": file_name, "methods": methods, "error": error, "elapsed": time.perf_counter() - started_at, "cached": False, "outputs": outputs,
+                "metrics": metrics.drain(), "startup": startup}
+
+    # Set the method you want to use. Accepted values: GAF, ERSP, or a list of them e.g. ["GAF", "ERSP"].
+    # With several methods each file is loaded, filtered and epoched once and the epochs are shared by all methods.
     # events_dictionary: a dictionary specifying the ALL the data set events' identifier and description. This is optional only needed by GAF class to get the description to create folders to save the generate images. This is not used by ERSP class.
-    def generate_images(self, method: str, valid_events_descriptions: list, events_dictionary: dict, t_start, duration):
-        # if not method == "GAF":
-        #     raise Exception(f'Method {method} not supported yet')
+    # n_workers: number of worker processes. Each file (with all its methods) is processed by one worker; 1 runs everything in this process.
+    # output_format: "png" writes one image file per image, "npy" writes dense array shards (see ArraySink) and a `manifest.json` index in the output folder.
+    # use_cache: skip the (file, method) pairs whose outputs were already generated from the same file content and parameters (see BuildCache).
+    # lazy: read only the desired channels around each event instead of loading the whole recordings, for files larger than memory.
+    # per_trial: ERSP only, save one image per trial instead of one average image per event.
+    # image_size: GAF only, width and height of the images. The epochs are downsampled with PAA first, None keeps one pixel per sample.
+    # packed: GAF with "npy" only, store the upper triangle of the fields instead of the full matrices, see GAF.generate_images.
+    # dtype: precision of the epochs, transforms and float outputs: float64 (None), float32 or float16 (computed in float32, only the outputs are float16).
+    # quantize: "uint8" or "rgb" to save 8 bit images over a fixed value range instead of float maps, see GAF.generate_images and ERSP.generate_images.
+    # n_crops, crop_stride: GAF only, `n_crops` overlapping windows of `duration` seconds per trial, `crop_stride` seconds apart, see GAF.generate_images.
+    # significance: ERSP only, "mask" or "apply" the cluster permutation test masks of the event averages, see ERSP.generate_images.
+    # n_permutations, significance_seed: of each test. significance_workers: processes running the tests of each file, None for one per core.
+    # The tests run in parallel only with n_workers = 1: worker processes can't start pools of their own, there the files are the parallel units.
+    # metrics_report: where the time spent in each stage (load, filter, epoch, transform, significance, encode, write) and the counters of every file are saved at the end of the run,
+    # relative to the output folder. CSV if it ends with .csv, JSON otherwise. None doesn't save them, the totals are logged anyway.
+    # shard: (i, N) to process only the i-th of N parts of the files (i from 0), e.g. one per node of a cluster sharing the output folder.
+    # The parts are balanced by the number of epochs estimated from the catalog and only depend on the input files, so every node computes the same partition without a coordinator.
+    # Each shard keeps its own build cache and metrics report, and with "npy" writes a partial index `manifest-shard-i-of-N.json`
+    # instead of `manifest.json`. Run `merge_shards` once every shard finished to combine them.
+    # select: only process the files whose catalog entry matches this predicate, see `plan`.
+    # Files that can't be processed (missing channels or labels, see `plan`) are reported as failed without being loaded.
+    # Returns the list of job results, i.e. {"file", "methods", "error", "elapsed", "cached", "outputs", "metrics", "startup"} for each file, where outputs is {method: [paths]}.
+    def generate_images(self, method, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, n_workers: int = 1, output_format: str = "png", use_cache: bool = True, lazy: bool = False, per_trial: bool = False, image_size: int = None,
+                        packed: bool = False, metrics_report: str = "metrics.json", shard: tuple = None, select=None,
+                        dtype: str = None, quantize: str = None, n_crops: int = 1, crop_stride: float = 0,
+                        significance: str = None, n_permutations: int = N_PERMUTATIONS, significance_seed: int = 0, significance_workers: int = None):
+        methods = self.__methods(method)
+        if n_crops < 1 or (n_crops > 1 and crop_stride <= 0):
+            raise ValueError(f'Crops need n_crops >= 1 and a positive stride, got {n_crops} crops every {crop_stride} s')
+        parse_dtype(dtype)
+        if quantize not in QUANTIZE_MODES:
+            raise ValueError(f'Quantization {quantize} not supported. Accepted values: uint8, rgb')
+        if significance not in SIGNIFICANCE_MODES:
+            raise ValueError(f'Significance {significance} not supported. Accepted values: mask, apply')
+        if significance is not None and per_trial and "ERSP" in methods:
+            raise ValueError('Significance masks are computed for the ERSP event averages, they can\'t be used with per_trial')
+        if packed and output_format != "npy":
+            raise ValueError('Packed triangular images are only supported by the npy output format')
         
         base_dir = os.getcwd()
         # Set the directory containing the files you want to process
@@ -81,15 +225,327 @@ class TS2Image:
         # Set the root output folder
         output_folder = base_dir + '/output'
 
-        files = self.__list_filtered_files(self.input_folder)
+        run_started_at = time.perf_counter()
+        run_metrics = Metrics()
+        all_plans = self.__plan(methods, valid_events_descriptions, events_dictionary, t_start, duration, select=select, n_crops=n_crops, crop_stride=crop_stride)
+        plans = self.__shard_plans(all_plans, shard)
+        files = [plan["file"] for plan in plans]
 
         log('!!! START !!!')
-        log(f"Method: {method}")
+        log(f"Methods: {methods}")
         log(f'Processing files inside: {self.input_folder}')
+        if shard is not None:
+            log(f'Shard {shard[0]}/{shard[1]}: {len(files)} of {len(all_plans)} files, '
+                f'{sum(sum(plan["epochs"].values()) for plan in plans)} of {sum(sum(plan["epochs"].values()) for plan in all_plans)} estimated epochs')
         log(f'Files: {files}')
 
-        for file in files:
-            self.__generate_images(self.input_folder, file, self.output_folder, method=method, t_start=t_start, duration=duration, events_descriptions_to_process=valid_events_descriptions, events_dictionary=events_dictionary)
+        job_kwargs = dict(t_start=t_start, duration=duration, events_descriptions_to_process=valid_events_descriptions, events_dictionary=events_dictionary, output_format=output_format, lazy=lazy, per_trial=per_trial, image_size=image_size, packed=packed, dtype=dtype, quantize=quantize, n_crops=n_crops, crop_stride=crop_stride,
+                          significance=significance, n_permutations=n_permutations, significance_seed=significance_seed, significance_workers=significance_workers)
+
+        # Skip the (file, method) pairs already generated with the same input and parameters
+        cache = self.__cache(shard)
+        job_keys = {}
+        results = []
+        jobs = []
+        for plan in plans:
+            file = plan["file"]
+            # Fail early, without starting a worker, when the catalog already tells the file can't be processed
+            if len(plan["problems"]) > 0:
+                results.append({"file": file, "methods": methods, "error": '; '.join(plan["problems"]), "elapsed": 0.0, "cached": False, "outputs": {}, "metrics": None, "startup": None})
+                self.__log_job_result(results[-1], len(results), len(files))
+                continue
+            pending_methods = []
+            cached_outputs = {}
+            for job_method in methods:
+                parameters = self.__job_parameters(file, job_method, **job_kwargs)
+                key = cache.key(f'{self.input_folder}/{file}', parameters)
+                job_keys[(file, job_method)] = (key, parameters)
+                if use_cache and cache.is_valid(key):
+                    cached_outputs[job_method] = cache.entries[key]["outputs"]
+                else:
+                    pending_methods.append(job_method)
+
+            if len(pending_methods) > 0:
+                jobs.append((file, pending_methods, job_kwargs))
+            else:
+                results.append({"file": file, "methods": methods, "error": None, "elapsed": 0.0, "cached": True, "outputs": cached_outputs, "metrics": None, "startup": None})
+                self.__log_job_result(results[-1], len(results), len(files))
+
+        try:
+            # Worker processes (and their fork server) only when there is more than one job left, a single job runs here
+            if n_workers > 1 and len(jobs) > 1:
+                log(f'Using {n_workers} worker processes')
+                with _worker_context().Pool(processes=min(n_workers, len(jobs)), initializer=_init_worker, initargs=(get_verbosity(), get_log_file(), time.time())) as pool:
+                    for result in pool.imap_unordered(self._run_job, jobs, chunksize=1):
+                        results.append(result)
+                        run_metrics.merge(result["metrics"])
+                        self.__record_job_result(cache, job_keys, result)
+                        self.__log_job_result(result, len(results), len(files))
+            else:
+                for job in jobs:
+                    result = self._run_job(job)
+                    results.append(result)
+                    run_metrics.merge(result["metrics"])
+                    self.__record_job_result(cache, job_keys, result)
+                    self.__log_job_result(result, len(results), len(files))
+        finally:
+            # Keep what was generated so far even if the run is interrupted
+            cache.save()
+
+        # Keep the report order stable regardless of which worker finished first
+        results.sort(key=lambda result: result["file"])
+        failed = [result for result in results if result["error"] is not None]
+        if len(failed) > 0:
+            log(f'{len(failed)} of {len(results)} jobs failed:', level=QUIET)
+            for result in failed:
+                log(f'{result["file"]} ({", ".join(result["methods"])}): {result["error"]}', level=QUIET)
+
+        wall_seconds = time.perf_counter() - run_started_at
+        log(f'Processed {len(results)} files ({len(failed)} failed) in {wall_seconds:.1f}s, time per stage (summed over workers):', level=QUIET)
+        for line in run_metrics.summary_lines():
+            log(f'  {line}', level=QUIET)
+        # Time from the creation of the pool to the start of each worker, including the fork server imports for the first ones
+        worker_startups = sorted(result["startup"] for result in results if result["startup"] is not None)
+        if len(worker_startups) > 0:
+            log(f'Worker startup: {len(worker_startups)} workers, median {worker_startups[len(worker_startups) // 2]:.2f}s, max {worker_startups[-1]:.2f}s', level=QUIET)
+        if metrics_report is not None:
+            jobs_summary = {result["file"]: {"elapsed": result["elapsed"], "cached": result["cached"], "failed": result["error"] is not None} for result in results}
+            os.makedirs(self.output_folder, exist_ok=True)
+            report_path = run_metrics.write_report(os.path.join(self.output_folder, self.__shard_file_name(metrics_report, shard)),
+                                                   extra={"methods": methods, "n_workers": n_workers, "wall_seconds": wall_seconds, "jobs": jobs_summary, "shard": shard,
+                                                          "worker_startup_seconds": worker_startups})
+            log(f'Metrics report available at: {report_path}')
+
+        if output_format == "npy":
+            if shard is None:
+                log(f'Dataset manifest available at: {build_manifest(self.output_folder)}')
+            else:
+                # Only the shards written (or cached) by this part, other nodes may still be writing theirs
+                manifest_paths = sorted(path for result in results for outputs in result["outputs"].values() for path in outputs if path.endswith('.json'))
+                manifest_path = build_manifest(self.output_folder, manifest_name=self.__shard_file_name('manifest.json', shard), manifest_paths=manifest_paths,
+                                               extra={"shard": {"index": shard[0], "count": shard[1], "files": files}})
+                log(f'Partial dataset manifest available at: {manifest_path}, combine the shards with `merge_shards` once they all finished')
 
         log(f'Generated images available at: {self.output_folder}')
         log('!!! FINISH !!!')
+        return results
+
+    # Plan a run from the dataset catalog (see Catalog): only the headers and event tables of the files are read, no signal is loaded,
+    # and files are only scanned again when they change. The catalog is saved to `.ts2image-catalog.json` in the output folder.
+    # The files are the ones accepted by the file name filter and by `select`, an optional predicate over their catalog entries,
+    # e.g. lambda entry: entry["sfreq"] == 250 and entry["events"].get("769", 0) > 0. shard: only plan this part of the files, see `generate_images`.
+    # Returns one dict per file: {"file", "sfreq", "duration", "channels", "events", "epochs", "problems"}, where epochs is {method: estimated number of epochs}
+    # and problems lists why the file would fail: missing channels, or (GAF) events without a label in `events_dictionary`.
+    # n_crops, crop_stride: GAF crops, see `generate_images`. They extend the GAF window, epochs still count trials, not crops.
+    def plan(self, method, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, select=None, shard: tuple = None,
+             n_crops: int = 1, crop_stride: float = 0) -> list:
+        plans = self.__plan(self.__methods(method), valid_events_descriptions, events_dictionary, t_start, duration, select=select, n_crops=n_crops, crop_stride=crop_stride)
+        return self.__shard_plans(plans, shard)
+
+    # What `generate_images` would do with the same arguments, from the catalog only (see `plan`): no signal is loaded and nothing is written.
+    # Returns one dict per file: {"file", "epochs", "problems", "cached", "outputs"}, where epochs is the number of epochs cut from the file,
+    # cached is {method: whether the build cache already has its outputs} and outputs is {method: [paths]}, the files the method would write
+    # (images, or shards and their manifests with "npy"), whether cached or not. Files with problems have no outputs.
+    # Paths follow the naming of GAF and ERSP as TS2Image runs them: one image per channel, GAF summation fields only.
+    def dry_run(self, method, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, output_format: str = "png", use_cache: bool = True,
+                per_trial: bool = False, image_size: int = None, packed: bool = False, shard: tuple = None, select=None, dtype: str = None, quantize: str = None,
+                n_crops: int = 1, crop_stride: float = 0, significance: str = None, n_permutations: int = N_PERMUTATIONS, significance_seed: int = 0) -> list:
+        methods = self.__methods(method)
+        # New or changed files are scanned in memory, the catalog file isn't updated
+        catalog = Catalog(f'{self.output_folder}/.ts2image-catalog.json')
+        plans = self.__shard_plans(self.__plan(methods, valid_events_descriptions, events_dictionary, t_start, duration, select=select, n_crops=n_crops, crop_stride=crop_stride,
+                                               catalog=catalog), shard)
+        cache = self.__cache(shard)
+        job_kwargs = dict(t_start=t_start, duration=duration, events_descriptions_to_process=valid_events_descriptions, events_dictionary=events_dictionary, output_format=output_format, lazy=False, per_trial=per_trial, image_size=image_size, packed=packed, dtype=dtype, quantize=quantize, n_crops=n_crops, crop_stride=crop_stride,
+                          significance=significance, n_permutations=n_permutations, significance_seed=significance_seed, significance_workers=None)
+        # Same epochs as `__generate_images`: the ones where the shortest of the methods' windows fits, each method using those where its own fits
+        min_tmax = min(_method_window(m, t_start, duration, n_crops, crop_stride)[1] for m in methods)
+
+        dry_runs = []
+        for plan in plans:
+            file = plan["file"]
+            entry = catalog.entry(f'{self.input_folder}/{file}')
+            dry_run = {"file": file, "epochs": estimate_epochs(entry, valid_events_descriptions, t_start, min_tmax), "problems": plan["problems"], "cached": {}, "outputs": {}}
+            if len(plan["problems"]) == 0:
+                for job_method in methods:
+                    key = cache.key(f'{self.input_folder}/{file}', self.__job_parameters(file, job_method, **job_kwargs))
+                    dry_run["cached"][job_method] = use_cache and cache.is_valid(key)
+                    epochs = epoch_events(entry, valid_events_descriptions, *_method_window(job_method, t_start, duration, n_crops, crop_stride))
+                    dry_run["outputs"][job_method] = self.__expected_outputs(job_method, file, entry, epochs, t_start, duration, events_dictionary, output_format,
+                                                                             per_trial, image_size, packed, quantize, n_crops, crop_stride, significance)
+            dry_runs.append(dry_run)
+        return dry_runs
+
+    # Paths written by one method for one file, see `dry_run`. epochs: from Catalog.epoch_events.
+    def __expected_outputs(self, method: str, file: str, entry: dict, epochs: list, t_start, duration, events_dictionary: dict, output_format: str,
+                           per_trial: bool, image_size: int, packed: bool, quantize: str, n_crops: int, crop_stride: float, significance: str) -> list:
+        sfreq = entry["sfreq"]
+        tmin, tmax = _method_window(method, t_start, duration)
+        n_times = int(round(tmax * sfreq)) - int(round(tmin * sfreq)) + 1
+        # {folder: [(image name, image shape)]}
+        images = {}
+        if method == "GAF":
+            size = n_times if image_size is None else min(image_size, n_times)
+            shape = (size * (size + 1) // 2,) if packed else (size, size) + ((3,) if quantize == "rgb" else ())
+            n_channels = len(self.__desired_channels_for_file(file))
+            for annotation_index, description, _ in epochs:
+                for crop in range(n_crops):
+                    name = f'size_{size}-{file}-Ann-{annotation_index}' + (f'-Crop-{crop}' if n_crops > 1 else '')
+                    images.setdefault(f'{self.output_folder}/GAF/summation/{events_dictionary[description]}', []).extend(
+                        (f'{name}-Ch-{channel}', shape) for channel in range(n_channels))
+        else:
+            import mne
+            # Channels are named in the order the recording keeps them when picked
+            channel_names = [entry["ch_names"][index] for index in mne.pick_channels(entry["ch_names"], include=self.__desired_channels_for_file(file))]
+            shape = (len(FREQS), len(range(0, n_times, DECIM))) + ((3,) if quantize == "rgb" else ())
+            suffixes = [(description, f'-Trial-{annotation_index}') for annotation_index, description, _ in epochs] if per_trial else \
+                       [(description, '') for description in dict.fromkeys(description for _, description, _ in epochs)]
+            for description, suffix in suffixes:
+                folder = f'{self.output_folder}/ERSP/{description}'
+                images.setdefault(folder, []).extend((f'{file}{suffix}-Ch-{channel}', shape) for channel in channel_names)
+                if significance == "mask":
+                    images.setdefault(f'{folder}/mask', []).extend((f'{file}{suffix}-Ch-{channel}', shape[:2]) for channel in channel_names)
+
+        paths = []
+        for folder, folder_images in images.items():
+            if output_format == "npy":
+                for shape in dict.fromkeys(shape for _, shape in folder_images):
+                    shard_path = f'{folder}/{file}-{"x".join(str(dim) for dim in shape)}'
+                    paths += [f'{shard_path}.npy', f'{shard_path}.json']
+            else:
+                paths += [f'{folder}/{name}.png' for name, _ in folder_images]
+        return paths
+
+    # Images of the input files computed in memory for a training loop, see Dataset.ImageDataset: no file is written unless `cache` is set,
+    # then the images are kept in npy shards under `cache_folder` and memory mapped on the next passes or runs.
+    # cache_folder: default `{output_folder}.dataset-cache`, next to the output folder and not in it, so its shards never end up
+    # in the manifest of a run with output_format="npy" (they don't have the same parameters).
+    # select: only the files whose catalog entry matches this predicate, see `plan`. Files with problems (e.g. missing channels) are skipped.
+    # The other arguments are passed to ImageDataset, e.g. image_size, batch_size, shuffle, seed, n_workers, prefetch.
+    def dataset(self, method: str, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, select=None, cache: bool = False, cache_folder: str = None, **kwargs) -> ImageDataset:
+        file_paths = []
+        for plan in self.plan(method, valid_events_descriptions, events_dictionary, t_start, duration, select=select):
+            if len(plan["problems"]) > 0:
+                log(f'Dataset: skipping {plan["file"]}: {"; ".join(plan["problems"])}')
+                continue
+            file_paths.append(f'{self.input_folder}/{plan["file"]}')
+        return ImageDataset(file_paths, method, valid_events_descriptions, events_dictionary, t_start, duration, desired_channels=self.__desired_channels_for_file,
+                            cache_folder=(cache_folder or f'{os.path.normpath(self.output_folder)}.dataset-cache') if cache else None, **kwargs)
+
+    # catalog: updated but not saved, e.g. by `dry_run`. None to update and save the catalog of the output folder.
+    def __plan(self, methods: list, valid_events_descriptions: list, events_dictionary: dict, t_start, duration, select=None, n_crops: int = 1, crop_stride: float = 0,
+               catalog: Catalog = None) -> list:
+        files = self.__list_filtered_files(self.input_folder)
+        save_catalog = catalog is None
+        if catalog is None:
+            catalog = Catalog(f'{self.output_folder}/.ts2image-catalog.json')
+        scanned = catalog.update([f'{self.input_folder}/{file}' for file in files])
+        if scanned > 0 and save_catalog:
+            catalog.save()
+        log(f'Catalog: {len(files)} files, {scanned} scanned')
+
+        plans = []
+        for file in files:
+            entry = catalog.entry(f'{self.input_folder}/{file}')
+            if select is not None and not select(entry):
+                continue
+            channels = self.__desired_channels_for_file(file)
+            problems = []
+            missing_channels = [channel for channel in channels if channel not in entry["ch_names"]]
+            if len(missing_channels) > 0:
+                problems.append(f'Missing channels {missing_channels}, the file has {entry["ch_names"]}')
+            if "GAF" in methods:
+                # GAF names the output folders after the labels
+                missing_labels = [description for description in valid_events_descriptions if description in entry["events"] and description not in events_dictionary]
+                if len(missing_labels) > 0:
+                    problems.append(f'No label in events_dictionary for the events {missing_labels}')
+            plans.append({
+                "file": file,
+                "sfreq": entry["sfreq"],
+                "duration": entry["duration"],
+                "channels": channels,
+                "events": {description: entry["events"].get(description, 0) for description in valid_events_descriptions},
+                "epochs": {method: estimate_epochs(entry, valid_events_descriptions, *_method_window(method, t_start, duration, n_crops, crop_stride)) for method in methods},
+                "problems": problems,
+            })
+
+        sampling_rates = sorted(set(plan["sfreq"] for plan in plans))
+        if len(sampling_rates) > 1:
+            log(f'Warning: the files have different sampling rates {sampling_rates}, image sizes will differ')
+        return plans
+
+    # Keep the plans of the files of one shard, balanced by estimated epochs (a deterministic function of the catalog)
+    def __shard_plans(self, plans: list, shard: tuple = None) -> list:
+        if shard is None:
+            return plans
+        weights = {plan["file"]: sum(plan["epochs"].values()) for plan in plans}
+        files = set(shard_items(list(weights), weights, *shard))
+        return [plan for plan in plans if plan["file"] in files]
+
+    def __methods(self, method) -> list:
+        methods = [method.upper()] if isinstance(method, str) else [m.upper() for m in method]
+        for m in methods:
+            if m not in ["GAF", "ERSP"]:
+                raise ValueError(f'Method {m} not supported. Accepted values: GAF, ERSP')
+        return methods
+
+    # Combine the partial indexes written by the N shards of a distributed run (see `generate_images`) into `manifest.json`.
+    # Raises ValueError if a shard didn't write its index yet, or if the output folder has indexes of runs with different N.
+    def merge_shards(self):
+        partial_manifests = {}
+        for path in glob.glob(f'{self.output_folder}/manifest-shard-*-of-*.json'):
+            match = re.fullmatch(r'manifest-shard-(\d+)-of-(\d+)\.json', os.path.basename(path))
+            if match is not None:
+                partial_manifests[(int(match.group(1)), int(match.group(2)))] = path
+        counts = set(count for _, count in partial_manifests)
+        if len(counts) != 1:
+            raise ValueError(f'Expected the partial manifests of one sharded run in {self.output_folder}, found shard counts: {sorted(counts)}')
+        count = counts.pop()
+        missing = [index for index in range(count) if (index, count) not in partial_manifests]
+        if len(missing) > 0:
+            raise ValueError(f'Shards {missing} of {count} didn\'t write their manifest yet')
+
+        manifest_path = merge_manifests(self.output_folder, [partial_manifests[(index, count)] for index in range(count)])
+        log(f'Merged {count} shards into: {manifest_path}')
+        return manifest_path
+
+    # Invalidate the build cache for `file_name` (a file inside the input folder), or for every file if None.
+    # The next `generate_images` call generates them again. shard: the cache of one shard, see `generate_images`.
+    def clear_cache(self, file_name: str = None, shard: tuple = None):
+        cache = self.__cache(shard)
+        removed = cache.invalidate(None if file_name is None else f'{self.input_folder}/{file_name}')
+        cache.save()
+        log(f'Invalidated {removed} cache entries')
+
+    # Drop the cache entries of input files that were changed or removed, deleting their outputs,
+    # and delete the outputs of earlier runs with other parameters that the later runs didn't overwrite.
+    def collect_cache_garbage(self, shard: tuple = None):
+        cache = self.__cache(shard)
+        removed, deleted = cache.garbage_collect()
+        cache.save()
+        log(f'Removed {removed} stale cache entries and deleted {deleted} files')
+
+    # Each shard of a distributed run has its own cache file, so nodes never write the same file
+    def __cache(self, shard: tuple = None):
+        if shard is None:
+            return BuildCache(self.output_folder)
+        return BuildCache(self.output_folder, cache_file_name=f'.ts2image-cache-{shard_name(*shard)}.json')
+
+    # e.g. metrics.json -> metrics-shard-0-of-4.json
+    def __shard_file_name(self, file_name: str, shard: tuple = None):
+        if shard is None:
+            return file_name
+        root, extension = os.path.splitext(file_name)
+        return f'{root}-{shard_name(*shard)}{extension}'
+
+    # Record the methods that finished, even if a later method of the same file failed
+    def __record_job_result(self, cache: BuildCache, job_keys: dict, result: dict):
+        for method, outputs in result["outputs"].items():
+            key, parameters = job_keys[(result["file"], method)]
+            cache.record(key, f'{self.input_folder}/{result["file"]}', method, parameters, outputs)
+
+    def __log_job_result(self, result: dict, done: int, total: int):
+        status = "OK" if result["error"] is None else "FAILED"
+        if result["cached"]:
+            status = "up to date"
+        log(f'[{done}/{total}] {result["file"]} ({", ".join(result["methods"])}): {status} in {result["elapsed"]:.1f}s')
@@ -0,0 +1,45 @@
+from functools import lru_cache
+import numpy as np
+
+# Python 3.8.2
+
+__all__ = ["triangular_indexes", "packed_length", "pack_triangular", "unpack_triangular"]
+
+# Compact storage of symmetric (GASF) and antisymmetric (GADF) matrices: only the upper triangle, diagonal included,
+# is kept, row by row, in a packed array of n * (n + 1) / 2 values instead of n^2.
+
+def packed_length(n: int) -> int:
+    return n * (n + 1) // 2
+
+# Row and column of each packed value, same order as np.triu_indices(n). Cached, they are reused for every image.
+@lru_cache(maxsize=16)
+def triangular_indexes(n: int):
+    rows, columns = np.triu_indices(n)
+    rows.flags.writeable = False
+    columns.flags.writeable = False
+    return rows, columns
+
+# matrices: ndarray, shape (..., n, n). Returns ndarray, shape (..., n * (n + 1) / 2).
+def pack_triangular(matrices: np.ndarray) -> np.ndarray:
+    rows, columns = triangular_indexes(matrices.shape[-1])
+    return matrices[..., rows, columns]
+
+# Expand packed matrices back to dense form.
+# packed: ndarray, shape (..., n * (n + 1) / 2). Returns ndarray, shape (..., n, n).
+# antisymmetric: the lower triangle is the negated upper one (GADF), otherwise a copy of it (GASF).
+# Unsigned integers are quantized values (see Quantization.quantize) whose range is centered on 0, so they are negated as max - value
+# (the lower triangle can then differ by one level from quantizing the negated values directly, because of rounding).
+def unpack_triangular(packed: np.ndarray, n: int, antisymmetric: bool = False) -> np.ndarray:
+    if packed.shape[-1] != packed_length(n):
+        raise ValueError(f'Expected {packed_length(n)} packed values for {n}x{n} matrices, got {packed.shape[-1]}')
+    rows, columns = triangular_indexes(n)
+    dense = np.empty(packed.shape[:-1] + (n, n), dtype=packed.dtype)
+    if not antisymmetric:
+        dense[..., columns, rows] = packed
+    elif np.issubdtype(packed.dtype, np.unsignedinteger):
+        dense[..., columns, rows] = np.iinfo(packed.dtype).max - packed
+    else:
+        dense[..., columns, rows] = -packed
+    # Written last so the diagonal keeps the stored values
+    dense[..., rows, columns] = packed
+    return dense
@@ -1,3 +1,4 @@
 from .Logger import log
 from .GAF import GAF
-from .ERSP import ERSP
\ No newline at end of file
+from .ERSP import ERSP
+from .Dataset import ImageDataset
\ No newline at end of file
@@ -1,3 +1,7 @@
+import time
+# Cold start: time from here until the pipeline is imported and ready, logged at startup
+started_at = time.perf_counter()
+
 import os
 current_working_directory = os.getcwd()
 
@@ -5,10 +9,58 @@ import argparse
 
 # TODO: Add other arguments to parser
 parser = argparse.ArgumentParser(description='Parse TS2Image parameters.')
-parser.add_argument('method', metavar='Method', type=str, nargs='?',
-                    help='Image generation method: GAF or ERSP')
+parser.add_argument('method', metavar='Method', type=str, nargs='*',
+                    help='Image generation methods: GAF and/or ERSP. With both, each file is loaded and filtered once (default: GAF)')
+parser.add_argument('--workers', dest='workers', type=int, default=1,
+                    help='Number of worker processes used to process the files in parallel (default: 1)')
+parser.add_argument('--output-format', dest='output_format', type=str, default='png', choices=['png', 'npy'],
+                    help='png: one image file per image; npy: dense array shards with a manifest (default: png)')
+parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                    help='Generate every file again, even the ones whose outputs are up to date')
+parser.add_argument('--cache-clear', dest='cache_clear', action='store_true',
+                    help='Invalidate the build cache of the output folder and exit')
+parser.add_argument('--cache-gc', dest='cache_gc', action='store_true',
+                    help='Delete the outputs of input files that were changed or removed and exit')
+parser.add_argument('--lazy', dest='lazy', action='store_true',
+                    help='Read only the desired channels around each event instead of loading whole recordings (for files larger than memory)')
+parser.add_argument('--per-trial', dest='per_trial', action='store_true',
+                    help='ERSP only: save one image per trial instead of one average image per event')
+parser.add_argument('--image-size', dest='image_size', type=int, default=None,
+                    help='GAF only: width and height of the images, the epochs are downsampled with PAA (default: one pixel per sample)')
+parser.add_argument('--packed', dest='packed', action='store_true',
+                    help='GAF with --output-format npy: store only the upper triangle of each field, about half the size')
+parser.add_argument('--crops', dest='n_crops', type=int, default=1,
+                    help='GAF only: number of overlapping windows per trial, --crop-stride seconds apart (default: 1)')
+parser.add_argument('--crop-stride', dest='crop_stride', type=float, default=0,
+                    help='GAF only: seconds between the starts of consecutive crops (default: 0)')
+parser.add_argument('--dtype', dest='dtype', type=str, default=None, choices=['float64', 'float32', 'float16'],
+                    help='Precision of the epochs, transforms and npy outputs (default: float64)')
+parser.add_argument('--quantize', dest='quantize', type=str, default=None, choices=['uint8', 'rgb'],
+                    help='Save 8 bit gray level or RGB images over a fixed value range (GAF [-1, 1], ERSP -100%% to +100%%) instead of float maps')
+parser.add_argument('--significance', dest='significance', type=str, default=None, choices=['mask', 'apply'],
+                    help='ERSP only: cluster permutation test of each event and channel, save the masks of the significant clusters next to the images (mask) or zero the rest of the images (apply)')
+parser.add_argument('--permutations', dest='n_permutations', type=int, default=1024,
+                    help='ERSP with --significance: sign flip permutations per test (default: 1024)')
+parser.add_argument('--seed', dest='significance_seed', type=int, default=0,
+                    help='ERSP with --significance: seed of the permutations (default: 0)')
+parser.add_argument('--significance-workers', dest='significance_workers', type=int, default=None,
+                    help='ERSP with --significance: processes running the tests of a file, with --workers 1 (default: one per core)')
+parser.add_argument('--shard', dest='shard', type=str, default=None,
+                    help='i/N: only process the i-th (from 0) of N parts of the files, balanced by estimated number of epochs. Run every shard with the same output folder')
+parser.add_argument('--merge-shards', dest='merge_shards', action='store_true',
+                    help='Combine the partial manifests written by every --shard run into manifest.json and exit')
+parser.add_argument('--catalog', dest='catalog', action='store_true',
+                    help='Print the plan of each file (sampling rate, duration, events, estimated epochs, problems) from the file headers only and exit')
+parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                    help='Print the files, epochs and output paths a run with these options would generate, from the file headers only, and exit')
+parser.add_argument('--verbosity', dest='verbosity', type=str, default='info', choices=['quiet', 'info', 'debug'],
+                    help='quiet: only errors and the run summary, info: one line per file and stage, debug: every image (default: info)')
+parser.add_argument('--log-file', dest='log_file', type=str, default=None,
+                    help='Append the log messages to this file instead of printing them')
+parser.add_argument('--metrics', dest='metrics_report', type=str, default='metrics.json',
+                    help='Stage timings and counters report saved in the output folder, CSV if it ends with .csv (default: metrics.json)')
 args = parser.parse_args()
-method = args.method or "GAF"
+methods = args.method or ["GAF"]
 
 # Python 3.8.2
 ##########################################################################
@@ -70,10 +122,47 @@ t_start = 0
 duration = 4 # imagery duration is 4 seconds
 
 ##########################################################################
-from TS2Image import TS2Image
-ts2i = TS2Image(input_folder=input_folder, output_folder=output_folder)
-ts2i.generate_images(method="GAF", valid_events_descriptions=valid_events_descriptions, events_dictionary=BCI_competition_dataset_events_dictionary, t_start=t_start, duration=duration)
-##########################################################################
-from Logger import log
-log('End main')
+# NOTE: The guard is required by multiprocessing: worker processes may re-import this module.
+if __name__ == '__main__':
+    from Logger import set_verbosity, set_log_file, QUIET, INFO, DEBUG
+    set_verbosity({'quiet': QUIET, 'info': INFO, 'debug': DEBUG}[args.verbosity])
+    set_log_file(args.log_file)
+    from TS2Image import TS2Image
+    from Sharding import parse_shard
+    from Logger import log
+    log(f'Startup: {time.perf_counter() - started_at:.2f}s')
+    shard = None if args.shard is None else parse_shard(args.shard)
+    ts2i = TS2Image(input_folder=input_folder, output_folder=output_folder)
+    if args.merge_shards:
+        ts2i.merge_shards()
+    elif args.catalog:
+        plans = ts2i.plan(method=methods, valid_events_descriptions=valid_events_descriptions, events_dictionary=BCI_competition_dataset_events_dictionary, t_start=t_start, duration=duration, shard=shard,
+                          n_crops=args.n_crops, crop_stride=args.crop_stride)
+        for plan in plans:
+            print(f'{plan["file"]}: {plan["sfreq"]:g} Hz, {plan["duration"]:.1f} s, channels {plan["channels"]}, events {plan["events"]}, epochs {plan["epochs"]}')
+            for problem in plan["problems"]:
+                print(f'    {problem}')
+        print(f'{len(plans)} files, {sum(sum(plan["epochs"].values()) for plan in plans)} epochs, {sum(len(plan["problems"]) > 0 for plan in plans)} with problems')
+    elif args.dry_run:
+        dry_runs = ts2i.dry_run(method=methods, valid_events_descriptions=valid_events_descriptions, events_dictionary=BCI_competition_dataset_events_dictionary, t_start=t_start, duration=duration, output_format=args.output_format, use_cache=args.use_cache, per_trial=args.per_trial, image_size=args.image_size, packed=args.packed, shard=shard, dtype=args.dtype, quantize=args.quantize, n_crops=args.n_crops, crop_stride=args.crop_stride, significance=args.significance, n_permutations=args.n_permutations, significance_seed=args.significance_seed)
+        for dry_run in dry_runs:
+            print(f'{dry_run["file"]}: {dry_run["epochs"]} epochs')
+            for problem in dry_run["problems"]:
+                print(f'    {problem}')
+            for method, paths in dry_run["outputs"].items():
+                print(f'    {method}: {len(paths)} files' + (' (cached, skipped)' if dry_run["cached"][method] else ''))
+                for path in paths:
+                    print(f'        {path}')
+        print(f'{len(dry_runs)} files, {sum(dry_run["epochs"] for dry_run in dry_runs)} epochs, '
+              f'{sum(len(paths) for dry_run in dry_runs for method, paths in dry_run["outputs"].items() if not dry_run["cached"][method])} files to generate')
+    elif args.cache_clear or args.cache_gc:
+        if args.cache_clear:
+            ts2i.clear_cache(shard=shard)
+        if args.cache_gc:
+            ts2i.collect_cache_garbage(shard=shard)
+    else:
+        ts2i.generate_images(method=methods, valid_events_descriptions=valid_events_descriptions, events_dictionary=BCI_competition_dataset_events_dictionary, t_start=t_start, duration=duration, n_workers=args.workers, output_format=args.output_format, use_cache=args.use_cache, lazy=args.lazy, per_trial=args.per_trial, image_size=args.image_size, packed=args.packed, dtype=args.dtype, quantize=args.quantize, n_crops=args.n_crops, crop_stride=args.crop_stride, significance=args.significance, n_permutations=args.n_permutations, significance_seed=args.significance_seed, significance_workers=args.significance_workers, metrics_report=args.metrics_report, shard=shard)
+    ##########################################################################
+    from Logger import log
+    log('End main')
 ##########################################################################
\ No newline at end of file
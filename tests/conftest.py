@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The modules of src/ import each other by name, like when main.py runs from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from SyntheticEEG import generate_gdf_file
+
+# Synthetic recordings named like the BCI competition IV 2b training files, so TS2Image accepts them
+@pytest.fixture(scope="session")
+def input_folder(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("datasets")
+    for seed, file_name in enumerate(["B0101T.gdf", "B0102T.gdf", "B0201T.gdf"]):
+        generate_gdf_file(str(folder / file_name), duration=60 + 10 * seed, seed=seed)
+    return str(folder)
@@ -0,0 +1,63 @@
+import json
+import os
+
+import numpy as np
+
+from ArraySink import ArraySink, load_shard, build_manifest
+from Triangular import pack_triangular
+
+# Images are streamed to one shard per folder and shape, and read back memory mapped with their metadata
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    left = rng.normal(size=(4, 8, 8))
+    right = rng.normal(size=(3, 8, 8)).astype(np.float32)
+    wide = rng.normal(size=(2, 8, 16))
+    with ArraySink('/data/B0101T.gdf', parameters={"method": "GAF"}) as sink:
+        for index, (folder, images) in enumerate([("Left", left), ("Right", right), ("Left", wide)]):
+            for image_index, image in enumerate(images):
+                sink.save(str(tmp_path / folder), f'image-{image_index}', image, metadata={"annotation": image_index, "group": index})
+
+    assert sorted(os.path.relpath(path, tmp_path) for path in sink.written) == sorted([
+        "Left/B0101T.gdf-8x8.npy", "Left/B0101T.gdf-8x8.json", "Right/B0101T.gdf-8x8.npy", "Right/B0101T.gdf-8x8.json",
+        "Left/B0101T.gdf-8x16.npy", "Left/B0101T.gdf-8x16.json"])
+    for folder, shape, expected in [("Left", "8x8", left), ("Right", "8x8", right), ("Left", "8x16", wide)]:
+        images, manifest = load_shard(str(tmp_path / folder / f'B0101T.gdf-{shape}.json'))
+        assert isinstance(images, np.memmap) and images.dtype == expected.dtype
+        np.testing.assert_array_equal(images, expected)
+        assert manifest["shape"] == list(expected.shape) and manifest["parameters"] == {"method": "GAF"}
+        assert [item["name"] for item in manifest["items"]] == [f'image-{index}' for index in range(len(expected))]
+        assert [item["annotation"] for item in manifest["items"]] == list(range(len(expected)))
+
+# The index lists every shard with its array path relative to the output folder, and ignores other JSON files
+def test_build_manifest(tmp_path):
+    for folder in ["b", "a"]:
+        with ArraySink(f'/data/{folder}.gdf') as sink:
+            sink.save(str(tmp_path / folder), 'image', np.zeros((2, 2)))
+    (tmp_path / "other.json").write_text(json.dumps({"not": "a shard"}))
+    with open(build_manifest(str(tmp_path))) as f:
+        index = json.load(f)
+    assert [shard["array"] for shard in index["shards"]] == ["a/a.gdf-2x2.npy", "b/b.gdf-2x2.npy"]
+    # Built again, the index doesn't list itself
+    with open(build_manifest(str(tmp_path))) as f:
+        assert len(json.load(f)["shards"]) == 2
+
+# Packed shards are expanded to the dense images by default, also when the channels are stacked, or kept packed with dense=False
+def test_packed_round_trip(tmp_path):
+    upper = np.random.default_rng(0).normal(size=(4, 3, 6, 6))
+    gasf = upper + upper.swapaxes(-1, -2)
+    gadf = upper - upper.swapaxes(-1, -2)
+    packing = {"layout": "upper", "size": 6}
+    with ArraySink('/data/B0101T.gdf') as sink:
+        for index in range(len(upper)):
+            sink.save(str(tmp_path / "summation"), f'image-{index}', pack_triangular(gasf[index]),
+                      packing=dict(packing, antisymmetric=False, dense_shape=[18, 6]))
+            sink.save_batch(str(tmp_path / "difference"), [f'image-{index}-Ch-{channel}' for channel in range(3)], pack_triangular(gadf[index]),
+                            packing=dict(packing, antisymmetric=True, dense_shape=[6, 6]))
+
+    images, manifest = load_shard(str(tmp_path / "summation" / "B0101T.gdf-3x21.json"))
+    np.testing.assert_array_equal(images, gasf.reshape(4, 18, 6))
+    images, manifest = load_shard(str(tmp_path / "difference" / "B0101T.gdf-21.json"))
+    np.testing.assert_array_equal(images, gadf.reshape(12, 6, 6))
+    images, manifest = load_shard(str(tmp_path / "difference" / "B0101T.gdf-21.json"), dense=False)
+    assert isinstance(images, np.memmap) and manifest["packing"]["antisymmetric"]
+    np.testing.assert_array_equal(images, pack_triangular(gadf).reshape(12, 21))
@@ -0,0 +1,78 @@
+import os
+
+from BuildCache import BuildCache
+
+PARAMETERS = {"method": "GAF", "t_start": -1, "duration": 3}
+
+def write(path, content: str) -> str:
+    with open(path, 'w') as f:
+        f.write(content)
+    return str(path)
+
+# The key changes with the file content and the parameters, not with the file name
+def test_key(tmp_path):
+    cache = BuildCache(str(tmp_path / "output"))
+    key = cache.key(write(tmp_path / "a.gdf", "data"), PARAMETERS)
+    assert cache.key(write(tmp_path / "b.gdf", "data"), PARAMETERS) == key
+    assert cache.key(str(tmp_path / "a.gdf"), dict(PARAMETERS, duration=4)) != key
+    write(tmp_path / "a.gdf", "other data")
+    assert cache.key(str(tmp_path / "a.gdf"), PARAMETERS) != key
+
+# An entry is valid while all its outputs exist, and survives a reload
+def test_record_and_reload(tmp_path):
+    cache = BuildCache(str(tmp_path / "output"))
+    input_file = write(tmp_path / "a.gdf", "data")
+    outputs = [write(tmp_path / f'image-{index}.png', "image") for index in range(2)]
+    key = cache.key(input_file, PARAMETERS)
+    assert not cache.is_valid(key)
+    cache.record(key, input_file, "GAF", PARAMETERS, outputs)
+    cache.save()
+
+    cache = BuildCache(str(tmp_path / "output"))
+    assert cache.is_valid(key)
+    os.remove(outputs[1])
+    assert not cache.is_valid(key)
+
+# A new entry for the same file and job supersedes the old one, invalidate forgets entries but keeps the outputs
+def test_supersede_and_invalidate(tmp_path):
+    cache = BuildCache(str(tmp_path / "output"))
+    input_file = write(tmp_path / "a.gdf", "data")
+    output = write(tmp_path / "image.png", "image")
+    old_key = cache.key(input_file, PARAMETERS)
+    new_key = cache.key(input_file, dict(PARAMETERS, duration=4))
+    cache.record(old_key, input_file, "GAF", PARAMETERS, [output])
+    cache.record(new_key, input_file, "GAF", dict(PARAMETERS, duration=4), [output])
+    assert list(cache.entries) == [new_key]
+    assert cache.invalidate(input_file) == 1 and cache.entries == {}
+    assert os.path.exists(output)
+
+# The outputs of changed or removed inputs are deleted, unless a live entry uses them
+def test_garbage_collect(tmp_path):
+    cache = BuildCache(str(tmp_path / "output"))
+    inputs = [write(tmp_path / f'{name}.gdf', name) for name in "abc"]
+    shared = write(tmp_path / "shared.png", "image")
+    outputs = [write(tmp_path / f'{name}.png', "image") for name in "abc"]
+    for input_file, output in zip(inputs, outputs):
+        cache.record(cache.key(input_file, PARAMETERS), input_file, "GAF", PARAMETERS, [output, shared])
+
+    write(inputs[0], "changed")
+    os.remove(inputs[1])
+    assert cache.garbage_collect() == (2, 2)
+    assert [os.path.exists(output) for output in outputs] == [False, False, True]
+    assert os.path.exists(shared) and len(cache.entries) == 1
+
+# Outputs of a superseded entry that the new one didn't overwrite (e.g. another image size in the names) are deleted by the GC
+def test_garbage_collect_superseded_outputs(tmp_path):
+    cache = BuildCache(str(tmp_path / "output"))
+    input_file = write(tmp_path / "a.gdf", "data")
+    shared = write(tmp_path / "shared.json", "manifest")
+    old_outputs = [write(tmp_path / "size_32.png", "image"), shared]
+    new_outputs = [write(tmp_path / "size_64.png", "image"), shared]
+    cache.record(cache.key(input_file, PARAMETERS), input_file, "GAF", PARAMETERS, old_outputs)
+    cache.record(cache.key(input_file, dict(PARAMETERS, image_size=64)), input_file, "GAF", dict(PARAMETERS, image_size=64), new_outputs)
+    cache.save()
+
+    cache = BuildCache(str(tmp_path / "output"))
+    assert cache.garbage_collect() == (0, 1)
+    assert not os.path.exists(old_outputs[0]) and all(os.path.exists(output) for output in new_outputs)
+    assert cache.garbage_collect() == (0, 0)
@@ -0,0 +1,57 @@
+import os
+import shutil
+
+import mne
+import pytest
+
+from Catalog import Catalog, scan_file, estimate_epochs, epoch_events
+from Preprocessing import preprocess_file
+from SyntheticEEG import synthetic_recording, write_gdf
+
+CHANNELS = ['EEG:C3', 'EEG:Cz', 'EEG:C4']
+
+# The header scan reads what mne reads when loading the recording
+def test_scan_file(input_folder):
+    file_path = os.path.join(input_folder, "B0102T.gdf")
+    entry = scan_file(file_path)
+    raw = mne.io.read_raw_gdf(file_path, preload=False, verbose=False)
+    assert (entry["sfreq"], entry["ch_names"], entry["n_times"]) == (raw.info['sfreq'], raw.ch_names, raw.n_times)
+    assert sum(entry["events"].values()) == len(raw.annotations)
+    assert entry["onsets"]["768"] == [round(float(onset), 6) for onset in raw.annotations.onset[raw.annotations.description == "768"]]
+
+# The estimates count the epochs the preprocessing keeps, also when windows at the start or the end of the recording are dropped
+@pytest.mark.parametrize("descriptions, tmin, tmax", [
+    (["769", "770"], -1, 2),
+    (["768"], -0.5, 4),
+    (["768", "769", "770"], -3.5, 5.5),
+    (["769", "770"], 0, 9.5),
+])
+def test_estimate_epochs(input_folder, descriptions, tmin, tmax):
+    for file_name in ["B0101T.gdf", "B0201T.gdf"]:
+        file_path = os.path.join(input_folder, file_name)
+        recording = preprocess_file(file_path, CHANNELS, descriptions, tmin, tmax)
+        assert estimate_epochs(scan_file(file_path), descriptions, tmin, tmax) == len(recording)
+
+# Events at the same onset are listed in the order of the annotations, like the preprocessing cuts them
+def test_epoch_events_ties(tmp_path):
+    data, ch_names, events = synthetic_recording(duration=20, seed=0)
+    events = sorted(events + [(10.0, "770"), (10.0, "769"), (10.0, "770")], key=lambda event: event[0])
+    file_path = str(tmp_path / "B0101T.gdf")
+    write_gdf(file_path, data, 250, ch_names, events)
+    recording = preprocess_file(file_path, CHANNELS, ["769", "770"], -1, 2)
+    assert [(int(index), description) for index, description, _ in epoch_events(scan_file(file_path), ["769", "770"], -1, 2)] == \
+        list(zip(recording.annotation_indexes.tolist(), recording.descriptions))
+
+# Only new or changed files are scanned again, also after reloading the catalog
+def test_update(input_folder, tmp_path):
+    file_paths = [shutil.copy(os.path.join(input_folder, file_name), tmp_path) for file_name in ["B0101T.gdf", "B0102T.gdf"]]
+    catalog = Catalog(str(tmp_path / "catalog" / "catalog.json"))
+    assert catalog.update(file_paths) == 2
+    catalog.save()
+
+    catalog = Catalog(str(tmp_path / "catalog" / "catalog.json"))
+    assert catalog.update(file_paths) == 0
+    shutil.copy(os.path.join(input_folder, "B0201T.gdf"), file_paths[1])
+    assert catalog.update(file_paths) == 1
+    assert catalog.entry(file_paths[1])["duration"] == 80
+    assert catalog.select(lambda entry: entry["duration"] < 70) == [file_paths[0]]
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+from ArraySink import load_shard
+from Epoching import crop_views
+from GAF import GAF
+
+CHANNELS = ['EEG:C3', 'EEG:Cz', 'EEG:C4']
+LABELS = {"769": "Left", "770": "Right"}
+
+def test_crop_views():
+    epochs = np.arange(2 * 3 * 20).reshape(2, 3, 20)
+    crops = crop_views(epochs, 8, 3, 5)
+    assert crops.shape == (2, 3, 3, 8) and not crops.flags.writeable
+    for crop in range(3):
+        np.testing.assert_array_equal(crops[:, crop], epochs[..., 5 * crop:5 * crop + 8])
+    with pytest.raises(ValueError):
+        crop_views(epochs, 8, 4, 5)
+
+# Images of one shard of a GAF npy run, by name
+def images_by_name(output_folder: str) -> dict:
+    images = {}
+    for label in LABELS.values():
+        folder = os.path.join(output_folder, "GAF", "summation", label)
+        for file_name in os.listdir(folder):
+            if file_name.endswith('.json'):
+                shard, manifest = load_shard(os.path.join(folder, file_name))
+                images.update((item["name"], image) for item, image in zip(manifest["items"], shard))
+    return images
+
+# The crops of a trial are the images of runs starting at each crop offset
+@pytest.mark.parametrize("image_size", [None, 25, 33])
+def test_crops_match_shifted_runs(input_folder, tmp_path, image_size):
+    file_path = os.path.join(input_folder, "B0101T.gdf")
+    options = dict(duration=0.996, desired_channels=CHANNELS, generate_intermediate_images=True, merge_channels=False, output_format="npy", image_size=image_size)
+    GAF(file_path, ["769", "770"], LABELS).generate_images(str(tmp_path / "crops"), t_start=-0.5, n_crops=3, crop_stride=0.2, **options)
+    crops = images_by_name(str(tmp_path / "crops"))
+    for crop in range(3):
+        GAF(file_path, ["769", "770"], LABELS).generate_images(str(tmp_path / f'crop-{crop}'), t_start=-0.5 + 0.2 * crop, **options)
+        shifted = images_by_name(str(tmp_path / f'crop-{crop}'))
+        assert len(shifted) > 0
+        for name, image in shifted.items():
+            channel = name.rsplit('-Ch-', 1)
+            np.testing.assert_allclose(crops[f'{channel[0]}-Crop-{crop}-Ch-{channel[1]}'], image, rtol=0, atol=1e-12)
+    assert len(crops) == 3 * len(shifted)
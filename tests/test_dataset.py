@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from ArraySink import build_manifest
+from Dataset import ImageDataset, file_images
+from TS2Image import TS2Image
+
+CHANNELS = ['EEG:C3', 'EEG:Cz', 'EEG:C4']
+OPTIONS = dict(valid_events_descriptions=["769", "770"], events_dictionary={"769": "Left", "770": "Right"}, t_start=-1, duration=3,
+               desired_channels=CHANNELS, image_size=16, chunk_size=3)
+
+def file_paths(input_folder: str) -> list:
+    return [os.path.join(input_folder, file_name) for file_name in ["B0101T.gdf", "B0102T.gdf", "B0201T.gdf"]]
+
+def passes(dataset: ImageDataset):
+    batches = list(dataset)
+    images = np.concatenate([images for images, _, _ in batches])
+    metadata = [item for _, _, batch_metadata in batches for item in batch_metadata]
+    return [len(images) for images, _, _ in batches], images, metadata
+
+# Batches follow the files and epochs order whatever the number of workers, and hold the images of `file_images`
+@pytest.mark.parametrize("method", ["GAF", "ERSP"])
+def test_order(input_folder, method):
+    expected = [chunk for file_path in file_paths(input_folder) for chunk in file_images(file_path, method, **OPTIONS)]
+    expected_images = np.concatenate([images for images, _, _ in expected])
+    for n_workers in [1, 3]:
+        sizes, images, metadata = passes(ImageDataset(file_paths(input_folder), method, **OPTIONS, batch_size=5, n_workers=n_workers, prefetch=1))
+        assert sizes == [5] * (len(expected_images) // 5) + ([len(expected_images) % 5] if len(expected_images) % 5 else [])
+        np.testing.assert_array_equal(images, expected_images)
+        assert metadata == [item for _, _, chunk_metadata in expected for item in chunk_metadata]
+        assert [item["label"] for item in metadata] == [{"769": "Left", "770": "Right"}[item["description"]] for item in metadata]
+
+# A seed and an epoch always give the same permutation of the images, another epoch gives another one
+def test_shuffle_is_deterministic(input_folder):
+    _, images, metadata = passes(ImageDataset(file_paths(input_folder), "GAF", **OPTIONS, batch_size=5))
+    key = lambda item: (item["file"], item["annotation"])
+    orders = {}
+    for epoch, n_workers in [(0, 1), (0, 3), (1, 2)]:
+        dataset = ImageDataset(file_paths(input_folder), "GAF", **OPTIONS, batch_size=5, shuffle=True, seed=7, shuffle_buffer=8, n_workers=n_workers, drop_last=True)
+        dataset.set_epoch(epoch)
+        sizes, shuffled_images, shuffled_metadata = passes(dataset)
+        assert set(sizes) == {5} and len(shuffled_images) == len(images) // 5 * 5
+        positions = {key(item): index for index, item in enumerate(metadata)}
+        np.testing.assert_array_equal(shuffled_images, images[[positions[key(item)] for item in shuffled_metadata]])
+        orders[(epoch, n_workers)] = [key(item) for item in shuffled_metadata]
+    assert orders[(0, 1)] == orders[(0, 3)]
+    assert orders[(1, 2)] != orders[(0, 1)]
+    assert orders[(0, 1)] != [key(item) for item in metadata][:len(orders[(0, 1)])]
+
+# With a cache folder the second pass reads the images back from the shards written by the first one
+def test_cache(input_folder, tmp_path):
+    dataset = ImageDataset(file_paths(input_folder), "GAF", **OPTIONS, batch_size=5, cache_folder=str(tmp_path))
+    _, images, metadata = passes(dataset)
+    assert len(dataset.cache.entries) == 3
+    modified = {output: os.stat(output).st_mtime_ns for entry in dataset.cache.entries.values() for output in entry["outputs"]}
+    _, cached_images, cached_metadata = passes(dataset)
+    np.testing.assert_array_equal(cached_images, images)
+    assert cached_metadata == metadata
+    assert {output: os.stat(output).st_mtime_ns for output in modified} == modified
+
+# The shards of the dataset cache are not in the index of an npy run in the same output folder, wherever the cache is
+def test_cache_not_in_manifest(input_folder, tmp_path):
+    ts2image = TS2Image(input_folder, str(tmp_path / "output"))
+    events = {name: OPTIONS[name] for name in ["valid_events_descriptions", "events_dictionary", "t_start", "duration"]}
+    for cache_folder in [None, str(tmp_path / "output" / ".dataset-cache")]:
+        list(ts2image.dataset("GAF", **events, image_size=16, cache=True, cache_folder=cache_folder))
+    assert os.path.isdir(tmp_path / "output.dataset-cache") and os.path.isdir(tmp_path / "output" / ".dataset-cache")
+    ts2image.generate_images(method="GAF", **events, output_format="npy", image_size=32)
+    with open(build_manifest(str(tmp_path / "output"))) as f:
+        arrays = [shard["array"] for shard in json.load(f)["shards"]]
+    assert len(arrays) > 0 and all(array.startswith("GAF/") for array in arrays)
@@ -0,0 +1,27 @@
+import os
+
+import mne
+import numpy as np
+import pytest
+
+from Epoching import extract_epochs, read_filtered_epochs
+
+# Windows near both ends of the recording (where the padding is cut) and outside of it
+START_SAMPLES = [-5, 0, 10, 2000, 7000, 14200, 14300]
+N_TIMES = 751
+
+# Filtering only a padded window around each epoch gives the epochs of the filtered full recording.
+# With min_n_times the window at 14300 is kept, zero padded after the end of the recording (15000 samples)
+@pytest.mark.parametrize("min_n_times, expected_mask", [(None, [False, True, True, True, True, True, False]), (500, [False, True, True, True, True, True, True])])
+@pytest.mark.parametrize("l_freq, h_freq", [(1, 40), (8, 30)])
+def test_lazy_matches_preload(input_folder, l_freq, h_freq, min_n_times, expected_mask):
+    file_path = os.path.join(input_folder, "B0101T.gdf")
+    raw = mne.io.read_raw_gdf(file_path, preload=True, verbose=False)
+    raw.filter(l_freq=l_freq, h_freq=h_freq, verbose=False)
+    expected, expected_in_bounds = extract_epochs(raw.get_data(), START_SAMPLES, N_TIMES, min_n_times=min_n_times)
+
+    raw = mne.io.read_raw_gdf(file_path, preload=False, verbose=False)
+    epochs, in_bounds = read_filtered_epochs(raw, START_SAMPLES, N_TIMES, l_freq=l_freq, h_freq=h_freq, min_n_times=min_n_times)
+    assert in_bounds.tolist() == expected_in_bounds.tolist() == expected_mask
+    assert not expected[5:, :, raw.n_times - START_SAMPLES[-1]:].any()
+    np.testing.assert_allclose(epochs, expected, rtol=0, atol=1e-12 * np.abs(expected).max())
@@ -0,0 +1,89 @@
+import os
+
+import mne
+import numpy as np
+import pytest
+from mne.baseline import rescale
+from mne.time_frequency import tfr_array_multitaper
+
+from ArraySink import load_shard
+from ERSP import ERSP, ersp_power, N_CYCLES, BASELINE, MODE
+from Spectral import KernelCache
+import Spectral
+
+CHANNELS = ['EEG:C3', 'EEG:Cz', 'EEG:C4']
+FREQS = np.arange(1, 40, 1)
+SFREQ = 250.0
+
+# Baseline corrected power of every trial, computed at once on the epochs mne.Epochs takes from the filtered recording
+def reference_power(file_path: str, t_start, t_end) -> dict:
+    raw = mne.io.read_raw_gdf(file_path, preload=True, verbose=False).pick_channels(CHANNELS)
+    raw.filter(l_freq=1, h_freq=40, verbose=False)
+    events, event_id = mne.events_from_annotations(raw, event_id={"769": 1, "770": 2}, verbose=False)
+    epochs = mne.Epochs(raw, events, event_id, t_start, t_end, baseline=None, preload=True, verbose=False)
+    power = tfr_array_multitaper(epochs.get_data(), sfreq=raw.info['sfreq'], freqs=FREQS, n_cycles=FREQS, use_fft=True, decim=2, output='power', verbose=False)
+    rescale(power, epochs.times[::2], [-1, 0], mode="percent", copy=False, verbose=False)
+    return {description: power[epochs.events[:, 2] == code] for description, code in event_id.items()}
+
+# The averages and single trial maps computed in chunks match the whole epochs array transformed at once
+@pytest.mark.parametrize("per_trial", [False, True])
+def test_chunks_match_mne(input_folder, tmp_path, per_trial):
+    file_path = os.path.join(input_folder, "B0101T.gdf")
+    ERSP(file_path).generate_images(str(tmp_path), CHANNELS, ["769", "770"], -1, 2, generate_intermediate_images=True,
+                                    output_format="npy", chunk_size=3, per_trial=per_trial)
+    for description, power in reference_power(file_path, -1, 2).items():
+        images, manifest = load_shard(str(tmp_path / "ERSP" / description / f'B0101T.gdf-{len(FREQS)}x{power.shape[-1]}.json'))
+        expected = power.reshape(-1, *power.shape[2:]) if per_trial else power.mean(axis=0)
+        assert [item["channel"] for item in manifest["items"]] == CHANNELS * (len(power) if per_trial else 1)
+        np.testing.assert_allclose(images, expected, rtol=1e-10, atol=1e-12)
+
+# mne's tfr_multitaper (array version, one power per trial) followed by the baseline correction, what ersp_power replaces
+def mne_ersp(data: np.ndarray, t_start: float, decim: int) -> np.ndarray:
+    power = tfr_array_multitaper(data, SFREQ, FREQS, N_CYCLES, use_fft=True, decim=decim, output='power', verbose=False)
+    times = (int(round(t_start * SFREQ)) + np.arange(data.shape[-1])) / SFREQ
+    return rescale(power, times[::decim], BASELINE, mode=MODE, verbose=False)
+
+def ersp(data: np.ndarray, t_start: float, decim: int, chunk_size: int = 3, **kwargs) -> np.ndarray:
+    return np.concatenate([power for _, power in ersp_power(data, SFREQ, t_start, chunk_size=chunk_size, decim=decim, **kwargs)])
+
+# A fresh kernel cache for each test, banks built here are not left in the process wide one
+@pytest.fixture
+def kernel_cache(monkeypatch):
+    cache = KernelCache()
+    monkeypatch.setattr(Spectral, "kernel_cache", cache)
+    return cache
+
+# Odd and even lengths (the wavelets are centered on the samples) and every decimation used
+@pytest.mark.parametrize("n_times, decim", [(1001, 2), (1000, 2), (751, 3), (1001, 1)])
+def test_kernel_bank_matches_mne(kernel_cache, n_times, decim):
+    data = np.random.default_rng(n_times).normal(size=(7, 3, n_times))
+    expected = mne_ersp(data, -1, decim)
+    power = ersp(data, -1, decim)
+    assert power.shape == expected.shape
+    np.testing.assert_allclose(power, expected, rtol=1e-9, atol=1e-9 * np.abs(expected).max())
+
+# Inverse FFTs in blocks of a few signals and frequencies, or of one frequency of one signal, give the same power as one block
+@pytest.mark.parametrize("max_block_values", [5000, 1])
+def test_blocks(kernel_cache, monkeypatch, max_block_values):
+    data = np.random.default_rng(0).normal(size=(4, 3, 1001))
+    power = ersp(data, -1, 2)
+    monkeypatch.setattr(Spectral, "MAX_BLOCK_VALUES", max_block_values)
+    np.testing.assert_allclose(ersp(data, -1, 2), power, rtol=1e-12, atol=1e-12 * np.abs(power).max())
+
+# Banks read back from the disk cache by another process (here another cache) give the same power
+def test_disk_kernel_cache(tmp_path, kernel_cache, monkeypatch):
+    data = np.random.default_rng(0).normal(size=(4, 2, 1001))
+    power = ersp(data, -1, 2, kernel_cache_folder=str(tmp_path))
+    assert kernel_cache.stats["built"] == 1 and len(list(tmp_path.glob('*.npy'))) == 1
+
+    other_cache = KernelCache()
+    monkeypatch.setattr(Spectral, "kernel_cache", other_cache)
+    np.testing.assert_array_equal(ersp(data, -1, 2, kernel_cache_folder=str(tmp_path)), power)
+    assert other_cache.stats == {"memory": 1, "disk": 1, "built": 0}
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_dtype(kernel_cache, dtype):
+    data = np.random.default_rng(0).normal(size=(4, 2, 1001))
+    power = ersp(data, -1, 2, dtype=dtype)
+    assert power.dtype == dtype
+    np.testing.assert_allclose(power, mne_ersp(data, -1, 2).astype(dtype), rtol=1e-3 if dtype == np.float16 else 1e-6, atol=1e-3)
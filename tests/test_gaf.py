@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from pyts.image import GramianAngularField
+
+from GAF import gramian_angular_fields
+from Quantization import working_dtype
+from Triangular import pack_triangular, unpack_triangular
+
+# Epochs of random walks, one of them constant (rescaled to the lower bound, like pyts)
+def epochs(n_timestamps: int = 101, seed: int = 0) -> np.ndarray:
+    X = np.random.default_rng(seed).normal(size=(5, 3, n_timestamps)).cumsum(axis=-1)
+    X[1, 2] = 3.0
+    return X
+
+def fields(X: np.ndarray, **kwargs):
+    chunks = list(gramian_angular_fields(X, summation=True, difference=True, chunk_size=2, **kwargs))
+    assert [start for start, _, _ in chunks] == list(range(0, len(X), 2))
+    return np.concatenate([gasf for _, gasf, _ in chunks]), np.concatenate([gadf for _, _, gadf in chunks])
+
+def pyts_fields(X: np.ndarray, method: str, image_size: int) -> np.ndarray:
+    transformer = GramianAngularField(image_size=image_size or X.shape[-1], method=method)
+    return np.stack([transformer.fit_transform(epoch) for epoch in X])
+
+# pyts computes the fields with arccos and cos, which lose about sqrt(eps) near +-1
+PYTS_ATOL = 1e-7
+
+# Image sizes: one pixel per sample, a divisor of the length, sizes that aren't (uneven PAA segments) and larger than the length
+@pytest.mark.parametrize("n_timestamps", [101, 250])
+@pytest.mark.parametrize("image_size", [None, 101, 50, 33, 16, 7, 200])
+def test_matches_pyts(n_timestamps, image_size):
+    X = epochs(n_timestamps)
+    gasf, gadf = fields(X, image_size=image_size)
+    size = min(image_size or n_timestamps, n_timestamps)
+    assert gasf.shape == gadf.shape == (5, 3, size, size)
+    np.testing.assert_allclose(gasf, pyts_fields(X, 'summation', size), rtol=0, atol=PYTS_ATOL)
+    np.testing.assert_allclose(gadf, pyts_fields(X, 'difference', size), rtol=0, atol=PYTS_ATOL)
+
+# Fields of float32 epochs, and float16 fields computed from float32 epochs like the pipeline does (see Quantization.working_dtype),
+# with the precision of their dtype. Epochs in volts (1e-5 scale) are subnormal in float16
+@pytest.mark.parametrize("dtype, atol", [(np.float32, 1e-5), (np.float16, 2e-2)])
+@pytest.mark.parametrize("scale", [1, 1e-5])
+@pytest.mark.parametrize("image_size", [None, 33])
+def test_dtypes_match_pyts(dtype, atol, scale, image_size):
+    X = epochs() * scale
+    gasf, gadf = fields(X.astype(working_dtype(dtype)), image_size=image_size, dtype=dtype)
+    assert gasf.dtype == gadf.dtype == dtype
+    size = min(image_size or X.shape[-1], X.shape[-1])
+    np.testing.assert_allclose(gasf, pyts_fields(X, 'summation', size), rtol=0, atol=atol)
+    np.testing.assert_allclose(gadf, pyts_fields(X, 'difference', size), rtol=0, atol=atol)
+
+def test_only_requested_fields():
+    _, gasf, gadf = next(gramian_angular_fields(epochs(), summation=False, difference=True))
+    assert gasf is None and gadf.shape == (5, 3, 101, 101)
+
+# Packed fields are exactly the upper triangles of the dense ones, and expand back to them exactly
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.float16])
+@pytest.mark.parametrize("image_size", [None, 16, 33])
+def test_packed_round_trip(dtype, image_size):
+    X = epochs().astype(dtype)
+    gasf, gadf = fields(X, image_size=image_size)
+    packed_gasf, packed_gadf = fields(X, image_size=image_size, packed=True)
+    size = gasf.shape[-1]
+    assert packed_gasf.shape == (5, 3, size * (size + 1) // 2)
+    np.testing.assert_array_equal(packed_gasf, pack_triangular(gasf))
+    np.testing.assert_array_equal(packed_gadf, pack_triangular(gadf))
+    np.testing.assert_array_equal(unpack_triangular(packed_gasf, size), gasf)
+    np.testing.assert_array_equal(unpack_triangular(packed_gadf, size, antisymmetric=True), gadf)
@@ -0,0 +1,36 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from PIL import Image
+
+from ImageWriter import ImageWriter
+
+def read_png(path) -> np.ndarray:
+    return np.asarray(Image.open(path).convert('RGBA'))
+
+# The lookup table colors every pixel like plt.imsave, which normalizes each image with its own min and max
+@pytest.mark.parametrize("cmap", ["viridis", "RdBu"])
+def test_matches_imsave(tmp_path, cmap):
+    rng = np.random.default_rng(0)
+    images = rng.normal(size=(4, 20, 30))
+    images[1] = 2.5
+    images[2, 0, 0] = 1e3
+    with ImageWriter(cmap=cmap, max_pending=2) as writer:
+        writer.save_batch(str(tmp_path / "writer"), [f'image-{index}' for index in range(2)], images[:2])
+        for index in range(2, len(images)):
+            writer.save(str(tmp_path / "writer"), f'image-{index}', images[index])
+    assert sorted(writer.written) == [str(tmp_path / "writer" / f'image-{index}.png') for index in range(len(images))]
+
+    for index, image in enumerate(images):
+        plt.imsave(tmp_path / f'imsave-{index}.png', image, cmap=cmap)
+        np.testing.assert_array_equal(read_png(tmp_path / "writer" / f'image-{index}.png'), read_png(tmp_path / f'imsave-{index}.png'))
+
+# Errors of the writer threads are raised by close
+def test_close_raises_write_errors(tmp_path):
+    (tmp_path / "file").write_text("not a folder")
+    writer = ImageWriter()
+    writer.save(str(tmp_path / "file"), 'image', np.zeros((2, 2)))
+    with pytest.raises(OSError):
+        writer.close()
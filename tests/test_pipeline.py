@@ -0,0 +1,139 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import TS2Image as TS2Image_module
+from TS2Image import TS2Image
+
+EVENTS = dict(valid_events_descriptions=["769", "770"], events_dictionary={"768": "Start", "769": "Left", "770": "Right"}, t_start=-1, duration=3)
+
+# Every file written in the output folder, relative to it: the images and shards with their manifests, not the cache, metrics reports or indexes
+def written_files(output_folder: str) -> set:
+    files = set()
+    for root, dirs, file_names in os.walk(output_folder):
+        dirs[:] = [folder for folder in dirs if not folder.startswith('.')]
+        files.update(os.path.relpath(os.path.join(root, file_name), output_folder) for file_name in file_names
+                     if not file_name.startswith(('.', 'manifest', 'metrics')))
+    return files
+
+def read_files(output_folder: str) -> dict:
+    contents = {}
+    for file in written_files(output_folder):
+        with open(os.path.join(output_folder, file), 'rb') as f:
+            contents[file] = f.read()
+    return contents
+
+# Worker processes write the same files, byte for byte, as a serial run
+@pytest.mark.parametrize("method", ["GAF", "ERSP"])
+def test_workers_match_serial(input_folder, tmp_path, method):
+    contents = {}
+    for n_workers in [1, 2]:
+        output_folder = str(tmp_path / f'output-{n_workers}')
+        results = TS2Image(input_folder, output_folder).generate_images(method=method, **EVENTS, n_workers=n_workers)
+        assert len(results) == 3 and all(result["error"] is None for result in results)
+        contents[n_workers] = read_files(output_folder)
+    assert len(contents[1]) > 0
+    assert contents[2] == contents[1]
+
+# The npy shards hold one image for every PNG of a png run, with the same names
+@pytest.mark.parametrize("method", ["GAF", "ERSP"])
+def test_npy_has_the_png_images(input_folder, tmp_path, method):
+    TS2Image(input_folder, str(tmp_path / "png")).generate_images(method=method, **EVENTS)
+    TS2Image(input_folder, str(tmp_path / "npy")).generate_images(method=method, **EVENTS, output_format="npy")
+    png_images = set(file[:-len('.png')] for file in written_files(str(tmp_path / "png")))
+    with open(tmp_path / "npy" / "manifest.json") as f:
+        shards = json.load(f)["shards"]
+    npy_images = set(os.path.join(os.path.dirname(shard["array"]), item["name"]) for shard in shards for item in shard["items"])
+    assert len(png_images) > 0 and npy_images == png_images
+
+# A second run finds every job in the build cache and doesn't write anything
+def test_rerun_is_cached(input_folder, tmp_path):
+    output_folder = str(tmp_path / "output")
+    results = TS2Image(input_folder, output_folder).generate_images(method="GAF", **EVENTS)
+    assert not any(result["cached"] for result in results)
+    modified = {file: os.stat(os.path.join(output_folder, file)).st_mtime_ns for file in written_files(output_folder)}
+    rerun = TS2Image(input_folder, output_folder).generate_images(method="GAF", **EVENTS)
+    assert all(result["cached"] for result in rerun)
+    assert [result["outputs"] for result in rerun] == [{method: sorted(paths) for method, paths in result["outputs"].items()} for result in results]
+    assert {file: os.stat(os.path.join(output_folder, file)).st_mtime_ns for file in written_files(output_folder)} == modified
+
+# Running the methods together writes the files of running them one by one, although they share the epochs: with this window the last
+# trial of B0201T fits for GAF ([-2, 4] s) but not for ERSP ([-2, 6] s). dry_run predicts the same files
+def test_methods_share_epochs(input_folder, tmp_path):
+    events = dict(EVENTS, t_start=-2, duration=6, image_size=16)
+    contents = {}
+    for method in ["GAF", "ERSP"]:
+        TS2Image(input_folder, str(tmp_path / method)).generate_images(method=method, **events)
+        contents.update(read_files(str(tmp_path / method)))
+    assert any(file.endswith('size_16-B0201T.gdf-Ann-9-Ch-0.png') for file in contents)
+
+    ts2image = TS2Image(input_folder, str(tmp_path / "both"))
+    dry_runs = ts2image.dry_run(method=["GAF", "ERSP"], **events)
+    ts2image.generate_images(method=["GAF", "ERSP"], **events)
+    assert read_files(str(tmp_path / "both")) == contents
+    expected = set(os.path.relpath(path, str(tmp_path / "both")) for dry_run in dry_runs for paths in dry_run["outputs"].values() for path in paths)
+    assert expected == set(contents)
+
+# With a single job left after the cache check no worker process nor fork server is started, the job runs in this process
+def test_single_job_runs_inline(input_folder, tmp_path, monkeypatch):
+    ts2image = TS2Image(input_folder, str(tmp_path / "output"))
+    # The first two files (60 and 70 s long)
+    ts2image.generate_images(method="GAF", **EVENTS, image_size=16, select=lambda entry: entry["duration"] < 75)
+    monkeypatch.setattr(TS2Image_module, "_worker_context", lambda: pytest.fail("worker processes started for a single job"))
+    results = ts2image.generate_images(method="GAF", **EVENTS, image_size=16, n_workers=2)
+    assert [result["cached"] for result in results] == [True, True, False]
+    assert all(result["error"] is None for result in results)
+
+# The shards of a distributed run write the files of a single run between them, and merge_shards indexes them all
+def test_shards_merge_to_a_single_run(input_folder, tmp_path):
+    TS2Image(input_folder, str(tmp_path / "single")).generate_images(method="ERSP", **EVENTS, output_format="npy")
+    sharded = TS2Image(input_folder, str(tmp_path / "sharded"))
+    shard_files = []
+    for index in range(2):
+        results = sharded.generate_images(method="ERSP", **EVENTS, output_format="npy", shard=(index, 2))
+        shard_files.append(set(result["file"] for result in results))
+        if index == 0:
+            with pytest.raises(ValueError):
+                sharded.merge_shards()
+    assert shard_files[0].isdisjoint(shard_files[1]) and len(shard_files[0] | shard_files[1]) == 3
+    assert read_files(str(tmp_path / "sharded")) == read_files(str(tmp_path / "single"))
+
+    sharded.merge_shards()
+    manifests = {}
+    for folder in ["single", "sharded"]:
+        with open(tmp_path / folder / "manifest.json") as f:
+            manifests[folder] = sorted(json.load(f)["shards"], key=lambda shard: shard["array"])
+    assert len(manifests["single"]) > 0 and manifests["sharded"] == manifests["single"]
+
+# dry_run writes nothing and predicts, from the catalog only, every path a run writes, and reports them as cached after the run
+@pytest.mark.parametrize("options", [
+    dict(method=["GAF", "ERSP"]),
+    dict(method=["GAF", "ERSP"], output_format="npy", image_size=16, packed=True),
+    dict(method="GAF", image_size=20, n_crops=3, crop_stride=0.25, quantize="rgb"),
+    dict(method="ERSP", per_trial=True, output_format="npy", dtype="float32"),
+    dict(method="ERSP", significance="mask", n_permutations=32),
+], ids=["png", "npy-packed", "crops-rgb", "per-trial", "significance"])
+def test_dry_run_paths(input_folder, tmp_path, options):
+    ts2image = TS2Image(input_folder, str(tmp_path / "output"))
+    dry_runs = ts2image.dry_run(**EVENTS, **options)
+    assert not os.path.exists(tmp_path / "output")
+    expected = set(path for dry_run in dry_runs for paths in dry_run["outputs"].values() for path in paths)
+    assert all(not cached for dry_run in dry_runs for cached in dry_run["cached"].values())
+
+    results = ts2image.generate_images(**EVENTS, **options, metrics_report=None)
+    assert all(result["error"] is None for result in results)
+    generated = set(path for result in results for paths in result["outputs"].values() for path in paths)
+    assert generated == expected
+    assert set(os.path.join(str(tmp_path / "output"), file) for file in written_files(str(tmp_path / "output"))) == expected
+
+    dry_runs = ts2image.dry_run(**EVENTS, **options)
+    assert all(cached for dry_run in dry_runs for cached in dry_run["cached"].values())
+
+# Planning commands don't load the heavy libraries, they are imported when a method runs. -I: a clean interpreter, without PYTHONPATH
+def test_deferred_imports():
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    code = f'import sys; sys.path.insert(0, {src!r}); import TS2Image; print(sorted(set(["mne", "matplotlib", "scipy"]) & set(sys.modules)))'
+    assert subprocess.run([sys.executable, '-I', '-c', code], capture_output=True, text=True, check=True).stdout.strip() == '[]'
@@ -0,0 +1,27 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from Quantization import quantize, rgb_lut, parse_dtype
+
+# Values are mapped linearly from the range to 0..255 and clipped outside of it
+def test_gray_levels():
+    images = np.array([[-2.0, -1.0, -0.5, 0.0], [0.5, 0.999, 1.0, 3.0]])
+    levels = quantize(images, (-1, 1))
+    assert levels.dtype == np.uint8
+    np.testing.assert_array_equal(levels, [[0, 0, 64, 128], [191, 255, 255, 255]])
+    np.testing.assert_array_equal(quantize(images.astype(np.float32), (-1, 1)), levels)
+
+# RGB images take the color map color of each gray level
+def test_rgb():
+    images = np.random.default_rng(0).uniform(-1.2, 1.2, size=(2, 3, 5, 5))
+    rgb = quantize(images, (-1, 1), rgb_lut('viridis'))
+    assert rgb.shape == images.shape + (3,) and rgb.dtype == np.uint8
+    expected = plt.get_cmap('viridis')(quantize(images, (-1, 1)) / 255)[..., :3] * 255
+    np.testing.assert_allclose(rgb, expected, atol=0.5)
+
+def test_parse_dtype():
+    assert parse_dtype(None) is None
+    assert parse_dtype("float32") == np.float32 and parse_dtype(np.float16) == np.float16
+    with pytest.raises(ValueError):
+        parse_dtype("int16")
@@ -0,0 +1,22 @@
+import pytest
+
+from Sharding import parse_shard, partition
+
+def test_parse_shard():
+    assert parse_shard("0/4") == (0, 4) and parse_shard("3/4") == (3, 4)
+    for text in ["4/4", "-1/4", "0/0", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(text)
+
+# Every item goes to exactly one part, the parts have similar weights and don't depend on the listing order
+@pytest.mark.parametrize("count", [1, 2, 3, 5])
+def test_partition(count):
+    items = [f'B{index:02d}T.gdf' for index in range(13)]
+    weights = {item: (index * 7) % 5 + 1 for index, item in enumerate(items)}
+    parts = partition(items, weights, count)
+    assert len(parts) == count
+    assert sorted(item for part in parts for item in part) == items
+    assert all(part == sorted(part) for part in parts)
+    loads = [sum(weights[item] for item in part) for part in parts]
+    assert max(loads) - min(loads) <= max(weights.values())
+    assert partition(items[::-1], weights, count) == parts
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from mne.stats import permutation_cluster_1samp_test
+from scipy import stats
+
+from Significance import cluster_permutation_mask, significance_masks
+
+# Trials of noise with an effect in one time-frequency region
+def trials(seed: int = 0, effect: float = 0.9) -> np.ndarray:
+    X = np.random.default_rng(seed).normal(size=(20, 20, 60))
+    X[:, 5:10, 20:35] += effect
+    return X
+
+def mne_mask(X: np.ndarray, threshold: float, n_permutations: int, alpha: float) -> np.ndarray:
+    _, clusters, p_values, _ = permutation_cluster_1samp_test(X, threshold=threshold, n_permutations=n_permutations, tail=0, out_type='mask',
+                                                               seed=0, verbose=False)
+    mask = np.zeros(X.shape[1:], dtype=bool)
+    for cluster, p_value in zip(clusters, p_values):
+        if p_value <= alpha:
+            mask |= cluster
+    return mask
+
+# The clusters are the ones mne forms, with every cluster kept (alpha = 1) and only the significant ones
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_matches_mne(seed):
+    X = trials(seed)
+    threshold = stats.t.ppf(1 - 0.05 / 2, len(X) - 1)
+    np.testing.assert_array_equal(cluster_permutation_mask(X, n_permutations=64, alpha=1, threshold=threshold), mne_mask(X, threshold, 64, 1))
+    mask = cluster_permutation_mask(X, n_permutations=512, seed=seed)
+    assert mask[5:10, 20:35].mean() > 0.9
+    np.testing.assert_array_equal(mask, mne_mask(X, threshold, 512, 0.05))
+
+def test_no_effect_or_too_few_trials():
+    assert not cluster_permutation_mask(np.zeros((20, 20, 10))).any()
+    assert not cluster_permutation_mask(trials()[:1]).any()
+
+# The masks only depend on the seed, not on the number of worker processes
+def test_workers_match_serial():
+    tests = {(event, channel): trials(seed=channel) + 0.01 * channel for event in ["769", "770"] for channel in range(3)}
+    serial = significance_masks(tests, n_permutations=128, n_workers=1)
+    for n_workers in [None, 2]:
+        masks = significance_masks(tests, n_permutations=128, n_workers=n_workers)
+        assert set(masks) == set(tests)
+        assert all(np.array_equal(masks[key], serial[key]) for key in tests)
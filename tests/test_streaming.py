@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from GAF import gramian_angular_fields, paa
+from Streaming import StreamingGAF, StreamFilter
+
+WINDOW, HOP = 100, 20
+
+def signal(n_samples: int = 1000, seed: int = 0) -> np.ndarray:
+    return 1e-5 * np.random.default_rng(seed).normal(size=(3, n_samples)).cumsum(axis=-1)
+
+# The GAF of every window computed from scratch, with the scaling of the streaming GAF: [(end_sample, gasf, gadf)]
+def offline_images(X: np.ndarray, image_size: int, scaling: str, value_range: tuple = None) -> list:
+    segment = WINDOW // image_size
+    points = paa(X, X.shape[-1] // segment)
+    images = []
+    for end_sample in range(WINDOW, X.shape[-1] + 1, HOP):
+        end = end_sample // segment
+        window_points = points[:, end - image_size:end]
+        if scaling == "window":
+            _, gasf, gadf = next(gramian_angular_fields(window_points[np.newaxis], summation=True, difference=True))
+            images.append((end_sample, gasf[0], gadf[0]))
+            continue
+        if scaling == "fixed":
+            low, high = value_range
+        else:
+            low, high = points[:, :end].min(axis=1, keepdims=True), points[:, :end].max(axis=1, keepdims=True)
+        cos = np.clip((window_points - low) / (high - low) * 2 - 1, -1, 1)
+        sin = np.sqrt(1 - cos ** 2)
+        gasf = cos[:, :, None] * cos[:, None, :] - sin[:, :, None] * sin[:, None, :]
+        gadf = sin[:, :, None] * cos[:, None, :] - cos[:, :, None] * sin[:, None, :]
+        images.append((end_sample, gasf, gadf))
+    return images
+
+# Samples pushed in chunks of random sizes
+def push_in_chunks(streaming_gaf: StreamingGAF, X: np.ndarray) -> list:
+    chunk_ends = np.sort(np.random.default_rng(1).choice(np.arange(1, X.shape[-1]), size=60, replace=False)).tolist() + [X.shape[-1]]
+    images = []
+    start = 0
+    for end in chunk_ends:
+        images += streaming_gaf.push(X[:, start:end])
+        start = end
+    return images
+
+def assert_images_equal(images: list, expected: list):
+    assert [end_sample for end_sample, _, _ in images] == [end_sample for end_sample, _, _ in expected]
+    for (_, gasf, gadf), (_, expected_gasf, expected_gadf) in zip(images, expected):
+        np.testing.assert_allclose(gasf, expected_gasf, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(gadf, expected_gadf, rtol=0, atol=1e-12)
+
+# The incrementally updated images equal the offline GAF of each window, whatever the size of the chunks
+@pytest.mark.parametrize("scaling, value_range", [("fixed", (-2e-4, 2e-4)), ("running", None), ("window", None)])
+@pytest.mark.parametrize("image_size", [25, WINDOW])
+def test_incremental_matches_offline(scaling, value_range, image_size):
+    X = signal()
+    streaming_gaf = StreamingGAF(3, WINDOW, HOP, image_size=image_size, scaling=scaling, value_range=value_range, difference=True)
+    images = push_in_chunks(streaming_gaf, X)
+    assert_images_equal(images, offline_images(X, image_size, scaling, value_range))
+    if scaling == "fixed":
+        assert streaming_gaf.updates == {"incremental": len(images), "full": 0}
+    elif scaling == "running":
+        assert streaming_gaf.updates["incremental"] > 0 and streaming_gaf.updates["full"] > 0
+
+# With a backlog only the newest images are read out, and they are the same
+def test_max_images():
+    X = signal()
+    streaming_gaf = StreamingGAF(3, WINDOW, HOP, image_size=25, scaling="running", difference=True)
+    images = streaming_gaf.push(X[:, :500], max_images=2) + streaming_gaf.push(X[:, 500:], max_images=1)
+    expected = offline_images(X, 25, "running")
+    assert_images_equal(images, [image for image in expected if image[0] in [480, 500, 1000]])
+
+def test_invalid_parameters():
+    for kwargs in [dict(image_size=30), dict(hop=10, image_size=5), dict(hop=0), dict(scaling="fixed"), dict(scaling="other")]:
+        with pytest.raises(ValueError):
+            StreamingGAF(3, WINDOW, **dict(dict(hop=HOP), **kwargs))
+
+# The filter keeps its state between chunks, so filtering chunk by chunk equals filtering the whole signal at once
+def test_filter_state():
+    from scipy.signal import sosfilt
+    X = signal()
+    stream_filter = StreamFilter(250, 3)
+    filtered = np.concatenate([stream_filter(chunk) for chunk in np.array_split(X, 37, axis=-1)], axis=-1)
+    np.testing.assert_allclose(filtered, sosfilt(stream_filter.sos, X, axis=-1), rtol=0, atol=1e-18)